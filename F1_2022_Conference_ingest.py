@@ -1,19 +1,17 @@
 ###########################################################################################
 ####                 Custom Code to run F1 Ingest as a Forwarding Script
 import time
-import signalfx
+
+# Startup is timed from here, see report_startup
+startup_started = time.perf_counter()
+
 import configparser
 import argparse
-import json
-import requests
-import background
-import urllib3
-from datetime import datetime
-from f1_22_telemetry.listener import TelemetryListener
-from requests.adapters import HTTPAdapter, Retry
+import importlib
+import os
+import socket
 
-urllib3.disable_warnings()
-background.n = 40
+from f1_ingest.control import delta_settings
 
 global hostname
 global player_name
@@ -24,8 +22,6 @@ global motion
 global telemetry
 global lap
 global status
-global player_info  # Details of current player
-global lap_info  # track events such as lap and sector completion for filtering
 
 parser = argparse.ArgumentParser(description="Splunk DataDrivers")
 parser.add_argument("--hostname", help="Hostname", default="host_1")
@@ -33,17 +29,41 @@ parser.add_argument("--player", help="Player Name", default="Drivey McDriverface
 parser.add_argument("--port", help="UDP Port", type=int, default=20777)
 parser.add_argument("--o11y", help="Send data to O11y Cloud", choices=["yes", "no"], default="no")
 parser.add_argument("--splunk", help="Send data to Splunk Enterprise/Cloud", choices=["yes", "no"], default="yes")
+# write every merged row to local Parquet or Arrow files, one per session and packet type
+parser.add_argument("--archive", help="Archive sessions to local columnar files", choices=["yes", "no"], default="no")
 # mode should be "Spectator" to grab all cars, "Solo" to only grab data for the player car
 parser.add_argument("--mode", help="Spectator or Solo Mode", choices=["spectator", "solo"], default="spectator")
+# ingest every rig listed in [rigs] instead of the single --hostname/--player/--port rig
+parser.add_argument("--rigs", help="Ingest all rigs from settings.ini", action="store_true")
+# struct decodes the raw UDP bytes straight into flat rows, json is the original to_json()/json.loads() path,
+# numpy decodes the per car arrays into structured NumPy arrays and only builds rows when sending to HEC
+parser.add_argument("--decoder", help="Packet decoder", choices=["struct", "json", "numpy"], default="struct")
+# threads runs the staged worker pipeline, asyncio receives, decodes and sends on a single event loop
+parser.add_argument("--engine", help="Ingest engine", choices=["threads", "asyncio"], default="threads")
+parser.add_argument("--benchmark-decoder", help="Decode N synthetic packets of each type with both decoders, print packets/sec and exit", type=int, metavar="N")
+# decode -> merge -> serialise -> send against local fake HEC and SignalFx servers, in solo and spectator mode
+parser.add_argument("--benchmark", help="Run N frames of synthetic packets (or N passes over the --replay capture) through the whole ingest path against local fake HEC and SignalFx servers, print the results and exit", type=int, metavar="N")
+# append every received UDP datagram to a capture file, one file per rig with --rigs
+parser.add_argument("--record", help="Record the raw UDP packets to a capture file", metavar="FILE")
+# feed a capture file through the pipeline instead of listening on the UDP port
+parser.add_argument("--replay", help="Replay a capture file into the pipeline and exit", metavar="FILE")
+parser.add_argument("--replay-speed", help="Replay speed, 1 is real time, 0 is as fast as possible", type=float, default=1.0, metavar="X")
+# sample every thread's stack from startup, a window can also be started at any time with SIGUSR1
+parser.add_argument("--profile", help="Profile the first S seconds of the run and write a flamegraph and function summary", type=int, metavar="S")
 args = vars(parser.parse_args())
 
+if args["replay"] and not args["benchmark"] and (args["rigs"] or args["record"]):
+    parser.error("--replay replays into the command line rig and cannot be combined with --rigs or --record")
+if args["replay_speed"] < 0:
+    parser.error("--replay-speed must be 0 or more")
+if args["profile"] is not None and args["profile"] <= 0:
+    parser.error("--profile must be 1 second or more")
+
 hostname = args["hostname"]
 player_name = args["player"]
 mode = args["mode"]
-
-sesh = requests.Session()
-retries = Retry(total=10, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-sesh.mount("https://", HTTPAdapter(pool_connections=80, pool_maxsize=80, max_retries=0, pool_block=False))
+decoder = args["decoder"]
+engine = args["engine"]
 
 # Open config file for read
 config = configparser.ConfigParser()
@@ -57,31 +77,330 @@ splunk_hec_token = config.get("ingest_settings", "splunk_hec_token")
 # SIM variables
 sim_token = config.get("ingest_settings", "sim_token")
 sim_endpoint = config.get("ingest_settings", "ingest_endpoint")
+# HEC batching variables
+hec_batch_max_bytes = config.getint("hec_settings", "batch_max_bytes", fallback=524288)
+hec_batch_max_latency_ms = config.getint("hec_settings", "batch_max_latency_ms", fallback=250)
+hec_queue_size = config.getint("hec_settings", "queue_size", fallback=20000)
+hec_backpressure = config.get("hec_settings", "backpressure", fallback="drop-oldest")
+hec_flush_workers = config.getint("hec_settings", "flush_workers", fallback=4)
+# HEC transport variables, gzip_level 0 sends uncompressed and an empty spool_dir disables the spool
+hec_gzip_level = config.getint("hec_settings", "gzip_level", fallback=1)
+hec_max_retries = config.getint("hec_settings", "max_retries", fallback=5)
+hec_retry_backoff_ms = config.getint("hec_settings", "retry_backoff_ms", fallback=250)
+hec_retry_backoff_max_ms = config.getint("hec_settings", "retry_backoff_max_ms", fallback=10000)
+hec_timeout = config.getfloat("hec_settings", "timeout", fallback=10)
+hec_spool_dir = config.get("hec_settings", "spool_dir", fallback="hec_spool")
+hec_spool_max_bytes = config.getint("hec_settings", "spool_max_mb", fallback=256) * 1024 * 1024
+# event puts each row in the HEC event body, fields sends it as HEC indexed fields
+hec_event_format = config.get("hec_settings", "event_format", fallback="event")
+if hec_event_format not in ("event", "fields"):
+    raise ValueError("hec_settings event_format must be event or fields, not " + hec_event_format)
+# Pipeline variables
+decode_workers = config.getint("pipeline_settings", "decode_workers", fallback=2)
+hec_workers = config.getint("pipeline_settings", "hec_workers", fallback=2)
+o11y_workers = config.getint("pipeline_settings", "o11y_workers", fallback=4)
+stage_queue_size = config.getint("pipeline_settings", "queue_size", fallback=2000)
+stats_interval = config.getint("pipeline_settings", "stats_interval", fallback=30)
+analytics_workers = config.getint("pipeline_settings", "analytics_workers", fallback=1)
+# UDP receive variables, the kernel buffer of each rig socket (0 keeps the OS default) and the datagrams read per wakeup
+receive_buffer_kb = config.getint("pipeline_settings", "receive_buffer_kb", fallback=4096)
+receive_batch_size = config.getint("pipeline_settings", "receive_batch", fallback=64)
+# Lap analytics variables, summaries are sent to Splunk HEC
+analytics = config.getboolean("analytics_settings", "enabled", fallback=True)
+analytics_histogram_bins = config.getint("analytics_settings", "histogram_bins", fallback=10)
+# O11y sink variables
+o11y_window_ms = config.getint("o11y_settings", "window_ms", fallback=200)
+o11y_max_datapoints = config.getint("o11y_settings", "max_datapoints", fallback=1000)
+o11y_aggregate = config.get("o11y_settings", "aggregate", fallback="none")
+o11y_aggregate_metrics = [
+    metric.strip()
+    for metric in config.get("o11y_settings", "aggregate_metrics", fallback="engine_rpm, speed, throttle").split(",")
+    if metric.strip()
+]
+o11y_timeout = config.getfloat("o11y_settings", "timeout", fallback=5)
+# Change detection variables, a [hec_deltas] or [o11y_deltas] section turns it on for that sink
+hec_deltas, hec_delta_heartbeat_ms = delta_settings(config, "hec_deltas")
+o11y_deltas, o11y_delta_heartbeat_ms = delta_settings(config, "o11y_deltas")
+# Session archive variables
+archive_dir = config.get("archive_settings", "directory", fallback="archive")
+archive_format = config.get("archive_settings", "format", fallback="parquet")
+if archive_format not in ("parquet", "arrow"):
+    raise ValueError("archive_settings format must be parquet or arrow, not " + archive_format)
+archive_row_group_rows = config.getint("archive_settings", "row_group_rows", fallback=20000)
+archive_compression = config.get("archive_settings", "compression", fallback="zstd")
+archive_queue_size = config.getint("archive_settings", "queue_size", fallback=2000)
+# Self metrics variables, 0 turns off the export or the stats endpoint
+metrics_interval = config.getint("metrics_settings", "interval", fallback=10)
+stats_port = config.getint("metrics_settings", "stats_port", fallback=8099)
+# Runtime control variables, how often settings.ini is checked for changes (0 to disable)
+config_watch_interval = config.getint("control_settings", "watch_interval", fallback=2)
+# Load shedding variables, a sink queue more than queue_high full or a POST slower than latency_high_ms raises
+# the level, which drops back one step every hold_s once the sinks are below half of that
+shed_enabled = config.getboolean("shedding_settings", "enabled", fallback=True)
+shed_check_interval_ms = config.getint("shedding_settings", "check_interval_ms", fallback=500)
+shed_queue_high = config.getfloat("shedding_settings", "queue_high", fallback=0.5)
+shed_latency_high_ms = config.getint("shedding_settings", "latency_high_ms", fallback=2000)
+shed_hold_s = config.getint("shedding_settings", "hold_s", fallback=5)
+shed_thin_factor = config.getint("shedding_settings", "thin_factor", fallback=4)
+shed_top_cars = config.getint("shedding_settings", "top_cars", fallback=10)
+if shed_thin_factor < 1:
+    raise ValueError("shedding_settings thin_factor must be 1 or more, not " + str(shed_thin_factor))
+# Sampling profiler variables, the window is used when profiling is started by SIGUSR1
+profile_interval_ms = config.getint("metrics_settings", "profile_interval_ms", fallback=10)
+profile_window_s = config.getint("metrics_settings", "profile_window_s", fallback=30)
+profile_dir = config.get("metrics_settings", "profile_dir", fallback="profiles")
+# worker processes for --rigs, 0 is one per core
+rig_processes = config.getint("pipeline_settings", "rig_processes", fallback=0) or os.cpu_count()
+# asyncio engine variables
+hec_max_in_flight = config.getint("asyncio_settings", "hec_max_in_flight", fallback=4)
+o11y_max_in_flight = config.getint("asyncio_settings", "o11y_max_in_flight", fallback=4)
+o11y_batch_max_datapoints = config.getint("asyncio_settings", "o11y_batch_max_datapoints", fallback=1000)
+o11y_batch_max_latency_ms = config.getint("asyncio_settings", "o11y_batch_max_latency_ms", fallback=200)
 # Telemetry varilables     
 motion = config.getboolean("telemetry_settings", "motion")
 telemetry = config.getboolean("telemetry_settings", "telemetry")
 lap = config.getboolean("telemetry_settings","lap")
 status = config.getboolean("telemetry_settings","status")
+damage = config.getboolean("telemetry_settings", "damage", fallback=True)
+history = config.getboolean("telemetry_settings", "history", fallback=True)
+
+
+#########################################
+# Early UDP bind
+# The rig ports are bound before the rest of the script is imported and before any sink is
+# connected, so the kernel buffers what the game sends from the first moment. A rig restarted
+# mid-session keeps the Participants and Session packets that arrive while the script starts up,
+# they are read as soon as the receive loops run. Replays and benchmarks do not listen
+
+# sockets bound at startup by port, taken by rig_socket when the rig starts receiving
+bound_sockets = {}
+
+
+def bind_udp(port):
+    sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    sock.bind(("localhost", port))
+    if receive_buffer_kb > 0:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_kb * 1024)
+        except OSError:
+            # reported by tune_receive_socket
+            pass
+    return sock
+
+
+# The socket bound at startup for the port, or a new one
+def rig_socket(port):
+    return bound_sockets.pop(port, None) or bind_udp(port)
+
+
+if not (args["replay"] or args["benchmark"] or args["benchmark_decoder"]):
+    for port in [int(value.split(",")[0]) for _, value in config.items("rigs")] if args["rigs"] else [args["port"]]:
+        bound_sockets[port] = bind_udp(port)
+bound_ms = (time.perf_counter() - startup_started) * 1000
+
+
+#########################################
+# Imports
+# Everything else is imported once the ports are bound. The sink clients and the optional modules
+# are only imported when the sink, decoder, engine or archive that needs them is turned on, and
+# every import through load_module is timed for the startup report
+
+import json
+import threading
+import collections
+import struct
+import operator
+import queue
+import itertools
+import asyncio
+import multiprocessing
+import sys
+import signal
+import gzip
+import http.server
+import tracemalloc
+from datetime import datetime
+from f1_22_telemetry.packets import PacketHeader, HEADER_FIELD_TO_PACKET_TYPE
+from f1_ingest.metrics import metrics, percentile, recent_post_ms
+from f1_ingest import decoders
+from f1_ingest.decoders import unpack_packet, decode_packet, packet_tables, column_layout, car_range, lookup_packet_id
+from f1_ingest.deltas import DeltaFilter
+from f1_ingest.receive import PacketLoss, packet_header_size
+from f1_ingest.control import config_toggles, config_deltas, validate_config, file_config, changed_settings
+from f1_ingest import sinks
+from f1_ingest.sinks import HecTransport, HecSender, O11ySink
+
+metrics.hostname = hostname
+
+# milliseconds spent importing each module loaded through load_module
+import_ms = {}
 
-client = signalfx.SignalFx(ingest_endpoint=sim_endpoint)
-ingest = client.ingest(sim_token)
+
+def load_module(name, optional=False):
+    started = time.perf_counter()
+    try:
+        module = importlib.import_module(name)
+    except ImportError:
+        if not optional:
+            raise
+        module = None
+    import_ms[name] = (time.perf_counter() - started) * 1000
+    return module
+
+
+numpy = load_module("numpy", optional=True) if decoder == "numpy" else None
+aiohttp = load_module("aiohttp", optional=True) if engine == "asyncio" else None
+orjson = load_module("orjson", optional=True)
+pyarrow = load_module("pyarrow", optional=True) if args["archive"] == "yes" else None
+if pyarrow is not None:
+    load_module("pyarrow.ipc")
+    load_module("pyarrow.parquet")
+
+if decoder == "numpy" and numpy is None:
+    parser.error("--decoder numpy requires numpy, pip3 install numpy")
+if numpy is not None:
+    decoders.use_numpy(numpy)
+if engine == "asyncio" and aiohttp is None:
+    parser.error("--engine asyncio requires aiohttp, pip3 install aiohttp")
+if args["archive"] == "yes" and pyarrow is None:
+    parser.error("--archive yes requires pyarrow, pip3 install pyarrow")
+
+# Splunk HEC client, retries are done by HecTransport, so that a batch can go to the spool once they run out
+requests = None
+sesh = None
+if args["splunk"] == "yes" or args["benchmark"]:
+    requests = load_module("requests")
+    load_module("urllib3").disable_warnings()
+    sesh = requests.Session()
+    sesh.mount("https://", requests.adapters.HTTPAdapter(pool_connections=80, pool_maxsize=80, max_retries=0, pool_block=False))
+    sesh.mount("http://", requests.adapters.HTTPAdapter(pool_connections=80, pool_maxsize=80, max_retries=0, pool_block=False))
+sinks.use_http(requests, aiohttp)
+
+# SignalFx client, the asyncio engine posts to SignalFx itself. SignalFx.ingest() always posts
+# 300 datapoints at a time, the client is built here so one O11y sink window goes in one request
+def signalfx_ingest(endpoint, token):
+    clients = load_module("signalfx.ingest")
+    client = clients.ProtoBufSignalFxIngestClient if clients.sf_pbuf else clients.JsonSignalFxIngestClient
+    return counted_ingest_client(client)(token, endpoint=endpoint, timeout=o11y_timeout, batch_size=o11y_max_datapoints)
+
+
+# The signalfx client counting its own POSTs: response codes in o11y.responses, every failed
+# attempt as "error", the POST times, and the datapoints not posted yet. The client opens a new
+# requests session and tries once more after a connection error, so the response hook goes on
+# every session it opens. A send() after stop() would start a second send thread that stop()
+# then waits on for ever, so late datapoints, the self metrics at shutdown, are dropped
+def counted_ingest_client(client):
+    class CountedIngestClient(client):
+        def __init__(self, token, **kwargs):
+            self.sessions = 0
+            self.stopped = False
+            self.batch_size = kwargs["batch_size"]
+            # datapoints handed to send() and not posted yet, and how many the POST going out carries
+            self.pending = 0
+            self.posting = 0
+            self.pending_lock = threading.Lock()
+            self.room = threading.Condition(self.pending_lock)
+            # (finished, seconds) of the last few POSTs, see recent_post_ms
+            self.recent_posts = collections.deque(maxlen=16)
+            super().__init__(token, **kwargs)
+
+        def send(self, cumulative_counters=None, gauges=None, counters=None):
+            with self.pending_lock:
+                if self.stopped:
+                    return
+                self.pending += sum(len(datapoints or ()) for datapoints in (cumulative_counters, gauges, counters))
+                super().send(cumulative_counters=cumulative_counters, gauges=gauges, counters=counters)
+
+        def stop(self, msg="Thread stopped"):
+            with self.pending_lock:
+                self.stopped = True
+            super().stop(msg)
+
+        def _batch_data(self, datapoints_list):
+            self.posting = len(datapoints_list)
+            return super()._batch_data(datapoints_list)
+
+        def _reconnect(self):
+            if self.sessions:
+                metrics.incr("o11y.responses", status="error")
+            self.sessions += 1
+            super()._reconnect()
+            self._session.hooks["response"].append(self.count_response)
+
+        def count_response(self, response, *args, **kwargs):
+            metrics.incr("o11y.responses", status=response.status_code)
+
+        def _post(self, data, url, session=None, timeout=None):
+            started = time.perf_counter()
+            try:
+                super()._post(data, url, session, timeout)
+            except Exception:
+                metrics.incr("o11y.responses", status="error")
+                raise
+            finally:
+                metrics.observe("o11y.post", time.perf_counter() - started)
+                self.recent_posts.append((time.monotonic(), time.perf_counter() - started))
+                with self.pending_lock:
+                    self.pending -= self.posting
+                    self.posting = 0
+                    self.room.notify_all()
+
+        # For load shedding, as a fraction of ten batches like the asyncio engine queues
+        def backlog(self):
+            return self.pending / (self.batch_size * 10)
+
+        # Waits until fewer than ten batches are waiting, for the unthrottled replay
+        def wait_for_room(self):
+            with self.room:
+                while self.pending >= self.batch_size * 10:
+                    self.room.wait()
+
+        def recent_post_ms(self, window_s):
+            return recent_post_ms(self.recent_posts, window_s)
+
+    return CountedIngestClient
+
+
+signalfx = None
+ingest = None
+if (args["o11y"] == "yes" and engine == "threads") or args["benchmark"]:
+    signalfx = load_module("signalfx")
+    ingest = signalfx_ingest(sim_endpoint, sim_token)
 
 print("Hostname: " + args["hostname"])
 print("Player Name: " + args["player"])
 print("UDP Port: " + str(args["port"]))
 print("Splunk O11y Cloud Data: " + args["o11y"])
 print("Splunk Enterprise/Cloud Data: " +args["splunk"])
+print("Session archive: " + (archive_format + " files in " + archive_dir if args["archive"] == "yes" else "no"))
 print("Solo or Spectator: " + args["mode"])
+print("Packet decoder: " + args["decoder"])
+print("Ingest engine: " + args["engine"])
 print("Debug: " + str(debug))
 print("Splunk HEC Endpoint: " + splunk_hec_ip)
+print("Splunk HEC Batching: " + str(hec_batch_max_bytes) + " bytes / " + str(hec_batch_max_latency_ms) + " ms, " + hec_backpressure)
+print("Splunk HEC Transport: " + str(hec_flush_workers) + " flush workers, gzip level " + str(hec_gzip_level) + ", " + str(hec_max_retries) + " retries, spool " + (hec_spool_dir or "off"))
+print("Splunk HEC Event Format: " + hec_event_format + ", JSON encoder " + ("orjson" if orjson is not None else "json"))
 print("Splunk O11y Cloud Ingest Endpoint: " + sim_endpoint)
+print("Splunk O11y Batching: " + str(o11y_max_datapoints) + " datapoints / " + str(o11y_window_ms) + " ms, aggregate " + o11y_aggregate)
+print("Change detection: HEC " + (str(len(hec_deltas)) + " fields / heartbeat " + str(hec_delta_heartbeat_ms) + " ms" if hec_deltas else "off")
+      + ", O11y " + (str(len(o11y_deltas)) + " fields / heartbeat " + str(o11y_delta_heartbeat_ms) + " ms" if o11y_deltas else "off"))
+print("Pipeline workers: decode " + str(decode_workers) + ", HEC " + str(hec_workers) + ", O11y " + str(o11y_workers))
 print("Car telemetry enabled: " + str(telemetry))
 print("Car motion enabled: " + str(motion))
 print("Car lap enabled: " + str(lap))
 print("Car status enabled: " + str(status))
+print("Car damage enabled: " + str(damage))
+print("Session history enabled: " + str(history))
+print("Lap analytics enabled: " + str(analytics))
+print("Load shedding: " + ("1 in " + str(shed_thin_factor) + " motion and telemetry packets, then the top " + str(shed_top_cars)
+                           + " spectator cars, above " + str(int(shed_queue_high * 100)) + "% queued or " + str(shed_latency_high_ms) + " ms posts"
+                           if shed_enabled else "off"))
 
 #########################################
-# Set up global variables and data stores
+# Set up per rig data stores
+# Everything learnt from one simulator's packets lives on its Rig, so several rigs
+# can be ingested by one process without corrupting each other's state
 
 player_dict = {
     "ai_controlled": 1,
@@ -93,19 +412,178 @@ player_dict = {
     "your_telemetry": 1
 }
 
-player_info = [player_dict]
 
-lap_info = []
+# Cars the game sends data for, every per car array in a packet has this many slots
+car_slots = 22
+
+# Participant used for cars that have not been announced in a Participants packet yet
+no_participant = {"name": ""}
+
+
+# What one rig's session looks like, one fixed slot per car. Participants, Lap and Session
+# packets are decoded by different workers, so every update and every read that needs more
+# than one slot to agree holds the lock. Slots are replaced in place and never reallocated
+class SessionState:
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # Session packet: the session being ingested
+        self.session_uid = None
+
+        # Participants packet: the participant of each car slot. --decoder numpy also keeps the
+        # participant value tuples, which slots have a name and the keys of the tuples
+        self.participants = [no_participant] * car_slots
+        self.participant_keys = None
+        self.participant_values = [()] * car_slots
+        self.participant_named = numpy.zeros(car_slots, dtype=bool) if numpy is not None else None
+
+        # Lap packet: lap and sector of each car and the lap event being announced for it
+        self.current_lap = [1] * car_slots
+        self.current_sector = [0] * car_slots
+        self.lap_event = ["none"] * car_slots
+        self.lap_event_count = [0] * car_slots
+        # race position of each car, 0 until its first Lap packet
+        self.car_position = [0] * car_slots
+
+        # SessionHistory packet: completed laps of each car already sent
+        self.history_laps = [0] * car_slots
+
+        # --decoder numpy: columnar counterpart of the lap slots
+        if numpy is not None:
+            self.lap_columns = {
+                "current_lap": numpy.ones(car_slots, dtype=numpy.int64),
+                "current_sector": numpy.zeros(car_slots, dtype=numpy.int64),
+                "lap_event": numpy.zeros(car_slots, dtype=numpy.int64),
+                "lap_event_count": numpy.zeros(car_slots, dtype=numpy.int64),
+            }
+
+    # Only the slots whose participant changed are replaced
+    def update_participants(self, participants):
+        with self.lock:
+            for car_index, participant in enumerate(participants[:car_slots]):
+                if participant != self.participants[car_index]:
+                    self.participants[car_index] = participant
+
+    def update_participant_columns(self, cars):
+        layout = column_layout(cars.dtype)
+        name = layout.keys.index("name")
+        values = layout.values(cars, car_range(min(len(cars), car_slots)))
+
+        with self.lock:
+            self.participant_keys = layout.keys
+            for car_index, car_values in enumerate(values):
+                if car_values != self.participant_values[car_index]:
+                    self.participant_values[car_index] = car_values
+                    self.participant_named[car_index] = car_values[name] != ""
+                    self.participants[car_index] = dict(zip(layout.keys, car_values))
+
+    # A new session_uid starts every car on lap 1 again
+    def update_session(self, session_uid):
+        with self.lock:
+            if session_uid != self.session_uid:
+                if self.session_uid is not None:
+                    self.reset_laps()
+                self.session_uid = session_uid
+
+    # First lap of a car's history not sent yet, everything up to completed is sent from now on
+    def history_sent(self, car_index, completed):
+        with self.lock:
+            start = self.history_laps[car_index]
+            if completed > start:
+                self.history_laps[car_index] = completed
+            return start
+
+    def reset_laps(self):
+        for car_index in range(car_slots):
+            self.history_laps[car_index] = 0
+            self.current_lap[car_index] = 1
+            self.current_sector[car_index] = 0
+            self.lap_event[car_index] = "none"
+            self.lap_event_count[car_index] = 0
+            self.car_position[car_index] = 0
+
+        if numpy is not None:
+            for name, column in self.lap_columns.items():
+                column[:] = 1 if name == "current_lap" else 0
+
+
+class Rig:
+    def __init__(self, hostname, player_name, port, mode):
+        self.hostname = hostname
+        self.player_name = player_name
+        self.port = port
+        self.mode = mode
+        self.packets_received = 0
+        self.packets_by_id = [0] * 16
+        # packets the decode stage had no room for
+        self.dropped_by_id = [0] * 16
+        # packets dropped before decoding by wanted_packet, shed packets included
+        self.filtered = 0
+        # load shedding: packets seen and shed by packet id, and spectator car rows shed
+        self.thin_count = [0] * 16
+        self.shed_by_id = [0] * 16
+        self.cars_shed = 0
+        # packets the game sent that never arrived, see PacketLoss
+        self.loss = PacketLoss()
+
+        # CaptureWriter when --record is given
+        self.recorder = None
+
+        # pre-rendered HEC envelopes by packet id and event format
+        self.hec_envelopes = {}
+
+        # last values sent to each sink, None when change detection is off for it
+        self.hec_deltas = delta_filter(hec_deltas, hec_delta_heartbeat_ms)
+        self.o11y_deltas = delta_filter(o11y_deltas, o11y_delta_heartbeat_ms)
+
+        # participants, laps and session, see SessionState
+        self.session = SessionState()
+
+        # per sector and per lap rollups of every car, see LapAnalytics
+        self.analytics = LapAnalytics(analytics_histogram_bins)
+
+
+    def received(self, packet):
+        self.packets_received += 1
+        self.packets_by_id[packet[5] & 15] += 1
+        self.loss.check(packet)
+
+    def register_metrics(self):
+        for packet_id in range(12):
+            metrics.gauge(
+                "packets_received", lambda packet_id=packet_id: self.packets_by_id[packet_id], rig=self.hostname, packet_id=packet_id
+            )
+            metrics.gauge(
+                "packets_lost", lambda packet_id=packet_id: self.loss.lost[packet_id], rig=self.hostname, packet_id=packet_id
+            )
+            metrics.gauge(
+                "packets_late", lambda packet_id=packet_id: self.loss.late[packet_id], rig=self.hostname, packet_id=packet_id
+            )
+            metrics.gauge(
+                "packets_dropped", lambda packet_id=packet_id: self.dropped_by_id[packet_id], rig=self.hostname, packet_id=packet_id
+            )
+        for packet_id in shed_thinned_packets:
+            metrics.gauge(
+                "shed.packets", lambda packet_id=packet_id: self.shed_by_id[packet_id], rig=self.hostname, packet_id=packet_id
+            )
+        metrics.gauge("shed.cars", lambda: self.cars_shed, rig=self.hostname)
+
+
+# Rigs to ingest: the command line rig, or every "hostname = port, player[, mode]" line in [rigs] with --rigs
+def configured_rigs():
+    if not args["rigs"]:
+        return [Rig(hostname, player_name, args["port"], mode)]
+
+    rigs = []
+    for rig_hostname, value in config.items("rigs"):
+        fields = [field.strip() for field in value.split(",")]
+        rig_mode = fields[2] if len(fields) > 2 else mode
+        if rig_mode not in ("spectator", "solo"):
+            raise ValueError("rig " + rig_hostname + " mode must be spectator or solo, not " + rig_mode)
+        rigs.append(Rig(rig_hostname, fields[1], int(fields[0]), rig_mode))
+
+    return rigs
 
-for i in range(1, 21):
-    lap_info = lap_info + [
-        {
-            "current_sector": 0,
-            "current_lap": 1,
-            "lap_event": "none",
-            "lap_event_count": 0
-        }
-    ]
 
 #########################################
 # Set up lists of SIM Metrics and Dimensions
@@ -137,7 +615,11 @@ sim_metrics = [
     "tyres_surface_temperature1",
     "tyres_surface_temperature2",
     "tyres_surface_temperature3",
-    "tyres_surface_temperature4"
+    "tyres_surface_temperature4",
+    "tyres_wear1",
+    "tyres_wear2",
+    "tyres_wear3",
+    "tyres_wear4"
 ]
 
 sim_dimensions = [
@@ -146,456 +628,2846 @@ sim_dimensions = [
 ]
 
 
-def lookup_packet_id(packet_id):
-    dict = {
-        0: "MotionData",
-        1: "SessionData",
-        2: "LapData",
-        3: "EventData",
-        4: "ParticipantsData",
-        5: "CarSetupData",
-        6: "CarTelemetryData",
-        7: "CarStatusData",
-        8: "FinalClassificationData",
-        9: "LobbyInfoData",
-        10: "CarDamageData",
-        11: "SessionHistoryData",
-        99: "ScriptStartup",
+def send_dims_and_metrics(rig, f1_json, packet_id):
+    dimensions = [{key: car_dict[key] for key in sim_dimensions if key in car_dict} for car_dict in f1_json]
+
+    metrics = [{key: car_dict[key] for key in sim_metrics if key in car_dict} for car_dict in f1_json]
+
+    send_metric_pairs(rig, zip(metrics, dimensions), packet_id)
+
+
+def send_metric_pairs(rig, pairs, packet_id):
+    if rig.o11y_deltas is not None:
+        pairs = rig.o11y_deltas.filter_pairs(packet_id, pairs)
+    o11y_sink.add(rig, pairs)
+
+
+# Hands a batch to the signalfx ingest client, or whatever stands in for it
+def send_gauges(gauges):
+    ingest.send(gauges=gauges)
+
+
+# Unthrottled replay waits for the client to post instead of queueing datapoints without bound
+def send_gauges_waiting(gauges):
+    ingest.wait_for_room()
+    ingest.send(gauges=gauges)
+
+
+#########################################
+# O11y sink
+# Gauges are batched by O11ySink in f1_ingest/sinks.py and handed to send_gauges, or the
+# asyncio engine's own SignalFx sender
+o11y_sink = None
+
+
+def open_o11y_sink(emit=send_gauges, block=False):
+    global o11y_sink
+
+    if args["o11y"] == "yes":
+        o11y_sink = O11ySink(o11y_window_ms, o11y_max_datapoints, o11y_aggregate, o11y_aggregate_metrics, emit, block)
+
+
+def close_o11y_sink():
+    if o11y_sink is not None:
+        o11y_sink.close()
+        print("O11y sink: " + str(o11y_sink.stats()))
+
+
+#########################################
+# Session archive
+# With --archive yes the merged rows of every packet type are also written to local columnar
+# files for post-race analysis, <directory>/session_uid=<uid>/<PacketType>-<hostname>.parquet
+# (or .arrow for Arrow IPC). The decode workers only queue the rows; a writer thread collects
+# row_group_rows rows per file and writes them as one row group, and closes the files of a
+# session when its rig moves on to a new session_uid or the script stops. When the queue is
+# full rows are dropped and counted rather than holding up decoding. Parquet and Arrow files are
+# only readable once closed, so a killed script leaves its current files incomplete
+
+class ArchiveFile:
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+        self.schema = None
+        self.writer = None
+
+
+# Arrow schema from the first row group of a file: every key seen, in order. session_uid is
+# a uint64 and does not fit the int64 pyarrow infers, columns that are only None are left out
+def archive_schema(rows):
+    keys = {}
+    for row in rows:
+        for key in row:
+            keys[key] = None
+
+    fields = []
+    for key in keys:
+        if key == "session_uid":
+            fields.append(pyarrow.field(key, pyarrow.uint64()))
+            continue
+        column_type = pyarrow.array([row.get(key) for row in rows]).type
+        if column_type != pyarrow.null():
+            fields.append(pyarrow.field(key, column_type))
+    return pyarrow.schema(fields)
+
+
+class SessionArchive:
+    def __init__(self, directory, file_format, row_group_rows, compression, queue_size, block=False):
+        self.directory = directory
+        self.file_format = file_format
+        self.row_group_rows = row_group_rows
+        self.compression = compression
+        self.queue = queue.Queue(maxsize=queue_size)
+        # wait for room in the queue instead of dropping, for unthrottled replay
+        self.block = block
+
+        # (hostname, session_uid, packet_id) -> ArchiveFile, and the current session of each rig
+        self.files = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+        # counters
+        self.rows = 0
+        self.dropped = 0
+        self.errors = 0
+        self.row_groups = 0
+        self.closed_files = 0
+        metrics.gauge("archive.queue_depth", self.queue.qsize)
+
+        self.worker = threading.Thread(target=self.write_loop, name="archive", daemon=True)
+        self.worker.start()
+
+    # Rows are a list of dicts, or CarColumns whose rows are built on the writer thread
+    def add(self, rig, packet_id, rows):
+        try:
+            self.queue.put((rig.hostname, packet_id, rows), block=self.block)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            metrics.incr("archive.dropped", rig=rig.hostname)
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.append(*item)
+            except Exception as e:
+                print("archive error: " + str(e))
+                with self.lock:
+                    self.errors += 1
+
+        for archive_file in self.files.values():
+            self.close_file(archive_file)
+        self.files.clear()
+
+    def append(self, hostname, packet_id, rows):
+        if not isinstance(rows, list):
+            rows = rows.rows()
+        if not rows:
+            return
+
+        session_uid = rows[0].get("session_uid", 0)
+        if self.sessions.get(hostname) != session_uid:
+            # the rig moved on, the files of its last session are complete
+            for key in [key for key in self.files if key[0] == hostname]:
+                self.close_file(self.files.pop(key))
+            self.sessions[hostname] = session_uid
+
+        key = (hostname, session_uid, packet_id)
+        archive_file = self.files.get(key)
+        if archive_file is None:
+            archive_file = self.files[key] = ArchiveFile(self.path(hostname, session_uid, packet_id))
+        archive_file.rows.extend(rows)
+        with self.lock:
+            self.rows += len(rows)
+
+        if len(archive_file.rows) >= self.row_group_rows:
+            self.write_group(archive_file)
+
+    # A file that already exists, from an earlier run of the same session, is kept and the new one numbered
+    def path(self, hostname, session_uid, packet_id):
+        directory = os.path.join(self.directory, "session_uid=" + str(session_uid))
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, lookup_packet_id(packet_id) + "-" + hostname)
+        extension = "." + self.file_format
+        path = stem + extension
+        for part in itertools.count(1):
+            if not os.path.exists(path):
+                return path
+            path = stem + "-" + str(part) + extension
+
+    def write_group(self, archive_file):
+        rows, archive_file.rows = archive_file.rows, []
+        if archive_file.schema is None:
+            archive_file.schema = archive_schema(rows)
+        # keys the first group did not have are left out, missing ones are null
+        table = pyarrow.Table.from_pylist(rows, schema=archive_file.schema)
+
+        if archive_file.writer is None:
+            if self.file_format == "parquet":
+                archive_file.writer = pyarrow.parquet.ParquetWriter(
+                    archive_file.path, archive_file.schema, compression=self.compression
+                )
+            else:
+                options = pyarrow.ipc.IpcWriteOptions(compression=self.compression if self.compression in ("zstd", "lz4") else None)
+                archive_file.writer = pyarrow.ipc.new_file(archive_file.path, archive_file.schema, options=options)
+
+        if self.file_format == "parquet":
+            archive_file.writer.write_table(table, row_group_size=len(rows))
+        else:
+            archive_file.writer.write_table(table)
+        with self.lock:
+            self.row_groups += 1
+
+    def close_file(self, archive_file):
+        try:
+            if archive_file.rows:
+                self.write_group(archive_file)
+        except Exception as e:
+            print("archive error: " + archive_file.path + ": " + str(e))
+            with self.lock:
+                self.errors += 1
+        if archive_file.writer is not None:
+            archive_file.writer.close()
+            with self.lock:
+                self.closed_files += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rows": self.rows,
+                "row_groups": self.row_groups,
+                "files": self.closed_files,
+                "dropped": self.dropped,
+                "errors": self.errors,
+            }
+
+    # Write what is queued and buffered, and close every file
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+
+
+session_archive = None
+
+
+def open_session_archive(block=False):
+    global session_archive
+
+    if args["archive"] == "yes":
+        session_archive = SessionArchive(
+            archive_dir, archive_format, archive_row_group_rows, archive_compression, archive_queue_size, block
+        )
+
+
+def close_session_archive():
+    if session_archive is not None:
+        session_archive.close()
+        print("Session archive: " + str(session_archive.stats()))
+
+
+#########################################
+# Self metrics
+# Counters, latency histograms and sampled gauges about the forwarder itself: packets received
+# per packet id, stage run and queue wait times, queue depths, HEC and SignalFx response codes,
+# retries and drops. Every metrics_interval seconds they are sent to O11y Cloud as f1_2022.ingest.*
+# gauges, and http://127.0.0.1:<stats_port>/stats serves the same numbers as JSON. The registry
+# itself is in f1_ingest/metrics.py, shared with the sinks
+
+def export_metrics(emit):
+    while True:
+        time.sleep(metrics_interval)
+        try:
+            emit(metrics.datapoints())
+        except Exception as e:
+            print("metrics export error: " + str(e))
+
+
+def start_metrics_export(emit=send_gauges):
+    if args["o11y"] == "yes" and metrics_interval > 0:
+        threading.Thread(target=export_metrics, args=(emit,), name="metrics-export", daemon=True).start()
+        print("Self metrics: every " + str(metrics_interval) + "s as f1_2022.ingest.*, process " + metrics.process)
+
+
+# GET /stats for the self metrics, GET /config and POST /config for the runtime control
+class StatsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path in ("", "/stats"):
+            self.reply(200, stats_snapshot())
+        elif path == "/config":
+            self.reply(200, effective_config())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/config":
+            self.send_error(404)
+            return
+
+        try:
+            changes = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not isinstance(changes, dict):
+                raise ValueError("expected a JSON object")
+            apply_config(changes, "control endpoint")
+        except ValueError as e:
+            self.reply(400, {"error": str(e)})
+            return
+        self.reply(200, effective_config())
+
+    def reply(self, status, content):
+        body = json.dumps(content, indent=2).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# The self metrics of this process, and with --rigs those last reported by the worker processes, with an
+# ingest-process dimension like the exported gauges
+def stats_snapshot():
+    snapshot = metrics.snapshot()
+    if not worker_stats:
+        return snapshot
+
+    snapshots = [snapshot] + [worker_stats[process_name] for process_name in sorted(worker_stats)]
+    merged = {"process": snapshot["process"], "processes": [process_snapshot["process"] for process_snapshot in snapshots]}
+    for kind in ("counters", "histograms", "gauges"):
+        merged[kind] = [
+            dict(entry, dimensions=dict(entry["dimensions"], **{"ingest-process": process_snapshot["process"]}))
+            for process_snapshot in snapshots
+            for entry in process_snapshot[kind]
+        ]
+    return merged
+
+
+def start_stats_server():
+    if stats_port <= 0:
+        return
+    try:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", stats_port), StatsHandler)
+    except OSError as e:
+        print("Stats endpoint not started on port " + str(stats_port) + ": " + str(e))
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stats-endpoint", daemon=True).start()
+    print("Stats endpoint: http://127.0.0.1:" + str(stats_port) + "/stats")
+
+
+# How long the ports took to bind and the script took to start receiving, and the slowest imports
+def report_startup():
+    ready_ms = (time.perf_counter() - startup_started) * 1000
+    metrics.gauge("startup.bound_ms", lambda: round(bound_ms, 1))
+    metrics.gauge("startup.ready_ms", lambda: round(ready_ms, 1))
+
+    imports = sorted(import_ms.items(), key=lambda item: item[1], reverse=True)
+    print("Startup: UDP bound after {:.0f} ms, receiving after {:.0f} ms, imports {}".format(
+        bound_ms, ready_ms, ", ".join("{} {:.0f} ms".format(name, ms) for name, ms in imports) or "none"))
+
+
+# Datapoints the SignalFx client has not posted yet, 0 where there is no client to ask
+def o11y_backlog():
+    if hasattr(ingest, "backlog"):
+        return ingest.backlog()
+    return 0.0
+
+
+def o11y_recent_post_ms():
+    if hasattr(ingest, "recent_post_ms"):
+        return ingest.recent_post_ms(shed_hold_s)
+    return 0.0
+
+
+#########################################
+# Sampling profiler
+# For a window of seconds a background thread takes the stack of every other thread every
+# interval_ms with sys._current_frames(), so the ingest keeps running while it is profiled. Time
+# is wall clock: a sender blocked in sesh.post or an idle worker waiting on its queue is sampled
+# where it waits. At the end of the window two files are written to profile_dir:
+# <name>.folded, one "thread;outer;...;inner count" line per distinct stack for flamegraph.pl or
+# speedscope, and <name>.txt, the samples per thread and per function, self and inclusive
+class SamplingProfiler:
+    def __init__(self, interval_ms, directory):
+        self.interval = interval_ms / 1000.0
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.running = False
+        self.labels = {}
+
+    # Start a window, unless one is already running
+    def start(self, seconds):
+        with self.lock:
+            if self.running:
+                print("Profiler already running")
+                return False
+            self.running = True
+        threading.Thread(target=self.sample_loop, args=(seconds,), name="profiler", daemon=True).start()
+        print("Profiling for " + str(seconds) + "s every " + str(int(self.interval * 1000)) + " ms")
+        return True
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+        return label
+
+    def sample_loop(self, seconds):
+        own = threading.get_ident()
+        stacks = collections.Counter()
+        samples = 0
+        started = time.monotonic()
+        deadline = started + seconds
+        try:
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self.label(frame.f_code))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, "thread-" + str(ident)))
+                    stacks[tuple(reversed(stack))] += 1
+                samples += 1
+                time.sleep(self.interval)
+            self.write(stacks, samples, time.monotonic() - started)
+        except Exception as e:
+            print("Profiler error: " + str(e))
+        finally:
+            with self.lock:
+                self.running = False
+
+    def write(self, stacks, samples, elapsed):
+        os.makedirs(self.directory, exist_ok=True)
+        name = "profile-" + metrics.process + "-" + datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.directory, name)
+
+        with open(path + ".folded", "w") as folded:
+            for stack, count in stacks.most_common():
+                folded.write(";".join(stack) + " " + str(count) + "\n")
+
+        threads = collections.Counter()
+        own = collections.Counter()
+        inclusive = collections.Counter()
+        for stack, count in stacks.items():
+            threads[stack[0]] += count
+            if len(stack) > 1:
+                own[stack[-1]] += count
+            # recursive functions are counted once per stack
+            for function in set(stack[1:]):
+                inclusive[function] += count
+        total = sum(stacks.values()) or 1
+
+        with open(path + ".txt", "w") as summary:
+            summary.write("Profile of {}: {} samples of {} threads over {:.1f}s every {:.0f} ms\n\n".format(
+                metrics.process, samples, len(threads), elapsed, self.interval * 1000))
+            summary.write("{:>8}  thread\n".format("samples"))
+            for thread, count in threads.most_common():
+                summary.write("{:>8}  {}\n".format(count, thread))
+            summary.write("\n{:>7} {:>7}  function\n".format("self%", "total%"))
+            for function, count in sorted(inclusive.items(), key=lambda item: (-own[item[0]], -item[1])):
+                summary.write("{:>7.2f} {:>7.2f}  {}\n".format(100.0 * own[function] / total, 100.0 * count / total, function))
+
+        print("Profile written to " + path + ".folded and " + path + ".txt")
+
+
+profiler = SamplingProfiler(profile_interval_ms, profile_dir)
+# the rig worker processes forked by the main process with --rigs
+worker_processes = []
+
+
+# SIGUSR1 starts a profile_window_s window, and is passed on to the rig worker processes
+def profile_signal(signum, frame):
+    profiler.start(profile_window_s)
+    if metrics.process == "main":
+        for process in worker_processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGUSR1)
+
+
+def start_profiling():
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, profile_signal)
+    if args["profile"]:
+        profiler.start(args["profile"])
+
+
+#########################################
+# Runtime control
+# Settings that can change while the script runs, keeping the session state of every rig: the
+# packet toggles of [telemetry_settings], debug, the mode of each rig, pausing and resuming the
+# sinks the script was started with, the O11y window, change detection and the stats and metrics
+# intervals. settings.ini is checked every watch_interval seconds and the values that changed in
+# the file are applied. POST /config on the stats endpoint applies a JSON object of the same
+# names, GET /config reports the effective config and the load. A change is validated as a whole
+# and applied under one lock, all of it or none of it. With --rigs the main process passes control
+# changes on to the rig worker processes, which watch settings.ini themselves. The settings, their
+# validation and how settings.ini is read are in f1_ingest/control.py
+
+# Sinks that are sending, only the ones the script was started with can be resumed
+sinks_enabled = {"hec": args["splunk"] == "yes", "o11y": args["o11y"] == "yes", "archive": args["archive"] == "yes"}
+started_sinks = frozenset(sink for sink, enabled in sinks_enabled.items() if enabled)
+config_lock = threading.Lock()
+config_version = 0
+# packets/sec of each rig over the last second, by hostname
+rig_load = {}
+# the last load_report() and metrics snapshot of each rig worker process, by process name
+worker_load = {}
+worker_stats = {}
+# the queue to the parent process and the rigs it was given, in a rig worker process
+parent_queue = None
+worker_rigs = []
+# queues to the rig worker processes, filled in when they are forked
+control_queues = []
+
+
+def apply_config(changes, source):
+    global packet_wanted
+    global debug
+    global metrics_interval
+    global stats_interval
+    global o11y_window_ms
+    global config_version
+
+    if not changes:
+        return
+    with config_lock:
+        validate_config(changes, [rig.hostname for rig in rigs], started_sinks)
+
+        for key, value in changes.items():
+            if key == "debug":
+                debug = value
+            elif key in config_toggles:
+                globals()[key] = value
+                packet_enabled[packet_ids_by_toggle[key]] = value
+            elif key in sinks_enabled:
+                sinks_enabled[key] = value
+            elif key == "mode":
+                modes = value if isinstance(value, dict) else {rig.hostname: value for rig in rigs}
+                for rig in rigs:
+                    rig.mode = modes.get(rig.hostname, rig.mode)
+            elif key == "metrics_interval":
+                metrics_interval = value
+            elif key == "stats_interval":
+                stats_interval = value
+            elif key == "o11y_window_ms":
+                o11y_window_ms = value
+            elif key in config_deltas:
+                # keys are lower case, as configparser reads them from settings.ini
+                thresholds = {field.lower(): float(threshold) for field, threshold in value.items() if field != "heartbeat_ms"}
+                heartbeat_ms = value.get("heartbeat_ms", 1000) if thresholds else 0
+                globals()[key] = thresholds
+                globals()[key.replace("deltas", "delta_heartbeat_ms")] = heartbeat_ms
+                # a new filter sends every field once, then only what moves
+                for rig in rigs:
+                    setattr(rig, key, delta_filter(thresholds, heartbeat_ms))
+
+        if o11y_sink is not None:
+            with o11y_sink.lock:
+                o11y_sink.window = o11y_window_ms / 1000.0
+        packet_wanted = [
+            packet_id in packet_handlers and packet_enabled.get(packet_id, True) for packet_id in range(256)
+        ]
+        config_version += 1
+
+    print("Config from " + source + ": " + json.dumps(changes))
+    if metrics.process == "main":
+        for control_queue in control_queues:
+            control_queue.put(changes)
+
+
+# Everything that can be changed at runtime, as it is now, and the load
+def effective_config():
+    with config_lock:
+        config_now = {
+            "version": config_version,
+            "process": metrics.process,
+            "mode": {rig.hostname: rig.mode for rig in rigs},
+            "sinks": dict(sinks_enabled),
+        }
+        for key in config_toggles:
+            config_now[key] = debug if key == "debug" else packet_enabled[packet_ids_by_toggle[key]]
+        config_now.update(
+            o11y_window_ms=o11y_window_ms,
+            o11y_max_datapoints=o11y_max_datapoints,
+            metrics_interval=metrics_interval,
+            stats_interval=stats_interval,
+            hec_deltas=dict(hec_deltas, heartbeat_ms=hec_delta_heartbeat_ms) if hec_deltas else {},
+            o11y_deltas=dict(o11y_deltas, heartbeat_ms=o11y_delta_heartbeat_ms) if o11y_deltas else {},
+        )
+
+    if worker_load:
+        # with --rigs the rigs live in the worker processes, which report their load every second
+        config_now["load"] = {"rigs": {}, "queues": {}}
+        for process_name, report in sorted(worker_load.items()):
+            config_now["load"]["rigs"].update(report["rigs"])
+            config_now["load"]["queues"].update({process_name + " " + name: depth for name, depth in report["queues"].items()})
+    else:
+        config_now["load"] = load_report(rigs)
+    config_now["load"]["shed_level"] = shed_level
+    if hasattr(hec_sender, "stats"):
+        config_now["load"]["queues"]["hec sender"] = hec_sender.stats().get("queued", 0)
+    return config_now
+
+
+# Per-rig counters of the given rigs and the stage queue depths of this process
+def load_report(report_rigs):
+    return {
+        "rigs": {
+            rig.hostname: {
+                "packets_per_s": rig_load.get(rig.hostname, 0),
+                "received": rig.packets_received,
+                "filtered": rig.filtered,
+                "dropped": sum(rig.dropped_by_id),
+                "lost": sum(rig.loss.lost),
+            }
+            for rig in report_rigs
+        },
+        "queues": {stage.name: stage.stats().get("depth", 0) for stage in pipeline_stages()},
     }
-    return dict[packet_id]
 
 
-# Sends metrics to SIM
-@background.task
-def send_metric(f1_metrics, f1_dimensions):
-    telemetry_json = []
-    f1_dimensions['f1-2022-hostname'] = hostname
+def watch_config():
+    path = "settings.ini"
+    last_settings = file_config(path, args["rigs"], mode)
+    last_modified = os.path.getmtime(path)
+    last_received = {}
+    next_check = time.monotonic() + config_watch_interval
+
+    while True:
+        time.sleep(1)
+        for rig in rigs:
+            rig_load[rig.hostname] = rig.packets_received - last_received.get(rig.hostname, rig.packets_received)
+            last_received[rig.hostname] = rig.packets_received
+        if parent_queue is not None:
+            try:
+                report_to_parent(block=False)
+            except (queue.Full, ValueError):
+                # the parent is busy or the worker is shutting down, the next report will do
+                pass
+
+        if config_watch_interval <= 0 or time.monotonic() < next_check:
+            continue
+        next_check = time.monotonic() + config_watch_interval
+        try:
+            modified = os.path.getmtime(path)
+            if modified == last_modified:
+                continue
+            last_modified = modified
+            settings = file_config(path, args["rigs"], mode)
+            apply_config(changed_settings(last_settings, settings), path)
+            last_settings = settings
+        except (OSError, ValueError, configparser.Error) as e:
+            print("settings.ini not applied: " + str(e))
+
+
+def start_config_watch():
+    threading.Thread(target=watch_config, name="config-watch", daemon=True).start()
+    if metrics.process == "main":
+        print("Runtime control: settings.ini checked every " + str(config_watch_interval) + "s, GET/POST /config on the stats endpoint")
+
+
+# Changes passed on from the main process, in a rig worker process
+def receive_config(control_queue):
+    while True:
+        changes = control_queue.get()
+        if "shed_level" in changes:
+            set_shed_level(changes["shed_level"], "main process")
+            continue
+        try:
+            apply_config(changes, "main process")
+        except ValueError as e:
+            print("config not applied: " + str(e))
+
+
+#########################################
+# Load shedding
+# When HEC or O11y cannot keep up, data is given up in priority order instead of letting the
+# queues fill and the dashboards fall behind. Every check_interval_ms the fullest sink queue and
+# the slowest recent POST are compared with queue_high and latency_high_ms. Level 1 keeps one in
+# thin_factor motion and telemetry packets, level 2 also drops spectator cars below the top_cars
+# race positions from the per car packets. Lap, Event and FinalClassification packets are never
+# shed, so lap completion, events and results always get through. The level goes up one step at a
+# time, at most every hold_s, and comes back down once the sinks have stayed below half of the
+# limits for hold_s. With --rigs the main process owns the sinks and passes the level on
+
+shed_levels = ("normal", "thin motion and telemetry", "thin and top cars only")
+shed_level = 0
+# packet ids thinned at level 1, by the packet id byte of the header
+shed_thinned_packets = (0, 6)
+
+
+def set_shed_level(level, reason):
+    global shed_level
+
+    if level == shed_level:
+        return
+    shed_level = level
+    metrics.incr("shed.decisions", level=level, reason=reason)
+    print("Load shedding level " + str(level) + " (" + shed_levels[level] + "): " + reason)
+    if metrics.process == "main":
+        for control_queue in control_queues:
+            control_queue.put({"shed_level": level})
+
+
+# Car slots among indices that are in the top shed_top_cars, not placed yet, or the player's
+def top_cars(rig, indices, playerCarIndex):
+    state = rig.session
+    with state.lock:
+        kept = [
+            car_index for car_index in indices if state.car_position[car_index] <= shed_top_cars or car_index == playerCarIndex
+        ]
+        rig.cars_shed += len(indices) - len(kept)
+    return kept
+
+
+# How far each sink is over its limits, 1.0 is at the limit. Returns the worst as (name, pressure)
+def sink_pressure():
+    readings = []
+    for stage in (hec_stage, o11y_stage):
+        if hasattr(stage, "backlog"):
+            readings.append((stage.name + " stage", stage.backlog() / shed_queue_high))
+    if hasattr(hec_sender, "backlog"):
+        readings.append(("hec queue", hec_sender.backlog() / shed_queue_high))
+        readings.append(("hec latency", hec_sender.recent_post_ms(shed_hold_s) / shed_latency_high_ms))
+    if args["o11y"] == "yes":
+        readings.append(("o11y queue", o11y_backlog() / shed_queue_high))
+        readings.append(("o11y latency", o11y_recent_post_ms() / shed_latency_high_ms))
+    return max(readings, key=lambda reading: reading[1], default=("none", 0.0))
+
+
+def shed_loop():
+    changed = time.monotonic()
+    calm_since = None
+
+    while True:
+        time.sleep(shed_check_interval_ms / 1000.0)
+        try:
+            reason, pressure = sink_pressure()
+        except RuntimeError:
+            # a latency deque changed while it was read, try again on the next check
+            continue
+
+        now = time.monotonic()
+        if pressure >= 1.0:
+            calm_since = None
+            if shed_level + 1 < len(shed_levels) and (shed_level == 0 or now - changed >= shed_hold_s):
+                set_shed_level(shed_level + 1, reason)
+                changed = now
+        elif pressure < 0.5:
+            if calm_since is None:
+                calm_since = now
+            if shed_level > 0 and now - max(calm_since, changed) >= shed_hold_s:
+                set_shed_level(shed_level - 1, "recovered")
+                changed = now
+        else:
+            calm_since = None
 
-    for key, value in f1_metrics.items():
-        telemetry_json.append({"metric": "f1_2022." + key, "value": value, "dimensions": f1_dimensions})
 
-    ingest.send(gauges=telemetry_json)
+# Replays wait for the sinks instead, so they are never shed
+def start_load_shedding():
+    metrics.gauge("shed.level", lambda: shed_level)
+    if not shed_enabled or metrics.process != "main" or args["replay"]:
+        return
+    threading.Thread(target=shed_loop, name="load-shedding", daemon=True).start()
 
 
-def send_dims_and_metrics(f1_json):
-    dimensions = [{key: car_dict[key] for key in sim_dimensions if key in car_dict} for car_dict in f1_json]
+#########################################
+# Change detection
+# Fields listed in [hec_deltas] or [o11y_deltas] are only sent to that sink when they have moved
+# more than their threshold since the value last sent for the same car, or when heartbeat_ms has
+# passed without sending them. A key is a field name, optionally prefixed with a packet type such
+# as CarTelemetryData.gear, and may use * wildcards. Rows carrying a lap or sector event are always
+# sent whole, and a row is dropped when nothing but its context fields is left. DeltaFilter is in
+# f1_ingest/deltas.py
+
+# Fields that identify a row rather than measure anything, never filtered
+delta_context_fields = frozenset(
+    [field[0] for field in PacketHeader._fields_]
+    + list(player_dict)
+    + ["network_id", "my_team", "car_index", "player_name", "lap_event", "lap_event_count"]
+)
+
+def delta_filter(thresholds, heartbeat_ms):
+    return DeltaFilter(thresholds, heartbeat_ms, delta_context_fields) if thresholds else None
+
+
+def print_delta_stats(rigs):
+    for rig in rigs:
+        for sink, delta in (("HEC", rig.hec_deltas), ("O11y", rig.o11y_deltas)):
+            if delta is not None:
+                print("Change detection " + sink + " " + rig.hostname + ": " + str(delta.stats()))
+
+
+#########################################
+# Splunk HEC transport
+# HecTransport, the on-disk HecSpool and the batching HecSender are in f1_ingest/sinks.py
+
+# Transport to the configured HEC endpoint
+def hec_transport():
+    return HecTransport(
+        session=sesh,
+        url=str(splunk_hec_ip + ":" + splunk_hec_port + "/services/collector"),
+        token=splunk_hec_token,
+        gzip_level=hec_gzip_level,
+        max_retries=hec_max_retries,
+        backoff_ms=hec_retry_backoff_ms,
+        backoff_max_ms=hec_retry_backoff_max_ms,
+        timeout=hec_timeout,
+        spool_dir=hec_spool_dir,
+        spool_max_bytes=hec_spool_max_bytes,
+    )
+
+
+# HecSender, AsyncHecSender or ParentForwarder once the pipeline is started
+hec_sender = None
+
+
+def print_spool_stats(transport):
+    if transport.spool is not None:
+        print("HEC spool: " + str(transport.spool.stats()))
+
+
+#########################################
+# HEC event serialisation
+# The constant part of every event, sourcetype, source and host, is rendered once per rig and
+# packet type. Rows are encoded straight to bytes, orjson when it is installed, keeping numbers
+# as JSON numbers, and joined to the envelope in one concatenation per event
+if orjson is not None:
+    def encode_json(value):
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+else:
+    json_encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def encode_json(value):
+        return json_encoder.encode(value).encode()
+
+
+class HecEnvelope:
+    def __init__(self, sourcetype, host, event_format):
+        envelope = encode_json({"sourcetype": sourcetype, "source": "f1_2022", "host": host})
+        self.head = envelope[:-1] + b',"time":'
+        if event_format == "fields":
+            # indexed fields need an event body, the sourcetype is enough
+            self.body = b',"event":' + encode_json(sourcetype) + b',"fields":'
+        else:
+            self.body = b',"event":'
+
+    # One serialised HEC event per row, all stamped with the current time
+    def render(self, rows):
+        prefix = self.head + b"%.6f" % time.time() + self.body
+        return [prefix + encode_json(row) + b"}" for row in rows]
+
+
+def hec_envelope(rig, packet_id, event_format):
+    envelope = rig.hec_envelopes.get((packet_id, event_format))
+    if envelope is None:
+        envelope = HecEnvelope(lookup_packet_id(packet_id), rig.hostname, event_format)
+        rig.hec_envelopes[(packet_id, event_format)] = envelope
+    return envelope
+
+
+# Function to send raw unprocessed event to hec, nested data always goes in the event body
+def send_hec_json(rig, data, packet_id):
+    hec_sender.put_many(hec_envelope(rig, packet_id, "event").render([data]))
+
+
+def send_hec_columns(rig, car_columns, packet_id):
+    send_hec_batch(rig, car_columns.rows(), packet_id)
+
+
+# function to queue multiple events for splunk enterprise env
+def send_hec_batch(rig, event_rows, packet_id):
+    if rig.hec_deltas is not None:
+        event_rows = rig.hec_deltas.filter_rows(packet_id, event_rows)
+    if not event_rows:
+        return
+    hec_sender.put_many(hec_envelope(rig, packet_id, hec_event_format).render(event_rows))
+
+
+#########################################
+# Streaming lap analytics
+# Lap, telemetry and status rows of every car are rolled up per sector and per lap as they
+# arrive. When a car crosses a sector line a compact summary event goes to the LapAnalytics
+# sourcetype: sector or lap time, deltas to the car's and the session's best, gap to the leader
+# at that line, speed min/max/avg, throttle and brake histograms and peak tyre and brake
+# temperatures and tyre wear, so dashboards can query the rollups instead of every 60Hz telemetry event
+analytics_packet_id = 100
+analytics_packets = (2, 6, 7, 10)
+
+peak_fields = (
+    ["brakes_temperature" + str(wheel) for wheel in range(1, 5)]
+    + ["tyres_surface_temperature" + str(wheel) for wheel in range(1, 5)]
+    + ["tyres_inner_temperature" + str(wheel) for wheel in range(1, 5)]
+    + ["engine_temperature"]
+)
+
+
+# Telemetry and status of one car over one sector or lap
+class Rollup:
+    def __init__(self, bins):
+        self.samples = 0
+        self.speed_min = None
+        self.speed_max = None
+        self.speed_total = 0
+        self.throttle = [0] * bins
+        self.brake = [0] * bins
+        self.peaks = {}
+        self.first_status = None
+        self.last_status = None
+        self.first_damage = None
+        self.last_damage = None
+
+    def add_telemetry(self, row):
+        speed = row["speed"]
+        if self.samples == 0:
+            self.speed_min = self.speed_max = speed
+        else:
+            self.speed_min = min(self.speed_min, speed)
+            self.speed_max = max(self.speed_max, speed)
+        self.speed_total += speed
+        self.samples += 1
+
+        bins = len(self.throttle)
+        self.throttle[min(int(row["throttle"] * bins), bins - 1)] += 1
+        self.brake[min(int(row["brake"] * bins), bins - 1)] += 1
+
+        for field in peak_fields:
+            value = row.get(field)
+            if value is not None and value > self.peaks.get(field, value - 1):
+                self.peaks[field] = value
+
+    def add_status(self, row):
+        if self.first_status is None:
+            self.first_status = row
+        self.last_status = row
+
+    def add_damage(self, row):
+        if self.first_damage is None:
+            self.first_damage = row
+        self.last_damage = row
+
+    def summary(self):
+        summary = {
+            "samples": self.samples,
+            "speed_min": self.speed_min,
+            "speed_max": self.speed_max,
+            "speed_avg": round(self.speed_total / self.samples, 1) if self.samples else None,
+            "throttle_histogram": self.throttle,
+            "brake_histogram": self.brake,
+        }
+        for field, value in self.peaks.items():
+            summary["peak_" + field] = value
+
+        if self.last_status is not None:
+            summary["fuel_used"] = round(self.first_status["fuel_in_tank"] - self.last_status["fuel_in_tank"], 3)
+            summary["actual_tyre_compound"] = self.last_status["actual_tyre_compound"]
+            summary["tyres_age_laps"] = self.last_status["tyres_age_laps"]
+            summary["ers_store_energy"] = self.last_status["ers_store_energy"]
+
+        if self.last_damage is not None:
+            for wheel in range(1, 5):
+                field = "tyres_wear" + str(wheel)
+                summary[field] = round(self.last_damage[field], 3)
+                summary[field + "_delta"] = round(self.last_damage[field] - self.first_damage[field], 3)
+
+        return summary
+
+
+# Where one car is on track, its open rollups and its best sector and lap times
+class CarTiming:
+    def __init__(self, bins):
+        self.lap = None
+        self.sector = None
+        self.sector1 = 0
+        self.sector2 = 0
+        self.sector_rollup = Rollup(bins)
+        self.lap_rollup = Rollup(bins)
+        self.best_sectors = [None, None, None]
+        self.best_lap = None
+
+
+class LapAnalytics:
+    def __init__(self, bins):
+        self.bins = bins
+        self.reset(None)
+
+    def reset(self, session_uid):
+        self.session_uid = session_uid
+        self.cars = [CarTiming(self.bins) for _ in range(car_slots)]
+        self.best_sectors = [None, None, None]
+        self.best_lap = None
+        # (lap, sector line) -> session time the car in P1 crossed it, a few hundred per session
+        self.timing_points = {}
+
+    # Summary events completed by one packet's rows
+    def add(self, packet_id, rows):
+        if not rows:
+            return []
+        if rows[0]["session_uid"] != self.session_uid:
+            self.reset(rows[0]["session_uid"])
+
+        if packet_id == 2:
+            return self.add_laps(rows)
+
+        for row in rows:
+            car = self.cars[row["car_index"]]
+            if packet_id == 6:
+                car.sector_rollup.add_telemetry(row)
+                car.lap_rollup.add_telemetry(row)
+            elif packet_id == 10:
+                car.sector_rollup.add_damage(row)
+                car.lap_rollup.add_damage(row)
+            else:
+                car.sector_rollup.add_status(row)
+                car.lap_rollup.add_status(row)
+        return []
+
+    def add_laps(self, rows):
+        summaries = []
+        # the leader's crossing is recorded before the other cars crossing in the same frame
+        for row in sorted(rows, key=lambda row: row["car_position"] != 1):
+            car = self.cars[row["car_index"]]
+            lap = row["current_lap_num"]
+            sector = row["sector"]
+
+            if car.lap is not None and lap > car.lap:
+                # over the finish line, the last sector closes and the lap with it
+                lap_time = row["last_lap_time_in_ms"]
+                if car.sector == 2:
+                    summaries.append(self.close_sector(car, row, car.lap, 2, lap_time - car.sector1 - car.sector2))
+                summaries.append(self.close_lap(car, row, car.lap, lap_time))
+            elif car.lap is not None and lap == car.lap and sector > car.sector:
+                sector_time = row["sector1_time_in_ms"] if car.sector == 0 else row["sector2_time_in_ms"]
+                summaries.append(self.close_sector(car, row, lap, car.sector, sector_time))
+
+            car.lap = lap
+            car.sector = sector
+            car.sector1 = row["sector1_time_in_ms"]
+            car.sector2 = row["sector2_time_in_ms"]
+        return summaries
+
+    # Milliseconds behind the car in P1 at the same line on the same lap, None when the leader's
+    # crossing was not seen, as in solo mode where only the player's car is analysed
+    def gap_to_leader(self, row, lap, line):
+        if row["car_position"] == 1:
+            self.timing_points[(lap, line)] = row["session_time"]
+        leader = self.timing_points.get((lap, line))
+        if leader is None:
+            return None
+        return round((row["session_time"] - leader) * 1000)
+
+    def close_sector(self, car, row, lap, sector, sector_time):
+        summary = {
+            "summary": "sector",
+            "car_index": row["car_index"],
+            "name": row.get("name"),
+            "session_uid": row["session_uid"],
+            "session_time": row["session_time"],
+            "lap": lap,
+            "sector": sector + 1,
+            "sector_time_in_ms": sector_time,
+            "delta_to_personal_best_ms": delta(sector_time, car.best_sectors[sector]),
+            "delta_to_session_best_ms": delta(sector_time, self.best_sectors[sector]),
+            "gap_to_leader_ms": self.gap_to_leader(row, lap, sector + 1),
+            "car_position": row["car_position"],
+        }
+        summary.update(car.sector_rollup.summary())
+
+        if sector_time > 0:
+            car.best_sectors[sector] = best(sector_time, car.best_sectors[sector])
+            self.best_sectors[sector] = best(sector_time, self.best_sectors[sector])
+        car.sector_rollup = Rollup(self.bins)
+        return summary
+
+    def close_lap(self, car, row, lap, lap_time):
+        summary = {
+            "summary": "lap",
+            "car_index": row["car_index"],
+            "name": row.get("name"),
+            "session_uid": row["session_uid"],
+            "session_time": row["session_time"],
+            "lap": lap,
+            "lap_time_in_ms": lap_time,
+            "sector1_time_in_ms": car.sector1,
+            "sector2_time_in_ms": car.sector2,
+            "sector3_time_in_ms": lap_time - car.sector1 - car.sector2,
+            "delta_to_personal_best_ms": delta(lap_time, car.best_lap),
+            "delta_to_session_best_ms": delta(lap_time, self.best_lap),
+            "gap_to_leader_ms": self.gap_to_leader(row, lap, 3),
+            "car_position": row["car_position"],
+        }
+        summary.update(car.lap_rollup.summary())
+
+        if lap_time > 0:
+            car.best_lap = best(lap_time, car.best_lap)
+            self.best_lap = best(lap_time, self.best_lap)
+        car.lap_rollup = Rollup(self.bins)
+        return summary
+
+
+def delta(time_ms, best_ms):
+    return time_ms - best_ms if best_ms is not None else None
+
+
+def best(time_ms, best_ms):
+    return time_ms if best_ms is None else min(time_ms, best_ms)
+
+
+# analytics stage, each rig's rows always go to the same worker
+def analyse_rows(rig, packet_id, rows):
+    if isinstance(rows, CarColumns):
+        rows = rows.rows()
+
+    summaries = rig.analytics.add(packet_id, rows)
+    if summaries:
+        hec_sender.put_many(hec_envelope(rig, analytics_packet_id, "event").render(summaries))
+
+
+#########################################
+# Staged pipeline
+# Packets flow from the receive loop to the decode/merge stage and on to the HEC and O11y
+# sink stages through bounded queues. Each stage has a fixed number of workers with a queue
+# each; work can be sharded so that every packet of one type lands on the same worker and
+# is handled in arrival order, which keeps lap slot updates in packet order
+class Stage:
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self.next_worker = itertools.count()
+        self.lock = threading.Lock()
+
+        # counters and the most recent latencies in seconds
+        self.done = 0
+        self.dropped = 0
+        self.errors = 0
+        self.wait_times = collections.deque(maxlen=1024)
+        self.run_times = collections.deque(maxlen=1024)
+        metrics.gauge("stage.queue_depth", lambda: sum(work_queue.qsize() for work_queue in self.queues), stage=name)
+
+        self.workers = [
+            threading.Thread(target=self.work, args=(work_queue,), name=name + "-" + str(i), daemon=True)
+            for i, work_queue in enumerate(self.queues)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    # Queue function(*args) on the worker picked by shard, round robin when no shard is given.
+    # Returns False when the queue is full and block is False
+    def put(self, function, *args, shard=None, block=True):
+        if shard is None:
+            shard = next(self.next_worker)
+
+        try:
+            self.queues[shard % len(self.queues)].put((time.perf_counter(), function, args), block=block)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            metrics.incr("stage.dropped", stage=self.name)
+            return False
+
+        return True
+
+    # Queue function(*args) on every worker but the one picked by shard
+    def put_others(self, function, *args, shard, block=True):
+        for other in range(len(self.queues)):
+            if other != shard % len(self.queues):
+                self.put(function, *args, shard=other, block=block)
+
+    def work(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+
+            queued, function, args = item
+            started = time.perf_counter()
+            try:
+                function(*args)
+                failed = 0
+            except Exception as e:
+                print(self.name + " stage error: " + str(e))
+                failed = 1
+            finished = time.perf_counter()
+
+            with self.lock:
+                self.done += 1
+                self.errors += failed
+                self.wait_times.append(started - queued)
+                self.run_times.append(finished - started)
+            metrics.observe("stage.wait", started - queued, stage=self.name)
+            metrics.observe("stage.run", finished - started, stage=self.name)
+            if failed:
+                metrics.incr("stage.errors", stage=self.name)
+
+    def stats(self):
+        with self.lock:
+            wait_times = list(self.wait_times)
+            run_times = list(self.run_times)
+            stats = {"done": self.done, "dropped": self.dropped, "errors": self.errors}
+
+        stats["depth"] = sum(work_queue.qsize() for work_queue in self.queues)
+        stats["wait_p50_ms"] = round(percentile(wait_times, 0.5) * 1000, 2)
+        stats["wait_p99_ms"] = round(percentile(wait_times, 0.99) * 1000, 2)
+        stats["run_p50_ms"] = round(percentile(run_times, 0.5) * 1000, 2)
+        stats["run_p99_ms"] = round(percentile(run_times, 0.99) * 1000, 2)
+        return stats
+
+    # Fraction of the queues in use, for load shedding
+    def backlog(self):
+        capacity = sum(work_queue.maxsize for work_queue in self.queues)
+        return sum(work_queue.qsize() for work_queue in self.queues) / capacity if capacity > 0 else 0.0
+
+    # Let the workers finish what is queued, then stop them
+    def close(self):
+        for work_queue in self.queues:
+            work_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+# Set by the engine; the --rigs parent process only forwards packets and has none
+decode_stage = analytics_stage = hec_stage = o11y_stage = None
+
+
+def pipeline_stages():
+    return [stage for stage in (decode_stage, analytics_stage, hec_stage, o11y_stage) if stage is not None]
+
+
+def print_pipeline_stats():
+    for rig in active_rigs:
+        print_receive_stats(rig)
+    print_delta_stats(active_rigs)
+    for stage in pipeline_stages():
+        print("Pipeline " + stage.name + ": " + str(stage.stats()))
+
+
+def report_pipeline_stats():
+    while True:
+        time.sleep(stats_interval)
+        print_pipeline_stats()
+
+
+#########################################
+# Record and replay
+# --record appends every datagram to a capture file: an 8 byte magic followed by one record per
+# packet, the arrival time as a double, the packet length as an unsigned short and the raw bytes.
+# --replay feeds a capture file back through the same pipeline at the recorded pace, a multiple
+# of it, or unthrottled, and reports packets/sec and the time from feeding a packet to the end
+# of massage_data
+capture_magic = b"F122CAP1"
+capture_record = struct.Struct("<dH")
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.packets = 0
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(capture_magic)
+
+    def write(self, packet, arrival=None):
+        record = capture_record.pack(arrival or time.time(), len(packet)) + packet
+        with self.lock:
+            self.file.write(record)
+            self.packets += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        print("Recorded " + str(self.packets) + " packets to " + self.path)
+
+
+# With --rigs every rig records to its own file, FILE with the rig hostname appended
+def open_recorders(rigs):
+    if not args["record"]:
+        return
+
+    for rig in rigs:
+        path = args["record"]
+        if args["rigs"]:
+            root, extension = os.path.splitext(path)
+            path = root + "_" + rig.hostname + extension
+        rig.recorder = CaptureWriter(path)
+
+
+def close_recorders(rigs):
+    for rig in rigs:
+        if rig.recorder is not None:
+            rig.recorder.close()
 
-    metrics = [{key: car_dict[key] for key in sim_metrics if key in car_dict} for car_dict in f1_json]
-    
-    for f1_metrics, f1_dimensions in zip(metrics, dimensions):
-        if len(f1_metrics) >= 1:
-            # Send current row to SIM
-            send_metric(f1_metrics, f1_dimensions)
-
-
-# Function to send raw unprocessed event to hec
-@background.task
-def send_hec_json(data, packet_id):
-    global hostname
-    global player_name
-    global sesh
-
-    hec_payload = ""
-
-    event = {}
-    event["time"] = datetime.now().timestamp()
-    event["sourcetype"] = lookup_packet_id(packet_id)
-    event["source"] = "f1_2022"
-    event["host"] = hostname
-    event["event"] = data
-
-    hec_payload = hec_payload + json.dumps(event)
-    
-    url = str(splunk_hec_ip + ":" + splunk_hec_port + "/services/collector")
-    header = {"Authorization": "{}".format("Splunk " + splunk_hec_token)}
+
+# Yields (arrival time, packet) for every complete record, a capture cut off mid record ends at the last full one
+def read_capture(path):
+    with open(path, "rb") as capture:
+        if capture.read(len(capture_magic)) != capture_magic:
+            raise ValueError(path + " is not a telemetry capture file")
+
+        while True:
+            record = capture.read(capture_record.size)
+            if len(record) < capture_record.size:
+                return
+            arrival, length = capture_record.unpack(record)
+            packet = capture.read(length)
+            if len(packet) < length:
+                return
+            yield arrival, packet
+
+
+# Yields (seconds to wait before feeding, packet), keeping the recorded gaps divided by speed. Speed 0 never waits
+def replay_schedule(path, speed):
+    started = time.perf_counter()
+    first_arrival = None
+
+    for arrival, packet in read_capture(path):
+        wait = 0.0
+        if speed > 0:
+            if first_arrival is None:
+                first_arrival = arrival
+            wait = started + (arrival - first_arrival) / speed - time.perf_counter()
+        yield wait, packet
+
+
+# feed to end of massage_data, in seconds
+replay_latencies = collections.deque(maxlen=100000)
+
+
+def replay_packet(rig, packet, fed):
+    if decoder == "json":
+        packet = unpack_packet(packet)
+        if packet is None:
+            return
+
+    massage_data(rig, packet)
+    replay_latencies.append(time.perf_counter() - fed)
+
+
+# Feed the capture through the threaded pipeline. Unthrottled replay waits for room in the decode
+# queue, and the senders for room of their own, instead of dropping, so the numbers are the
+# pipeline's own throughput
+def replay_capture(rig, path, speed):
+    for wait, packet in replay_schedule(path, speed):
+        if wait > 0:
+            time.sleep(wait)
+        rig.received(packet)
+        if not wanted_packet(rig, packet):
+            rig.filtered += 1
+            continue
+        decode_stage.put(replay_packet, rig, packet, time.perf_counter(), shard=packet[5], block=speed == 0)
+        if packet[5] in session_state_handlers:
+            decode_stage.put_others(apply_session_state, rig, packet, shard=packet[5], block=speed == 0)
+
+
+# Unthrottled replay waits for the senders to post instead of having them drop batches
+async def replay_capture_async(rig, path, speed):
+    senders = [sender for sender in (hec_sender, ingest) if speed == 0 and isinstance(sender, AsyncBatcher)]
+    for sender in senders:
+        sender.block = True
+    for wait, packet in replay_schedule(path, speed):
+        if wait > 0:
+            await asyncio.sleep(wait)
+        elif rig.packets_received % 64 == 0:
+            # let the senders post while replaying unthrottled
+            await asyncio.sleep(0)
+        for sender in senders:
+            await sender.wait_for_room()
+        rig.received(packet)
+        if not wanted_packet(rig, packet):
+            rig.filtered += 1
+            continue
+        decode_stage.put(replay_packet, rig, packet, time.perf_counter())
+
+
+def print_replay_stats(rig, started, fed, drained):
+    packets = rig.packets_received
+    print("Replay: {} packets at speed {:g}, fed in {:.2f} s ({:.0f} pkt/s), drained in {:.2f} s ({:.0f} pkt/s)".format(
+        packets, args["replay_speed"], fed - started, packets / max(fed - started, 1e-9),
+        drained - started, packets / max(drained - started, 1e-9)))
+    latencies = list(replay_latencies)
+    print("Replay feed to end of massage_data: p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, max(latencies, default=0.0) * 1000))
+
+
+#########################################
+# UDP receive
+# Each rig socket gets a receive_buffer_kb kernel buffer, so the burst of 22 cars at race start
+# is queued instead of overflowing. The receive thread wakes up on the first datagram and drains
+# up to receive_batch more without blocking, stamping each with its arrival time, before handing
+# the raw bytes to the decode pool. Packets the game sent but that never arrived are counted per
+# packet id from the header session time by PacketLoss in f1_ingest/receive.py, and the kernel's own
+# drop count is read from /proc/net/udp
+
+# Sets the receive buffer and reports what the OS actually granted, Linux caps it at net.core.rmem_max
+def tune_receive_socket(rig, sock):
+    if receive_buffer_kb > 0:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_kb * 1024)
+        except OSError as e:
+            print("Rig " + rig.hostname + ": receive buffer not set: " + str(e))
+
+    granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    message = "Rig " + rig.hostname + ": UDP receive buffer " + str(granted // 1024) + " KiB"
+    # Linux reports twice the size asked for
+    if receive_buffer_kb > 0 and granted < receive_buffer_kb * 1024:
+        message += ", asked for " + str(receive_buffer_kb) + " KiB, raise net.core.rmem_max"
+    print(message)
+
+    if kernel_udp_drops(rig.port) is not None:
+        metrics.gauge("udp.kernel_drops", lambda: kernel_udp_drops(rig.port), rig=rig.hostname)
+
+
+# Datagrams the kernel dropped for the port because the socket buffer was full, None when not on Linux
+def kernel_udp_drops(port):
+    drops = None
+    for path in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(path) as table:
+                next(table)
+                for line in table:
+                    fields = line.split()
+                    if int(fields[1].rsplit(":", 1)[1], 16) == port:
+                        drops = (drops or 0) + int(fields[-1])
+        except (OSError, ValueError, IndexError, StopIteration):
+            pass
+    return drops
+
+
+def print_receive_stats(rig):
+    def by_name(counts):
+        return {lookup_packet_id(packet_id): count for packet_id, count in enumerate(counts) if count}
+
+    stats = {
+        "lost": by_name(rig.loss.lost),
+        "late": by_name(rig.loss.late),
+        "dropped": by_name(rig.dropped_by_id),
+        "filtered": rig.filtered,
+        "shed": by_name(rig.shed_by_id),
+        "cars_shed": rig.cars_shed,
+    }
+    drops = kernel_udp_drops(rig.port) if not args["replay"] else None
+    if drops is not None:
+        stats["kernel_drops"] = drops
+    print("Pipeline receive " + rig.hostname + ": " + str(rig.packets_received) + " packets " + str(stats))
+
+
+# Blocks for the first datagram, then takes whatever else is already queued, up to receive_batch_size
+def receive_batch(sock):
+    packets = [(time.time(), sock.recv(2048))]
+    try:
+        while len(packets) < receive_batch_size:
+            packets.append((time.time(), sock.recv(2048, receive_flags)))
+    except BlockingIOError:
+        pass
+    return packets
+
+
+# Windows has no MSG_DONTWAIT, every wakeup reads one datagram there
+receive_flags = getattr(socket, "MSG_DONTWAIT", 0)
+if not receive_flags:
+    receive_batch_size = 1
+
+
+# time from arrival on the socket to the start of massage_data, in seconds
+def massage_received(rig, packet, arrival):
+    metrics.observe("receive.latency", time.time() - arrival, rig=rig.hostname)
+    massage_data(rig, packet)
+
+
+# receive stage, one thread per rig
+def receive_loop(rig, sock):
+    while True:
+        for arrival, packet in receive_batch(sock):
+            if len(packet) < packet_header_size:
+                continue
+            packet_id = packet[5]
+            rig.received(packet)
+            if rig.recorder is not None:
+                rig.recorder.write(packet, arrival)
+            if not wanted_packet(rig, packet):
+                rig.filtered += 1
+                continue
+            if decoder == "json":
+                packet = unpack_packet(packet)
+                if packet is None:
+                    continue
+            # shard by rig and packet id so each packet type of a rig is decoded in order, drop when the stage is full
+            if not decode_stage.put(massage_received, rig, packet, arrival, shard=rig.port * 16 + packet_id, block=False):
+                rig.dropped_by_id[packet_id & 15] += 1
+            elif packet_id in session_state_handlers:
+                decode_stage.put_others(apply_session_state, rig, packet, shard=rig.port * 16 + packet_id, block=False)
+
+
+# Run the pipeline for the given rigs until interrupted
+def run_rigs(rigs):
+    global decode_stage
+    global analytics_stage
+    global hec_stage
+    global o11y_stage
+    global active_rigs
+
+    active_rigs = rigs
+    for rig in rigs:
+        rig.register_metrics()
+    sockets = [rig_socket(rig.port) for rig in rigs]
+    for rig, sock in zip(rigs, sockets):
+        tune_receive_socket(rig, sock)
+    open_recorders(rigs)
+
+    decode_stage = Stage("decode", decode_workers, stage_queue_size)
+    analytics_stage = Stage("analytics", analytics_workers, stage_queue_size) if analytics and args["splunk"] == "yes" else None
+    hec_stage = Stage("hec", hec_workers, stage_queue_size) if args["splunk"] == "yes" else None
+    o11y_stage = Stage("o11y", o11y_workers, stage_queue_size) if args["o11y"] == "yes" else None
+    open_o11y_sink()
+    open_session_archive()
+
+    if stats_interval > 0:
+        threading.Thread(target=report_pipeline_stats, name="pipeline-stats", daemon=True).start()
+
+    for rig, sock in zip(rigs, sockets):
+        threading.Thread(target=receive_loop, args=(rig, sock), name="receive-" + rig.hostname, daemon=True).start()
+    if metrics.process == "main":
+        report_startup()
 
     try:
-        response = sesh.post(url=url, data=hec_payload, headers=header, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        print(err)
-        print("Packet ID affected: " + lookup_packet_id(packet_id))
-    
-
-# function to send multiple events to splunk enterprise env
-@background.task
-def send_hec_batch(event_rows, packet_id):
-    event_rows = [{key: str(dict[key]) for key in dict.keys()} for dict in event_rows]
-
-    hec_payload = ""
-
-    for row in event_rows:
-        event = {}
-        # event["time"] = float(row["checkpoint_1_data_received"])
-        event["time"] = datetime.now().timestamp()
-        event["sourcetype"] = lookup_packet_id(packet_id)
-        event["source"] = "f1_2022"
-        event["host"] = hostname
-        event["event"] = row
-
-        hec_payload = hec_payload + json.dumps(event)
-
-    url = str(splunk_hec_ip + ":" + splunk_hec_port + "/services/collector")
-    header = {"Authorization": "{}".format("Splunk " + splunk_hec_token)}
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for stage in pipeline_stages():
+            stage.close()
+        print_pipeline_stats()
+        close_o11y_sink()
+        close_session_archive()
+        close_recorders(rigs)
+
+
+# Replay a capture file into the rig, returns when every packet has been through the pipeline stages
+def run_replay(rig, path, speed):
+    global decode_stage
+    global analytics_stage
+    global hec_stage
+    global o11y_stage
+
+    rig.register_metrics()
+    decode_stage = Stage("decode", decode_workers, stage_queue_size)
+    analytics_stage = Stage("analytics", analytics_workers, stage_queue_size) if analytics and args["splunk"] == "yes" else None
+    hec_stage = Stage("hec", hec_workers, stage_queue_size) if args["splunk"] == "yes" else None
+    o11y_stage = Stage("o11y", o11y_workers, stage_queue_size) if args["o11y"] == "yes" else None
+    # unthrottled, every sink waits for room instead of dropping, like the decode queue
+    if speed == 0:
+        open_o11y_sink(send_gauges_waiting, block=True)
+    else:
+        open_o11y_sink()
+    open_session_archive(block=speed == 0)
 
     try:
-        response = sesh.post(url=url, data=hec_payload, headers=header, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        print(err)
-        print("Packet ID affected: " + lookup_packet_id(packet_id))
+        replay_capture(rig, path, speed)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fed = time.perf_counter()
+        for stage in pipeline_stages():
+            stage.close()
+        print_pipeline_stats()
+        close_o11y_sink()
+        close_session_archive()
+
+    return fed
+
+
+#########################################
+# Rig worker processes
+# With --rigs the rigs are sharded across worker processes, one per core by default. Each
+# worker receives, decodes, merges and serialises for its own rigs and hands HEC events and
+# SignalFx gauges to the parent process, which owns the shared HEC and O11y sender pools
+
+# Stands in for hec_sender and the signalfx ingest client inside a rig worker process
+class ParentForwarder:
+    def __init__(self, sink_queue, kind):
+        self.sink_queue = sink_queue
+        self.kind = kind
+
+    def put(self, event):
+        self.put_many([event])
+
+    def put_many(self, events):
+        self.sink_queue.put((self.kind, events))
+
+    def send(self, gauges):
+        self.sink_queue.put((self.kind, gauges))
+
+
+# Stop on the first Ctrl-C, the worker can get it from both the terminal and the parent
+def interrupt_once(signum, frame):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def run_rig_process(rigs, sink_queue, control_queue):
+    global hec_sender
+    global ingest
+    global parent_queue
+    global worker_rigs
+
+    parent_queue = sink_queue
+    worker_rigs = rigs
+    hec_sender = ParentForwarder(sink_queue, "hec")
+    ingest = ParentForwarder(sink_queue, "o11y")
+    signal.signal(signal.SIGINT, interrupt_once)
+    metrics.process = multiprocessing.current_process().name
+    start_metrics_export()
+    start_profiling()
+    start_config_watch()
+    start_load_shedding()
+    threading.Thread(target=receive_config, args=(control_queue,), name="config-receive", daemon=True).start()
+
+    run_rigs(rigs)
+
+    # make sure everything queued for the parent is flushed before exiting
+    report_to_parent(block=True)
+    sink_queue.close()
+    sink_queue.join_thread()
+
+
+# The rig counters, queue depths and self metrics of a rig worker process, for GET /config and /stats
+def report_to_parent(block):
+    parent_queue.put(("report", (metrics.process, load_report(worker_rigs), metrics.snapshot())), block=block)
+
+
+# Parent side: feed what the rig workers hand over into the shared senders
+def forward_from_rig_processes(sink_queue):
+    while True:
+        item = sink_queue.get()
+        if item is None:
+            return
+
+        kind, items = item
+        try:
+            if kind == "hec":
+                hec_sender.put_many(items)
+            elif kind == "report":
+                process_name, worker_load[process_name], worker_stats[process_name] = items
+            else:
+                ingest.send(gauges=items)
+        except Exception as e:
+            print("forwarder error: " + str(e))
+
+
+#########################################
+# asyncio engine
+# With --engine asyncio the UDP socket is a DatagramProtocol on the event loop, packets are
+# decoded and merged inline as they arrive and the HEC and SignalFx senders post batches
+# through one pooled aiohttp session with a cap on requests in flight
+
+# Same put() as Stage, but runs the function straight away on the event loop
+class InlineStage:
+    def __init__(self, name):
+        self.name = name
+        self.done = 0
+        self.errors = 0
+        self.run_times = collections.deque(maxlen=1024)
+
+    def put(self, function, *args, shard=None, block=True):
+        started = time.perf_counter()
+        try:
+            function(*args)
+        except Exception as e:
+            print(self.name + " stage error: " + str(e))
+            self.errors += 1
+            metrics.incr("stage.errors", stage=self.name)
+        self.done += 1
+        self.run_times.append(time.perf_counter() - started)
+        metrics.observe("stage.run", self.run_times[-1], stage=self.name)
+        return True
+
+    def stats(self):
+        run_times = list(self.run_times)
+        return {
+            "done": self.done,
+            "errors": self.errors,
+            "run_p50_ms": round(percentile(run_times, 0.5) * 1000, 2),
+            "run_p99_ms": round(percentile(run_times, 0.99) * 1000, 2),
+        }
+
+
+# Batches items on the event loop and posts them when max_items or max_bytes is reached or
+# the oldest item is max_latency_ms old. Batches beyond max_in_flight wait for a free slot,
+# and new batches are dropped once max_queued items are waiting, unless block is set: then
+# the producer awaits wait_for_room() instead, like the threaded replay blocking on a full queue
+class AsyncBatcher:
+    # names the self metrics of the sender
+    sink = "batcher"
+
+    def __init__(self, session, max_items, max_bytes, max_latency_ms, max_in_flight, max_queued):
+        self.session = session
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency_ms / 1000.0
+        self.max_queued = max_queued
+        self.in_flight = asyncio.Semaphore(max(1, max_in_flight))
+        self.block = False
+        self.room = asyncio.Event()
+
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.waiting = 0
+        self.timer = None
+        self.tasks = set()
+
+        # counters
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.spooled = 0
+        self.posts = 0
+        # (finished, seconds) of the last few POSTs, see recent_post_ms
+        self.recent_posts = collections.deque(maxlen=16)
+
+    def add(self, item, size=0):
+        self.buffer.append(item)
+        self.buffer_bytes += size
+
+        if len(self.buffer) >= self.max_items or self.buffer_bytes >= self.max_bytes:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_latency, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.buffer:
+            return
+
+        batch = self.buffer
+        self.buffer = []
+        self.buffer_bytes = 0
+
+        if not self.block and self.waiting + len(batch) > self.max_queued:
+            self.dropped += len(batch)
+            metrics.incr(self.sink + ".events", len(batch), result="dropped")
+            return
+
+        task = asyncio.get_running_loop().create_task(self.deliver(batch))
+        self.waiting += len(batch)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def deliver(self, batch):
+        async with self.in_flight:
+            self.waiting -= len(batch)
+            self.room.set()
+            started = time.perf_counter()
+            try:
+                result = await self.post(batch)
+                metrics.incr(self.sink + ".events", len(batch), result=result or "sent")
+                metrics.observe(self.sink + ".post", time.perf_counter() - started)
+                self.recent_posts.append((time.monotonic(), time.perf_counter() - started))
+                if result == "spooled":
+                    self.spooled += len(batch)
+                elif result == "failed":
+                    self.failed += len(batch)
+                else:
+                    self.flushed += len(batch)
+                    self.posts += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                self.recent_posts.append((time.monotonic(), time.perf_counter() - started))
+                print(repr(err))
+                print(self.__class__.__name__ + " batch lost: " + str(len(batch)) + " items")
+                self.failed += len(batch)
+                metrics.incr(self.sink + ".events", len(batch), result="failed")
+
+    async def wait_for_room(self):
+        while self.waiting >= self.max_queued:
+            self.room.clear()
+            await self.room.wait()
+
+    def stats(self):
+        return {
+            "queued": len(self.buffer) + self.waiting,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "spooled": self.spooled,
+            "posts": self.posts,
+        }
+
+    # For load shedding, read from the load shedding thread
+    def backlog(self):
+        return (len(self.buffer) + self.waiting) / self.max_queued
+
+    def recent_post_ms(self, window_s):
+        return recent_post_ms(self.recent_posts, window_s)
+
+    async def close(self):
+        self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
+# asyncio counterpart of HecSender, put() is called from the event loop
+class AsyncHecSender(AsyncBatcher):
+    sink = "hec"
+
+    def __init__(self, session, transport, max_bytes, max_latency_ms, queue_size, max_in_flight):
+        super().__init__(session, queue_size, max_bytes, max_latency_ms, max_in_flight, queue_size)
+        self.transport = transport
+
+    def put(self, event):
+        self.add(event, len(event))
+
+    def put_many(self, events):
+        for event in events:
+            self.add(event, len(event))
+
+    async def post(self, batch):
+        return await self.transport.send_async(self.session, batch)
+
+
+# Stands in for the signalfx ingest client: gauges from every send() are batched into one
+# JSON POST to the SignalFx /v2/datapoint endpoint
+class AsyncSignalFxIngest(AsyncBatcher):
+    sink = "o11y"
+
+    def __init__(self, session, endpoint, token, max_datapoints, max_latency_ms, max_in_flight):
+        super().__init__(session, max_datapoints, float("inf"), max_latency_ms, max_in_flight, max_datapoints * 10)
+        self.url = endpoint.rstrip("/") + "/v2/datapoint"
+        self.header = {"X-SF-Token": token}
+
+    def send(self, gauges):
+        for gauge in gauges:
+            self.add(gauge)
+
+    async def post(self, batch):
+        async with self.session.post(
+            self.url,
+            json={"gauge": batch},
+            headers=self.header,
+            timeout=aiohttp.ClientTimeout(total=o11y_timeout),
+        ) as response:
+            metrics.incr("o11y.responses", status=response.status)
+            response.raise_for_status()
+
+
+class TelemetryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, rig):
+        self.rig = rig
+
+    def connection_made(self, transport):
+        tune_receive_socket(self.rig, transport.get_extra_info("socket"))
+
+    def datagram_received(self, data, addr):
+        arrival = time.time()
+        if len(data) < packet_header_size:
+            return
+        self.rig.received(data)
+        if self.rig.recorder is not None:
+            self.rig.recorder.write(data, arrival)
+        if not wanted_packet(self.rig, data):
+            self.rig.filtered += 1
+            return
+
+        if decoder == "json":
+            data = unpack_packet(data)
+            if data is None:
+                return
+
+        decode_stage.put(massage_received, self.rig, data, arrival)
+
+
+async def report_pipeline_stats_async():
+    while True:
+        await asyncio.sleep(stats_interval)
+        print_pipeline_stats()
+
+
+async def run_asyncio(rigs):
+    global hec_sender
+    global ingest
+    global active_rigs
+
+    active_rigs = rigs
+    for rig in rigs:
+        rig.register_metrics()
+
+    loop = asyncio.get_running_loop()
+    connector = aiohttp.TCPConnector(limit=hec_max_in_flight + o11y_max_in_flight)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        if args["splunk"] == "yes":
+            hec_sender = AsyncHecSender(
+                session,
+                transport=hec_transport(),
+                max_bytes=hec_batch_max_bytes,
+                max_latency_ms=hec_batch_max_latency_ms,
+                queue_size=hec_queue_size,
+                max_in_flight=hec_max_in_flight,
+            )
+            for rig in rigs:
+                send_hec_batch(rig, [startup_payload], 99)
+
+        if args["o11y"] == "yes":
+            ingest = AsyncSignalFxIngest(
+                session,
+                endpoint=sim_endpoint,
+                token=sim_token,
+                max_datapoints=o11y_batch_max_datapoints,
+                max_latency_ms=o11y_batch_max_latency_ms,
+                max_in_flight=o11y_max_in_flight,
+            )
+            # the sink flushes from its own thread, the batch is handed over to the event loop
+            open_o11y_sink(lambda gauges: loop.call_soon_threadsafe(ingest.send, gauges))
+            start_metrics_export(lambda gauges: loop.call_soon_threadsafe(ingest.send, gauges))
+
+        open_session_archive(block=bool(args["replay"]) and args["replay_speed"] == 0)
+
+        transports = []
+        if not args["replay"]:
+            for rig in rigs:
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda rig=rig: TelemetryProtocol(rig), sock=rig_socket(rig.port)
+                )
+                transports.append(transport)
+            open_recorders(rigs)
+            report_startup()
+        reporter = loop.create_task(report_pipeline_stats_async()) if stats_interval > 0 else None
+
+        started = time.perf_counter()
+        try:
+            if args["replay"]:
+                await replay_capture_async(rigs[0], args["replay"], args["replay_speed"])
+            else:
+                await asyncio.Event().wait()
+        finally:
+            fed = time.perf_counter()
+            for transport in transports:
+                transport.close()
+            if reporter is not None:
+                reporter.cancel()
+            print_pipeline_stats()
+            close_recorders(rigs)
+            close_session_archive()
+            if args["splunk"] == "yes":
+                await hec_sender.close()
+                print("HEC sender: " + str(hec_sender.stats()))
+                print_spool_stats(hec_sender.transport)
+            if args["o11y"] == "yes":
+                close_o11y_sink()
+                # let the last batch reach the ingest client
+                await asyncio.sleep(0)
+                await ingest.close()
+                print("O11y sender: " + str(ingest.stats()))
+            if args["replay"]:
+                print_replay_stats(rigs[0], started, fed, time.perf_counter())
 
 
 #########################################
 # Data Stream Management and Processing
-def update_player_info(data):
-    global player_info
-    player_info = data["participants"]
+def update_player_info(rig, data):
+    if decoder == "numpy":
+        rig.session.update_participant_columns(data["participants"])
+    else:
+        rig.session.update_participants(data["participants"])
+
+
+def update_session_info(rig, data):
+    rig.session.update_session(data["header"]["session_uid"])
+
 
+#########################################
+# Flatten/merge plans
+# Every per car packet type is merged the same way, so each one is described once:
+# which array holds the car entries, which root fields are joined onto every row,
+# which player-only wheel lists are expanded in solo mode, an optional hook
+# run over the merged rows and whether load shedding may drop spectator cars
+class MergePlan:
+    def __init__(self, rows_field, root_fields=(), player_lists=(), hook=None, column_hook=None, sheddable=False):
+        self.rows_field = rows_field
+        self.root_fields = list(root_fields)
+        self.player_list_fields = list(player_lists)
+        self.hook = hook
+        self.column_hook = column_hook
+        self.sheddable = sheddable
+        # filled in from the first packet seen, the game sends a fixed schema for each packet type
+        self.scalar_keys = None
+        self.list_keys = None
+        self.player_lists = None
+
+    # Work out the flat column layout of a json decoded entry once
+    def compile(self, entry):
+        self.scalar_keys = [key for key in entry if not isinstance(entry[key], list)]
+        self.list_keys = [
+            (key, [key + str(i + 1) for i in range(len(entry[key]))]) for key in entry if isinstance(entry[key], list)
+        ]
+
+    def compile_player_lists(self, data):
+        self.player_lists = [
+            (key, [key + str(i + 1) for i in range(len(data[key]))]) for key in self.player_list_fields
+        ]
+
+    # Flatten one json decoded entry, expanding lists of tyre info into name1..nameN
+    def flatten(self, entry, car_index):
+        row = {key: entry[key] for key in self.scalar_keys}
+        for key, names in self.list_keys:
+            row.update(zip(names, entry[key]))
+        row["car_index"] = car_index
+        return row
+
+
+# Flatten and join one packet through its plan. In solo mode only the player car is flattened
+def merge_packet(rig, plan, data, header, playerCarIndex):
+    entries = data[plan.rows_field]
+
+    if rig.mode == "spectator":
+        # a packet decoded just before the rig was switched from solo only has the player's row
+        indices = [i for i, entry in enumerate(entries) if entry is not None]
+        if plan.sheddable and shed_level >= 2:
+            indices = top_cars(rig, indices, playerCarIndex)
+    elif playerCarIndex < len(entries):
+        indices = [playerCarIndex]
+    else:
+        return []
+
+    # the struct decoder already produces flat rows
+    if decoder == "json":
+        if plan.scalar_keys is None:
+            plan.compile(entries[0])
+        rows = [plan.flatten(entries[i], i) for i in indices]
+    else:
+        rows = [entries[i] for i in indices]
+
+    roots = {key: data[key] for key in plan.root_fields}
+    participants = rig.session.participants
+
+    for row in rows:
+        if debug == True:
+            row["checkpoint_2_payload_flattened"] = time.time()
+
+        car_index = row["car_index"]
+        row.update(participants[car_index])
+        row.update(header)
+        row.update(roots)
+
+    if plan.hook is not None:
+        plan.hook(rig, rows)
+
+    if rig.mode != "spectator":
+        if plan.player_lists is None:
+            plan.compile_player_lists(data)
+        rows[0]["player_name"] = rig.player_name
+        for key, names in plan.player_lists:
+            rows[0].update(zip(names, data[key]))
+
+    return rows
+
+
+# check for events such as lap or sector completion
+def detect_lap_events(rig, rows):
+    state = rig.session
+
+    with state.lock:
+        for entry in rows:
+            car_index = entry["car_index"]
+            lap_num = entry["current_lap_num"]
+            sector = entry["sector"]
+
+            if state.current_lap[car_index] < lap_num:
+                state.lap_event[car_index] = "LAP_COMPLETE"
+                state.lap_event_count[car_index] = 0
+
+            if state.current_sector[car_index] < sector:
+                state.lap_event[car_index] = "SECTOR_COMPLETE"
+                state.lap_event_count[car_index] = 0
+
+            # repeat event anouncement for 5 packets in case of network loss
+            if state.lap_event[car_index] != "none":
+                if state.lap_event_count[car_index] < 5:
+                    entry["lap_event_count"] = state.lap_event_count[car_index]
+                    state.lap_event_count[car_index] += 1
+                else:
+                    state.lap_event[car_index] = "none"
+                    state.lap_event_count[car_index] = 0
+
+            state.current_sector[car_index] = sector
+            state.current_lap[car_index] = lap_num
+            state.car_position[car_index] = entry["car_position"]
+            entry["lap_event"] = state.lap_event[car_index]
+
+
+#########################################
+# Columnar merge for --decoder numpy
+# Per car arrays stay as structured NumPy arrays, one column per field and one row per car.
+# Selection, the participant join, the name filter and lap events run as array operations
+# and rows are only built when the data is serialised for HEC
+
+if numpy is not None:
+    lap_event_names = numpy.array(["none", "LAP_COMPLETE", "SECTOR_COMPLETE"], dtype=object)
+
+
+# Merged cars of one packet, built from the columns of each block only when they are sent
+class CarColumns:
+    def __init__(self, keys, values, constants, sparse=()):
+        self.keys = keys
+        # one tuple per car, in the order of keys
+        self.values = values
+        # fields shared by every car: header, root fields and player name
+        self.constants = constants
+        # keys whose None values mean the field is not set for that car
+        self.sparse = sparse
+
+    def rows(self):
+        keys = self.keys + list(self.constants)
+        constants = tuple(self.constants.values())
+        rows = [dict(zip(keys, values + constants)) for values in self.values]
+
+        for key in self.sparse:
+            for row in rows:
+                if row[key] is None:
+                    del row[key]
+
+        return rows
+
+    # (metrics, dimensions) for each car, picked by column position from sim_metrics
+    def metrics(self):
+        positions = {key: i for i, key in enumerate(self.keys)}
+        metric_keys = [key for key in sim_metrics if key in positions]
+        metric_constants = {key: value for key, value in self.constants.items() if key in sim_metrics}
+        dimension_keys = [key for key in sim_dimensions if key in positions]
+        dimension_constants = {key: value for key, value in self.constants.items() if key in sim_dimensions}
+
+        pairs = []
+        for f1_metrics, f1_dimensions in zip(self.select(metric_keys, positions), self.select(dimension_keys, positions)):
+            f1_metrics.update(metric_constants)
+            f1_dimensions.update(dimension_constants)
+            pairs.append((f1_metrics, f1_dimensions))
+
+        return pairs
+
+    # A dict of the given keys for each car
+    def select(self, keys, positions):
+        if not keys:
+            return [{} for _ in self.values]
+        if len(keys) == 1:
+            return [{keys[0]: values[positions[keys[0]]]} for values in self.values]
+
+        getter = operator.itemgetter(*[positions[key] for key in keys])
+        return [dict(zip(keys, getter(values))) for values in self.values]
+
+
+# Columnar version of detect_lap_events over the selected car slots
+def detect_lap_events_columns(rig, cars, indices):
+    with rig.session.lock:
+        for car_index, position in zip(indices.tolist(), cars["car_position"][indices].tolist()):
+            rig.session.car_position[car_index] = position
+        return lap_event_columns(rig.session.lap_columns, cars, indices)
+
+
+def lap_event_columns(lap_columns, cars, indices):
+    lap_num = cars["current_lap_num"][indices].astype(numpy.int64)
+    sector = cars["sector"][indices].astype(numpy.int64)
+
+    lap_done = lap_columns["current_lap"][indices] < lap_num
+    sector_done = lap_columns["current_sector"][indices] < sector
+    event = numpy.where(sector_done, 2, numpy.where(lap_done, 1, lap_columns["lap_event"][indices]))
+    count = numpy.where(lap_done | sector_done, 0, lap_columns["lap_event_count"][indices])
+
+    # repeat event anouncement for 5 packets in case of network loss
+    active = event != 0
+    announce = active & (count < 5)
+    expire = active & ~announce
+
+    lap_columns["lap_event"][indices] = numpy.where(expire, 0, event)
+    lap_columns["lap_event_count"][indices] = numpy.where(announce, count + 1, numpy.where(expire, 0, count))
+    lap_columns["current_lap"][indices] = lap_num
+    lap_columns["current_sector"][indices] = sector
+
+    return {
+        "lap_event": lap_event_names[lap_columns["lap_event"][indices]],
+        "lap_event_count": numpy.where(announce, count, None),
+    }
+
+
+# Columnar counterpart of merge_packet followed by the name filter
+def merge_columns(rig, plan, data, header, playerCarIndex):
+    cars = data[plan.rows_field]
+
+    if rig.mode == "spectator":
+        indices = car_range(len(cars))
+        if plan.sheddable and shed_level >= 2:
+            indices = numpy.array(top_cars(rig, indices.tolist(), playerCarIndex), dtype=numpy.int64)
+    elif playerCarIndex < len(cars):
+        indices = numpy.array([playerCarIndex])
+    else:
+        return CarColumns([], [], {})
 
-# Flatten the F1-2022 sections that consist of fields, and lists of tyre info
-def flatten_fast(data):
-    blank_list = []
-    car_index = 0
-    for entry in data:
-        blank_dict = {}
-        blank_dict.update({element: entry[element] for element in entry if not isinstance(entry[element], list)})
-        multi_value_fields = {element: {element + str(ind + 1): value for ind, value in enumerate(entry[element])} for element in entry if isinstance(entry[element], list)}
+    extra = plan.column_hook(rig, cars, indices) if plan.column_hook is not None else {}
 
-        for field in multi_value_fields:
-            blank_dict.update(multi_value_fields[field])
+    # keep only cars with a participant name
+    state = rig.session
+    with state.lock:
+        keep_mask = state.participant_named[indices]
+        keep = indices[keep_mask]
+        participant_keys = state.participant_keys
+        participant_values = [state.participant_values[car_index] for car_index in keep.tolist()]
 
-        blank_dict.update({"car_index": car_index})
-        car_index += 1
-        blank_list = blank_list + [blank_dict]
+    car_layout = column_layout(cars.dtype)
+    keys = car_layout.keys + ["car_index"]
+    blocks = [car_layout.values(cars, keep), [(car_index,) for car_index in keep.tolist()]]
 
-    telemetry = blank_list
+    if participant_keys is not None:
+        keys = keys + participant_keys
+        blocks.append(participant_values)
 
-    return telemetry
+    if extra:
+        keys = keys + list(extra)
+        blocks.append(list(zip(*[values[keep_mask].tolist() for values in extra.values()])))
 
+    values = [sum(parts, ()) for parts in zip(*blocks)]
 
-def flatten_car(data):
-    data = flatten_fast(data)
+    constants = dict(header)
+    constants.update({key: data[key] for key in plan.root_fields})
 
     if debug == True:
-        for entry in data:
-            entry.update({"checkpoint_2_payload_flattened": time.time()})
-
-    return data
-
-
-def merge_car_telemetry(data, header, playerCarIndex):
-    # Flatten file format
-    telemetry = flatten_car(data["car_telemetry_data"])
-
-    # Augment with header and player info data
-    for entry, player in zip(telemetry, player_info):
-        entry.update(player)
-        entry.update(header)
-
-    # If not in spectator mode, get rid of the non-player cars
-    if mode != "spectator":
-        # get only player car from flattened data
-        telemetry = [telemetry[playerCarIndex]]
-        telemetry[0].update({"player_name": player_name})
-
-    return telemetry
-
-
-def merge_car_motion(data, header, playerCarIndex):
-    # Flatten file format
-    telemetry = flatten_car(data["car_motion_data"])
-
-    # Augment with header and player info data
-    for entry, player in zip(telemetry, player_info):
-        entry.update(player)
-        entry.update(header)
-
-    # If not in spectator mode, get rid of the non-player cars
-    if mode != "spectator":
-        # get only player car from flattened data
-        telemetry = [telemetry[playerCarIndex]]
-        telemetry[0].update({"player_name": player_name})
-        # Get additional motion data, not stored in the main array
-        """
-        telemetry[0].update({"angular_acceleration_x": data["angular_acceleration_x"]})
-        telemetry[0].update({"angular_acceleration_y": data["angular_acceleration_y"]})
-        telemetry[0].update({"angular_acceleration_z": data["angular_acceleration_z"]})
-        telemetry[0].update({"angular_velocity_x": data["angular_velocity_x"]})
-        telemetry[0].update({"angular_velocity_y": data["angular_velocity_y"]})
-        telemetry[0].update({"angular_velocity_z": data["angular_velocity_z"]})
-
-        telemetry[0].update({"frontWheelsAngle": data["frontWheelsAngle"]})
-        telemetry[0].update({"local_velocity_x": data["local_velocity_x"]})
-        telemetry[0].update({"local_velocity_y": data["local_velocity_y"]})
-        telemetry[0].update({"local_velocity_z": data["local_velocity_z"]})
-        """
+        constants["checkpoint_2_payload_flattened"] = time.time()
+
+    if rig.mode != "spectator":
+        if plan.player_lists is None:
+            plan.compile_player_lists(data)
+        constants["player_name"] = rig.player_name
+        for key, names in plan.player_lists:
+            constants.update(zip(names, data[key]))
+
+    return CarColumns(keys, values, constants, sparse=["lap_event_count"] if "lap_event_count" in extra else [])
+
+
+merge_plans = {
+    0: MergePlan(
+        "car_motion_data",
         # Get the per-wheel motion data for the player car
-        player_car_motion_list = [
+        player_lists=[
             "suspension_acceleration",
             "suspension_position",
             "suspension_velocity",
             "wheel_slip",
             "wheel_speed",
-        ]
-        for motion_data in player_car_motion_list:
-            i = 1
-            for value in data[motion_data]:
-                telemetry[0].update({motion_data + str(i): value})
-                i += 1
-
-    return telemetry
-
-
-def merge_car_status(data, header, playerCarIndex):
-    # Flatten file format
-    telemetry = flatten_car(data["car_status_data"])
-
-    # Augment with header and player info data
-    for entry, player in zip(telemetry, player_info):
-        entry.update(player)
-        entry.update(header)
-
-    # If not in spectator mode, get rid of the non-player cars
-    if mode != "spectator":
-        # get only player car from flattened data
-        telemetry = [telemetry[playerCarIndex]]
-        telemetry[0].update({"player_name": player_name})
-
-    return telemetry
-
-
-def merge_car_lap(data, header, playerCarIndex):
-    # Flatten file format
-    telemetry = flatten_car(data["lap_data"])
-
-    # Augment with header and player info data
-    for entry, player in zip(telemetry, player_info):
-        entry.update(player)
-        entry.update(header)
-
-    # check for events such as lap or sector completeion
-    for entry, info_buffer in zip(telemetry, lap_info):
-        if info_buffer["current_lap"] < entry["current_lap_num"]:
-            info_buffer.update({"lap_event": "LAP_COMPLETE", "lap_event_count": 0})
-            entry.update({"lap_event": "LAP_COMPLETE"})
-
-        if info_buffer["current_sector"] < entry["sector"]:
-            info_buffer.update({"lap_event": "SECTOR_COMPLETE", "lap_event_count": 0})
-            entry.update({"lap_event": "SECTOR_COMPLETE"})
-
-        # repeat event anouncement for 3 seconds in case of network loss
-        if info_buffer["lap_event"] != "none":
-            if info_buffer["lap_event_count"] < 5:
-                entry.update(
-                    {
-                        "lap_event": info_buffer["lap_event"],
-                        "lap_event_count": info_buffer["lap_event_count"],
-                    }
-                )
+        ],
+        sheddable=True,
+    ),
+    1: MergePlan(
+        "marshal_zones",
+        root_fields=["air_temperature", "track_id", "weather", "total_laps", "track_temperature", "track_length"],
+    ),
+    2: MergePlan("lap_data", hook=detect_lap_events, column_hook=detect_lap_events_columns if numpy else None),
+    5: MergePlan("car_setups", sheddable=True),
+    6: MergePlan("car_telemetry_data", sheddable=True),
+    7: MergePlan("car_status_data", sheddable=True),
+    8: MergePlan("classification_data", root_fields=["num_cars"]),
+    9: MergePlan("lobby_players", root_fields=["num_players"]),
+    10: MergePlan("car_damage_data", sheddable=True),
+}
 
-                info_buffer.update({"lap_event_count": info_buffer["lap_event_count"] + 1})
-            else:
-                entry.update({"lap_event": "none"})
-                info_buffer.update({"lap_event": "none"})
-                info_buffer.update({"lap_event_count": 0})
-
-        info_buffer.update({"current_sector": entry["sector"], "current_lap": entry["current_lap_num"]})
-        entry.update({"lap_event": info_buffer["lap_event"]})
-
-    # lap_info +[{'current_sector': 0,
-    #            'current_lap': 1,
-    #            'lap_event': 'none',
-    #            'lap_event_count': 0}]
-
-    # If not in spectator mode, get rid of the non-player cars
-    if mode != "spectator":
-        # get only player car from flattened data
-        telemetry = [telemetry[playerCarIndex]]
-        telemetry[0].update({"player_name": player_name})
-
-    return telemetry
-
-
-def merge_car_setups(data, header, playerCarIndex):
-    # Flatten file format
-    telemetry = flatten_car(data["car_setups"])
-
-    # Augment with header and player info data
-    for entry, player in zip(telemetry, player_info):
-        entry.update(player)
-        entry.update(header)
-
-    # If not in spectator mode, get rid of the non-player cars
-    if mode != "spectator":
-        # get only player car from flattened data
-        telemetry = [telemetry[playerCarIndex]]
-        telemetry[0].update({"player_name": player_name})
-
-    return telemetry
-
-
-def merge_session(data, header, playerCarIndex):
-    # Flatten file format
-    telemetry = flatten_car(data["marshal_zones"])
-
-    # Augment with header and player info data
-    for entry, player in zip(telemetry, player_info):
-        entry.update(player)
-        entry.update(header)
-        # Grab root data elements
-
-        entry.update({"air_temperature": data["air_temperature"]})
-        entry.update({"track_id": data["track_id"]})
-        entry.update({"weather": data["weather"]})
-        entry.update({"total_laps": data["total_laps"]})
-        entry.update({"track_temperature": data["track_temperature"]})
-        entry.update({"track_length": data["track_length"]})
-        #entry.update({"spectator_car_index": data["spectator_car_index"]})
-        """
-        entry.update({"gamePaused": data["gamePaused"]})
-        entry.update({"isSpectating": data["isSpectating"]})
-        entry.update({"m_formula": data["m_formula"]})
-        entry.update({"networkGame": data["networkGame"]})
-        entry.update({"numMarshalZones": data["numMarshalZones"]})
-        entry.update({"numWeatherForecastSamples": data["numWeatherForecastSamples"]})
-        entry.update({"pitSpeedLimit": data["pitSpeedLimit"]})
-        entry.update({"safetyCarStatus": data["safetyCarStatus"]})
-        entry.update({"sessionDuration": data["sessionDuration"]})
-        entry.update({"sessionTimeLeft": data["sessionTimeLeft"]})
-        entry.update({"sessionType": data["sessionType"]})
-        entry.update({"sliProNativeSupport": data["sliProNativeSupport"]})
-        """
-
-    # If not in spectator mode, get rid of the non-player cars
-    if mode != "spectator":
-        # get only player car from flattened data
-        telemetry = [telemetry[playerCarIndex]]
-        telemetry[0].update({"player_name": player_name})
-
-    return telemetry
-
-
-def merge_final(data, header, playerCarIndex):
-    # Flatten file format
-    telemetry = flatten_car(data["classification_data"])
-
-    # Augment with header and player info data
-    for entry, player in zip(telemetry, player_info):
-        entry.update(player)
-        entry.update(header)
-        # Grab root data elements
-        entry.update({"num_cars": data["num_cars"]})
-
-    # If not in spectator mode, get rid of the non-player cars
-    if mode != "spectator":
-        # get only player car from flattened data
-        telemetry = telemetry.iloc[[playerCarIndex]]
-        telemetry["player_name"] = player_name
-
-    return telemetry
-
-
-def merge_lobby(data, header, playerCarIndex):
-    # Flatten file format
-    telemetry = flatten_car(data["lobby_players"])
-
-    # Augment with header and player info data
-    for entry, player in zip(telemetry, player_info):
-        entry.update(player)
-        entry.update(header)
-        # Grab root data elements
-        entry.update({"num_players": data["num_players"]})
-
-    # If not in spectator mode, get rid of the non-player cars
-    if mode != "spectator":
-        # get only player car from flattened data
-        telemetry = telemetry.iloc[[playerCarIndex]]
-        telemetry["player_name"] = player_name
-
-    return telemetry
-
-
-def send_augmented_json(data, packet_id):
-    data.update({"player_name": player_name})
-    send_hec_json(data, packet_id)
-
-
-@background.task
-def massage_data(data):
-    dict_object = data.to_json()
-    data = json.loads(dict_object)
-    packet_id = data["header"]["packet_id"]
-    header = data["header"]
-    playerCarIndex = data["header"]["player_car_index"]
+# Packet types that can be switched off in [telemetry_settings]
+packet_enabled = {
+    0: motion,
+    2: lap,
+    6: telemetry,
+    7: status,
+    10: damage,
+    11: history,
+}
+packet_ids_by_toggle = {"motion": 0, "lap": 2, "telemetry": 6, "status": 7, "damage": 10, "history": 11}
+
+
+# In solo mode the struct decoder unpacks only the player's row of the per car array each plan
+# merges. Arrays of other lengths, such as the marshal zones, are always unpacked whole
+def solo_fields():
+    for key, table in packet_tables.items():
+        plan = merge_plans.get(key[2])
+        for name, kind, offset, field in table.fields:
+            if plan is not None and kind == "rows" and name == plan.rows_field and field[1] == car_slots:
+                table.car_field = name
+
+
+solo_fields()
+
+
+def send_augmented_json(rig, data, packet_id):
+    data.update({"player_name": rig.player_name})
+    send_hec_json(rig, data, packet_id)
+
+
+# Rows of an array of structures from any decoder, as dicts, for the entries from start to end
+def packet_rows(data, field, start, end):
+    entries = data[field]
+    if decoder == "numpy":
+        layout = column_layout(entries.dtype)
+        return [dict(zip(layout.keys, values)) for values in layout.values(entries, car_range(end)[start:])]
+    if decoder == "json":
+        return [dict(entry) for entry in entries[start:end]]
+    return entries[start:end]
+
+
+# Session history carries every lap of one car and is sent about once a second per car. Only the
+# laps completed since the last packet for that car become rows, one per lap, with the tyre of
+# the stint it was driven on
+def merge_session_history(rig, data, header, playerCarIndex):
+    car_index = data["car_idx"]
+    if car_index >= car_slots or (rig.mode != "spectator" and car_index != playerCarIndex):
+        return []
+
+    laps = packet_rows(data, "lap_history_data", 0, min(data["num_laps"], 100))
+    completed = 0
+    while completed < len(laps) and laps[completed]["lap_time_in_ms"] > 0:
+        completed += 1
+
+    # laps of a car without a name yet are kept back until the participants packet arrives
+    participant = rig.session.participants[car_index]
+    if participant["name"] == "":
+        return []
+
+    start = rig.session.history_sent(car_index, completed)
+    if start >= completed:
+        return []
+
+    stints = packet_rows(data, "tyre_stints_history_data", 0, min(data["num_tyre_stints"], 8))
+    roots = {key: data[key] for key in ("num_laps", "best_lap_time_lap_num", "best_sector1_lap_num", "best_sector2_lap_num", "best_sector3_lap_num")}
+
+    rows = []
+    for lap_index in range(start, completed):
+        row = laps[lap_index]
+        row["lap_num"] = lap_index + 1
+        row["car_index"] = car_index
+        # stints end on their last lap, the current stint ends on 255
+        for stint in stints:
+            if stint["end_lap"] >= lap_index + 1:
+                row["tyre_actual_compound"] = stint["tyre_actual_compound"]
+                row["tyre_visual_compound"] = stint["tyre_visual_compound"]
+                break
+        row.update(participant)
+        row.update(header)
+        row.update(roots)
+        if rig.mode != "spectator":
+            row["player_name"] = rig.player_name
+        rows.append(row)
+
+    return rows
 
-    if debug == True:
-        data["header"].update({"checkpoint_1_data_received": time.time()})
 
-    if packet_id == 0:
-        if motion == True:
-            merged_data = merge_car_motion(data, header, playerCarIndex)
-        else:
-            return
+#########################################
+# Packet dispatch
+# massage_data decodes a packet and hands it to the handler for its packet id
 
-    if packet_id == 1:
-        merged_data = merge_session(data, header, playerCarIndex)
+def handle_event(rig, data, packet_id):
+    try:
+        if sinks_enabled["hec"]:
+            hec_stage.put(send_augmented_json, rig, data, packet_id)
+    except Exception as e:
+        print(str(e))
 
-    if packet_id == 2:
-        if lap == True:
-            merged_data = merge_car_lap(data, header, playerCarIndex)
-        else:
-            return
 
-    if packet_id == 3:
-        try:
-            if args["splunk"] == "yes":
-                send_augmented_json(data, packet_id)
-        except Exception as e:
-            print(str(e))
-        return
+def handle_participants(rig, data, packet_id):
+    update_player_info(rig, data)
 
-    if packet_id == 4:
-        update_player_info(data)
 
-    if packet_id == 5:
-        merged_data = merge_car_setups(data, header, playerCarIndex)
+def handle_session(rig, data, packet_id):
+    update_session_info(rig, data)
+    handle_cars(rig, data, packet_id)
 
-    if packet_id == 6:
-        if telemetry == True:
-            merged_data = merge_car_telemetry(data, header, playerCarIndex)
-        else:
-            return
 
-    if packet_id == 7:
-        if status == True:
-            merged_data = merge_car_status(data, header, playerCarIndex)
-        else:
-            return
+# Per car packets, merged through their plan
+def handle_cars(rig, data, packet_id):
+    header = data["header"]
+    playerCarIndex = header["player_car_index"]
 
-    if packet_id == 8:
-        merged_data = merge_final(data, header, playerCarIndex)
+    if decoder == "numpy":
+        merged_columns = merge_columns(rig, merge_plans[packet_id], data, header, playerCarIndex)
 
-    if packet_id == 9:
-        merged_data = merge_lobby(data, header, playerCarIndex)
+        if debug == True:
+            merged_columns.constants["checkpoint_3_payload_processed"] = time.time()
+
+        # rows are only built in the HEC stage, O11y reads the metric columns directly
+        if sinks_enabled["hec"]:
+            hec_stage.put(send_hec_columns, rig, merged_columns, packet_id)
+
+        if sinks_enabled["o11y"]:
+            o11y_stage.put(send_metric_pairs, rig, merged_columns.metrics(), packet_id)
+
+        if analytics_stage is not None and sinks_enabled["hec"] and packet_id in analytics_packets:
+            analytics_stage.put(analyse_rows, rig, packet_id, merged_columns, shard=rig.port)
+
+        if session_archive is not None and sinks_enabled["archive"]:
+            session_archive.add(rig, packet_id, merged_columns)
+
+        return
+
+    merged_data = merge_packet(rig, merge_plans[packet_id], data, header, playerCarIndex)
 
     merged_data = [entry for entry in merged_data if entry['name']!=""]
     # merged_data = merged_data[merged_data['name']!=""]
 
+    send_rows(rig, merged_data, packet_id)
+
+
+def handle_session_history(rig, data, packet_id):
+    header = data["header"]
+    send_rows(rig, merge_session_history(rig, data, header, header["player_car_index"]), packet_id)
+
+
+def send_rows(rig, merged_data, packet_id):
+    if not merged_data:
+        return
+
     if debug == True:
         for entry in merged_data:
             entry.update({"checkpoint_3_payload_processed": time.time()})
 
     # send data to HEC
-    if args["splunk"] == "yes":
-        send_hec_batch(merged_data, packet_id)
+    if sinks_enabled["hec"]:
+        hec_stage.put(send_hec_batch, rig, merged_data, packet_id)
 
     # send data to SIM
-    if args["o11y"] == "yes":
-        send_dims_and_metrics(merged_data)
+    if sinks_enabled["o11y"]:
+        o11y_stage.put(send_dims_and_metrics, rig, merged_data, packet_id)
+
+    # roll up laps and sectors
+    if analytics_stage is not None and sinks_enabled["hec"] and packet_id in analytics_packets:
+        analytics_stage.put(analyse_rows, rig, packet_id, merged_data, shard=rig.port)
+
+    # keep the session for post-race analysis
+    if session_archive is not None and sinks_enabled["archive"]:
+        session_archive.add(rig, packet_id, merged_data)
+
+
+packet_handlers = {
+    0: handle_cars,
+    1: handle_session,
+    2: handle_cars,
+    3: handle_event,
+    4: handle_participants,
+    5: handle_cars,
+    6: handle_cars,
+    7: handle_cars,
+    8: handle_cars,
+    9: handle_cars,
+    10: handle_cars,
+    11: handle_session_history,
+}
 
+# Packet ids with a handler that are not switched off, by the packet id byte of the header
+packet_wanted = [packet_id in packet_handlers and packet_enabled.get(packet_id, True) for packet_id in range(256)]
+
+
+# Runs on the raw datagram before anything is decoded: packet types that are switched off or
+# unknown are dropped, and in solo mode so is the session history of every other car. While load
+# shedding, only one in shed_thin_factor motion and telemetry packets is kept
+def wanted_packet(rig, packet):
+    packet_id = packet[5]
+    if not packet_wanted[packet_id]:
+        return False
+    if shed_level and packet_id in shed_thinned_packets:
+        rig.thin_count[packet_id] += 1
+        if rig.thin_count[packet_id] % shed_thin_factor:
+            rig.shed_by_id[packet_id] += 1
+            return False
+    if packet_id == 11 and rig.mode != "spectator" and (len(packet) <= 24 or packet[24] != packet[22]):
+        return False
+    return True
+
+
+# Participants and Session packets set the names and session the other packet types are merged with.
+# The decode stage is sharded by packet type, so besides the worker of their own type every other
+# decode worker applies them too, at the same point of its queue: rows of packets received after
+# them always see them, however far apart the workers are
+session_state_handlers = {1: update_session_info, 4: update_player_info}
+
+
+def apply_session_state(rig, data):
+    # replays queue the raw bytes with --decoder json too, see replay_packet
+    if decoder == "json" and not hasattr(data, "to_json"):
+        data = unpack_packet(data)
+        if data is None:
+            return
+    data = decode_data(rig, data)
+    if data is not None:
+        session_state_handlers[data["header"]["packet_id"]](rig, data)
 
 
+def decode_data(rig, data):
+    if decoder == "json":
+        dict_object = data.to_json()
+        return json.loads(dict_object)
+    return decode_packet(data, columnar=decoder == "numpy", solo=rig.mode != "spectator")
+
+
+# decode/merge stage
+def massage_data(rig, data):
+    data = decode_data(rig, data)
+    if data is None:
+        return
+
+    packet_id = data["header"]["packet_id"]
+
+    if debug == True:
+        data["header"].update({"checkpoint_1_data_received": time.time()})
+
+    handler = packet_handlers.get(packet_id)
+    if handler is None or not packet_enabled.get(packet_id, True):
+        return
+
+    handler(rig, data, packet_id)
+
+
+
+# Compare packets/sec of the json and struct decoders on synthetic packets of every type,
+# both starting from the raw UDP bytes and ending with flat per car rows
+def benchmark_decoder(iterations):
+    print("Decoder benchmark: " + str(iterations) + " packets per type")
+    json_total = 0.0
+    struct_total = 0.0
+
+    for key in sorted(HEADER_FIELD_TO_PACKET_TYPE, key=lambda key: key[2]):
+        packet_type = HEADER_FIELD_TO_PACKET_TYPE[key]
+        packet = packet_type()
+        packet.header.packet_format, packet.header.packet_version, packet.header.packet_id = key
+        buffer = bytes(packet)
+
+        plan = merge_plans.get(key[2])
+        if plan is not None and plan.scalar_keys is None:
+            plan.compile(json.loads(packet.to_json())[plan.rows_field][0])
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            data = json.loads(packet_type.unpack(buffer).to_json())
+            if plan is not None:
+                [plan.flatten(entry, i) for i, entry in enumerate(data[plan.rows_field])]
+        json_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            decode_packet(buffer)
+        struct_time = time.perf_counter() - start
+
+        json_total += json_time
+        struct_total += struct_time
+        print("{:<26} json {:>9.0f} pkt/s   struct {:>9.0f} pkt/s   x{:.1f}".format(
+            lookup_packet_id(key[2]), iterations / json_time, iterations / struct_time, json_time / struct_time))
+
+    packets = iterations * len(HEADER_FIELD_TO_PACKET_TYPE)
+    print("{:<26} json {:>9.0f} pkt/s   struct {:>9.0f} pkt/s   x{:.1f}".format(
+        "All packets", packets / json_total, packets / struct_total, json_total / struct_total))
+
+
+#########################################
+# Ingest benchmark
+# --benchmark drives synthetic packets of every type, or a --replay capture, through massage_data,
+# the HEC serialisation and O11y metric functions and the real HEC and SignalFx senders, posting to
+# fake servers on localhost that count and check what they receive. Each stage runs on its own so
+# its latency is measured separately, once in solo and once in spectator mode
+
+# Frames between synthetic packets of each type, roughly what the game sends at 60Hz. 0 is the first frame only
+synthetic_intervals = {0: 1, 1: 30, 2: 1, 3: 60, 4: 300, 5: 30, 6: 1, 7: 1, 8: 0, 9: 0, 10: 30, 11: 3}
+
+
+def synthetic_packet(key, frame):
+    packet = HEADER_FIELD_TO_PACKET_TYPE[key]()
+    header = packet.header
+    header.packet_format, header.packet_version, header.packet_id = key
+    header.game_major_version = 1
+    header.session_uid = 2022
+    header.session_time = frame / 60.0
+    header.frame_identifier = frame
+    header.secondary_player_car_index = 255
+
+    packet_id = key[2]
+    if packet_id == 2:
+        for car_index, car in enumerate(packet.lap_data):
+            car.current_lap_num = 1 + frame // 600
+            car.sector = frame // 200 % 3
+            car.car_position = car_index + 1
+            car.current_lap_time_in_ms = frame % 600 * 16
+    elif packet_id == 3:
+        packet.event_string_code[:] = list(b"SPTP")
+    elif packet_id == 4:
+        packet.num_active_cars = 20
+        for car_index in range(20):
+            packet.participants[car_index].name = b"Driver " + str(car_index).encode()
+            packet.participants[car_index].race_number = car_index + 1
+    elif packet_id == 6:
+        for car_index, car in enumerate(packet.car_telemetry_data):
+            car.speed = 200 + (frame + car_index) % 120
+            car.throttle = frame % 100 / 100
+            car.engine_rpm = 9000 + frame % 3000
+            car.gear = 1 + frame % 8
+    elif packet_id == 10:
+        for car in packet.car_damage_data:
+            car.tyres_wear[:] = [frame / 600.0] * 4
+    elif packet_id == 11:
+        # one car per packet, like the game cycling through the grid
+        packet.car_idx = frame // 3 % 20
+        packet.num_laps = 1 + frame // 600
+        packet.num_tyre_stints = 1
+        packet.tyre_stints_history_data[0].end_lap = 255
+        for lap_index in range(packet.num_laps - 1):
+            lap = packet.lap_history_data[lap_index]
+            lap.sector1_time_in_ms = lap.sector2_time_in_ms = lap.sector3_time_in_ms = 3200
+            lap.lap_time_in_ms = 9600
+
+    return bytes(packet)
+
+
+def synthetic_packets(frames):
+    packets = []
+    keys = sorted(HEADER_FIELD_TO_PACKET_TYPE, key=lambda key: key[2])
+    for frame in range(frames):
+        for key in keys:
+            interval = synthetic_intervals.get(key[2], 1)
+            if frame == 0 or (interval and frame % interval == 0):
+                packets.append(synthetic_packet(key, frame))
+    return packets
+
+
+# Stands in for Splunk HEC and SignalFx ingest: accepts every POST and counts posts, bytes,
+# events or datapoints, and the ones that are not well formed
+class FakeIngestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.count(self.path, body)
+
+        reply = b'{"text":"Success","code":0}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeIngestServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeIngestHandler)
+        self.url = "http://127.0.0.1:" + str(self.server_address[1])
+        self.lock = threading.Lock()
+        self.reset()
+        threading.Thread(target=self.serve_forever, name="fake-ingest", daemon=True).start()
+
+    def reset(self):
+        with self.lock:
+            self.posts = 0
+            self.bytes = 0
+            self.events = 0
+            self.invalid = 0
+
+    def count(self, path, body):
+        size = len(body)
+        try:
+            if body[:2] == b"\x1f\x8b":
+                body = gzip.decompress(body)
+            if path.startswith("/services/collector"):
+                events, invalid = self.count_hec(body.decode())
+            else:
+                events, invalid = self.count_datapoints(body)
+        except (ValueError, OSError):
+            events, invalid = 0, 1
+
+        with self.lock:
+            self.posts += 1
+            self.bytes += size
+            self.events += events
+            self.invalid += invalid
+
+    # HEC batches are JSON events back to back, each needs an event or indexed fields, a sourcetype and a host
+    def count_hec(self, body):
+        decoder = json.JSONDecoder()
+        events = 0
+        invalid = 0
+        end = 0
+        while True:
+            while end < len(body) and body[end].isspace():
+                end += 1
+            if end == len(body):
+                return events, invalid
+            event, end = decoder.raw_decode(body, end)
+            events += 1
+            content = event.get("fields", event.get("event"))
+            if not isinstance(content, dict) or "sourcetype" not in event or "host" not in event:
+                invalid += 1
+
+    # SignalFx datapoints, protobuf from the signalfx client or JSON from the asyncio engine
+    def count_datapoints(self, body):
+        if body[:1] == b"{":
+            datapoints = json.loads(body)["gauge"]
+            invalid = sum(1 for datapoint in datapoints if "metric" not in datapoint or "value" not in datapoint)
+            return len(datapoints), invalid
+
+        from signalfx.generated_protocol_buffers import signal_fx_protocol_buffers_pb2
+        try:
+            message = signal_fx_protocol_buffers_pb2.DataPointUploadMessage.FromString(body)
+        except Exception:
+            raise ValueError("not a DataPointUploadMessage")
+        invalid = sum(1 for datapoint in message.datapoints if not datapoint.metric)
+        return len(message.datapoints), invalid
+
+    def stats(self):
+        with self.lock:
+            return {"posts": self.posts, "bytes": self.bytes, "events": self.events, "invalid": self.invalid}
+
+
+# Collects put() calls and runs them on run(), so every stage is timed on its own
+class DeferredStage(InlineStage):
+    def __init__(self, name):
+        super().__init__(name)
+        self.run_times = collections.deque()
+        self.pending = []
+
+    def put(self, function, *args, shard=None, block=True):
+        self.pending.append((function, args))
+        return True
+
+    def run(self):
+        pending, self.pending = self.pending, []
+        for function, args in pending:
+            InlineStage.put(self, function, *args)
+
+
+# One pass of the packets for one rig through every stage and both senders
+def benchmark_pass(rig, packets, hec_server, o11y_server):
+    global decode_stage
+    global analytics_stage
+    global hec_stage
+    global o11y_stage
+    global hec_sender
+    global ingest
+
+    decode_stage = DeferredStage("massage_data")
+    analytics_stage = DeferredStage("analytics") if analytics and sinks_enabled["hec"] else None
+    hec_stage = DeferredStage("hec serialise") if sinks_enabled["hec"] else None
+    o11y_stage = DeferredStage("o11y metrics")
+    hec_sender = None if not sinks_enabled["hec"] else HecSender(
+        HecTransport(
+            session=sesh,
+            url=hec_server.url + "/services/collector",
+            token="benchmark",
+            gzip_level=hec_gzip_level,
+            max_retries=hec_max_retries,
+            backoff_ms=hec_retry_backoff_ms,
+            backoff_max_ms=hec_retry_backoff_max_ms,
+            timeout=hec_timeout,
+            spool_dir="",
+            spool_max_bytes=0,
+        ),
+        max_bytes=hec_batch_max_bytes,
+        max_latency_ms=hec_batch_max_latency_ms,
+        queue_size=hec_queue_size,
+        backpressure="block",
+        workers=hec_flush_workers,
+    )
+    ingest = signalfx_ingest(o11y_server.url, "benchmark")
+    open_o11y_sink()
+
+    started = time.perf_counter()
+    for packet in packets:
+        decode_stage.put(massage_data, rig, packet)
+        decode_stage.run()
+        if analytics_stage is not None:
+            analytics_stage.run()
+        if hec_stage is not None:
+            hec_stage.run()
+        o11y_stage.run()
+    processed = time.perf_counter()
+    # every flusher must still be running after the load, close() is what stops them
+    flushers_alive = sum(1 for worker in hec_sender.workers if worker.is_alive()) if hec_sender is not None else 0
+
+    if hec_sender is not None:
+        hec_sender.close()
+    o11y_sink.close()
+    ingest.stop()
+    drained = time.perf_counter()
+
+    return processed - started, drained - started, flushers_alive
+
+
+def run_benchmark(passes):
+    global args
+
+    if args["replay"]:
+        packets = [packet for _, packet in read_capture(args["replay"])] * passes
+        source = args["replay"]
+    else:
+        packets = synthetic_packets(passes)
+        source = "synthetic"
+    if decoder == "json":
+        # the receive loop parses the packet with unpack_packet, before massage_data
+        packets = [packet for packet in map(unpack_packet, packets) if packet is not None]
+
+    # O11y is always exercised, HEC unless --splunk no
+    args["o11y"] = "yes"
+    sinks_enabled["o11y"] = True
+    hec_server = FakeIngestServer()
+    o11y_server = FakeIngestServer()
+    print("Ingest benchmark: " + str(len(packets)) + " " + source + " packets, decoder " + decoder + ", HEC " + args["splunk"])
+    failed = False
+
+    for rig_mode in ("solo", "spectator"):
+        # tracemalloc slows everything down, so allocations are measured on a separate pass over the first packets
+        allocation_packets = packets[:500]
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        benchmark_pass(Rig(hostname, player_name, args["port"], rig_mode), allocation_packets, hec_server, o11y_server)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        hec_server.reset()
+        o11y_server.reset()
+
+        processed, drained, flushers_alive = benchmark_pass(Rig(hostname, player_name, args["port"], rig_mode), packets, hec_server, o11y_server)
+
+        print("{}: {:.0f} pkt/s through massage_data and serialisation, {:.0f} pkt/s including the senders".format(
+            rig_mode, len(packets) / processed, len(packets) / drained))
+        for stage in pipeline_stages():
+            stats = stage.stats()
+            print("  {:<14} {:>7} calls   p50 {:>7.3f} ms   p99 {:>7.3f} ms   errors {}".format(
+                stage.name, stats["done"], stats["run_p50_ms"], stats["run_p99_ms"], stats["errors"]))
+        if hec_sender is not None:
+            hec_stats = hec_sender.stats()
+            print("  {:<14} {:>7} posts   p50 {:>7.3f} ms   p99 {:>7.3f} ms   failed {}".format(
+                "hec post", hec_stats["posts"], hec_stats["post_p50_ms"], hec_stats["post_p99_ms"], hec_stats["failed"]))
+            print("  HEC flushers: {}/{} alive after the load".format(flushers_alive, len(hec_sender.workers)))
+            if flushers_alive != len(hec_sender.workers):
+                print("  ERROR: HEC flushers exited while the sender was running")
+                failed = True
+            print("  HEC server:  " + str(hec_server.stats()))
+        print("  O11y sink:   " + str(o11y_sink.stats()))
+        print("  O11y server: " + str(o11y_server.stats()))
+        print("  allocations over the first {} packets: peak {:.0f} KiB, retained {:.0f} KiB".format(
+            len(allocation_packets), (peak - baseline) / 1024, (retained - baseline) / 1024))
+        hec_server.reset()
+        o11y_server.reset()
+
+    if failed:
+        raise SystemExit(1)
+
+
+if args["benchmark_decoder"]:
+    benchmark_decoder(args["benchmark_decoder"])
+    raise SystemExit(0)
+
+if args["benchmark"]:
+    run_benchmark(args["benchmark"])
+    raise SystemExit(0)
 
 # Initialise session
 startup_payload = {
@@ -604,10 +3476,101 @@ startup_payload = {
     "checkpoint_1_data_received": datetime.now().timestamp()
     }
 
+rigs = configured_rigs()
+active_rigs = rigs
+for rig in rigs:
+    print("Rig " + rig.hostname + ": UDP Port " + str(rig.port) + ", Player " + rig.player_name + ", " + rig.mode)
+
+if engine == "asyncio":
+    # everything runs inline on the event loop
+    decode_stage = InlineStage("decode")
+    analytics_stage = InlineStage("analytics") if analytics and args["splunk"] == "yes" else None
+    hec_stage = InlineStage("hec") if args["splunk"] == "yes" else None
+    o11y_stage = InlineStage("o11y") if args["o11y"] == "yes" else None
+
+    start_stats_server()
+    start_profiling()
+    start_config_watch()
+    start_load_shedding()
+    try:
+        asyncio.run(run_asyncio(rigs))
+    except KeyboardInterrupt:
+        pass
+    raise SystemExit(0)
+
+# Fork the rig worker processes before any thread is started
+worker_processes = []
+if len(rigs) > 1 and rig_processes > 1:
+    context = multiprocessing.get_context("fork")
+    sink_queue = context.Queue(maxsize=stage_queue_size)
+    shards = min(rig_processes, len(rigs))
+    for shard in range(shards):
+        control_queue = context.Queue()
+        process = context.Process(
+            target=run_rig_process, args=(rigs[shard::shards], sink_queue, control_queue), name="rigs-" + str(shard), daemon=True
+        )
+        process.start()
+        worker_processes.append(process)
+        control_queues.append(control_queue)
+    # the rig workers receive on their own copies of the bound sockets
+    for sock in bound_sockets.values():
+        sock.close()
+    bound_sockets.clear()
+
 if args["splunk"] == "yes":
-    send_hec_batch([startup_payload], 99)
+    hec_sender = HecSender(
+        hec_transport(),
+        max_bytes=hec_batch_max_bytes,
+        max_latency_ms=hec_batch_max_latency_ms,
+        queue_size=hec_queue_size,
+        backpressure="block" if args["replay"] and args["replay_speed"] == 0 else hec_backpressure,
+        workers=hec_flush_workers,
+    )
+    for rig in rigs:
+        send_hec_batch(rig, [startup_payload], 99)
+
+start_stats_server()
+start_metrics_export()
+start_profiling()
+start_config_watch()
+start_load_shedding()
+
+replay_started = time.perf_counter()
+if args["replay"]:
+    replay_fed = run_replay(rigs[0], args["replay"], args["replay_speed"])
+elif worker_processes:
+    forwarders = [
+        threading.Thread(target=forward_from_rig_processes, args=(sink_queue,), name="forwarder-" + str(i), daemon=True)
+        for i in range(max(1, hec_workers))
+    ]
+    for forwarder in forwarders:
+        forwarder.start()
+    report_startup()
 
-listener = TelemetryListener(port=args["port"])
-while True:
-    packet = listener.get()
-    massage_data(packet)
+    try:
+        while any(process.is_alive() for process in worker_processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # let the rig workers drain their pipelines, Ctrl-C only reaches them when run from a terminal
+        for process in worker_processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in worker_processes:
+            process.join(timeout=30)
+        for forwarder in forwarders:
+            sink_queue.put(None)
+        for forwarder in forwarders:
+            forwarder.join()
+else:
+    run_rigs(rigs)
+
+if args["splunk"] == "yes":
+    hec_sender.close()
+    print("HEC sender: " + str(hec_sender.stats()))
+    print_spool_stats(hec_sender.transport)
+if args["o11y"] == "yes":
+    ingest.stop()
+if args["replay"]:
+    print_replay_stats(rigs[0], replay_started, replay_fed, time.perf_counter())
@@ -0,0 +1,2 @@
+# Parts of F1_2022_Conference_ingest.py that take their settings as arguments instead of reading the
+# script's globals, so they can be imported and tested without starting the ingest
@@ -0,0 +1,96 @@
+# Runtime control
+# The settings that can change while the script runs, how a change is validated and how they are
+# read from settings.ini. Applying them to the running script is left to its apply_config
+
+import configparser
+
+# command line option that starts each sink, only sinks started with it can be resumed
+sink_options = {"hec": "--splunk", "o11y": "--o11y", "archive": "--archive"}
+config_toggles = ("motion", "telemetry", "lap", "status", "damage", "history", "debug")
+config_intervals = ("o11y_window_ms", "metrics_interval", "stats_interval")
+# shown by GET /config but only read at startup: max_datapoints is also the batch size the signalfx
+# client was created with
+config_restart_only = ("o11y_max_datapoints",)
+# change detection thresholds as {"field": threshold, "heartbeat_ms": n}, {} when off
+config_deltas = ("hec_deltas", "o11y_deltas")
+
+
+# Thresholds and heartbeat of a [hec_deltas] or [o11y_deltas] section, ({}, 0) when there is none
+def delta_settings(settings, section):
+    if not settings.has_section(section):
+        return {}, 0
+    return (
+        {key: settings.getfloat(section, key) for key in settings.options(section) if key != "heartbeat_ms"},
+        settings.getint(section, "heartbeat_ms", fallback=1000),
+    )
+
+
+# Raises ValueError for anything that cannot be applied, before anything is. rig_hostnames are the
+# rigs of this process and started_sinks the sinks the script was started with
+def validate_config(changes, rig_hostnames, started_sinks):
+    for key, value in changes.items():
+        if key in config_toggles or key in sink_options:
+            if not isinstance(value, bool):
+                raise ValueError(key + " must be true or false")
+            if key in sink_options and value and key not in started_sinks:
+                raise ValueError(key + " was not started, restart with " + sink_options[key] + " yes")
+        elif key in config_intervals:
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise ValueError(key + " must be a whole number of 1 or more")
+        elif key in config_deltas:
+            if not isinstance(value, dict):
+                raise ValueError(key + " must be an object of field thresholds")
+            for field, threshold in value.items():
+                if field == "heartbeat_ms":
+                    if not isinstance(threshold, int) or isinstance(threshold, bool) or threshold < 1:
+                        raise ValueError(key + " heartbeat_ms must be a whole number of 1 or more")
+                elif not isinstance(threshold, (int, float)) or isinstance(threshold, bool) or threshold < 0:
+                    raise ValueError(key + " " + str(field) + " must be a number of 0 or more")
+        elif key in config_restart_only:
+            raise ValueError(key + " cannot be changed while running, restart the script")
+        elif key == "mode":
+            modes = value if isinstance(value, dict) else {rig_hostname: value for rig_hostname in rig_hostnames}
+            for rig_hostname, rig_mode in modes.items():
+                if rig_hostname not in rig_hostnames:
+                    raise ValueError("no rig " + str(rig_hostname))
+                if rig_mode not in ("spectator", "solo"):
+                    raise ValueError("mode must be spectator or solo, not " + str(rig_mode))
+        else:
+            raise ValueError("unknown setting " + str(key))
+
+
+# The runtime settings as the file has them now. With rigs the mode of every [rigs] line is read
+# too, default_mode where the line has none
+def file_config(path, rigs=False, default_mode="spectator"):
+    file_settings = configparser.ConfigParser()
+    if not file_settings.read(path):
+        raise ValueError(path + " not found")
+
+    settings = {key: file_settings.getboolean("telemetry_settings", key, fallback=True) for key in config_toggles if key != "debug"}
+    settings["debug"] = file_settings.getboolean("ingest_settings", "debug")
+    settings["o11y_window_ms"] = file_settings.getint("o11y_settings", "window_ms", fallback=200)
+    settings["metrics_interval"] = file_settings.getint("metrics_settings", "interval", fallback=10)
+    settings["stats_interval"] = file_settings.getint("pipeline_settings", "stats_interval", fallback=30)
+    for section in config_deltas:
+        thresholds, heartbeat_ms = delta_settings(file_settings, section)
+        settings[section] = dict(thresholds, heartbeat_ms=heartbeat_ms) if thresholds else {}
+    if rigs:
+        settings["mode"] = {}
+        for rig_hostname, value in file_settings.items("rigs"):
+            fields = [field.strip() for field in value.split(",")]
+            settings["mode"][rig_hostname] = fields[2] if len(fields) > 2 else default_mode
+    return settings
+
+
+# Only what changed in the file since it was last read is applied, so a change made through
+# POST /config stays until the same setting is changed in the file
+def changed_settings(before, after):
+    changes = {}
+    for key, value in after.items():
+        if key == "mode":
+            modes = {rig_hostname: rig_mode for rig_hostname, rig_mode in value.items() if before.get("mode", {}).get(rig_hostname) != rig_mode}
+            if modes:
+                changes["mode"] = modes
+        elif before.get(key) != value:
+            changes[key] = value
+    return changes
@@ -0,0 +1,315 @@
+#########################################
+# Packet decoders
+# Field tables are built once per packet id from the f1_22_telemetry ctypes definitions
+# and used to unpack the raw UDP bytes straight into flat rows, skipping the
+# to_json()/json.loads() round trip and the separate flatten pass. With columnar set, the
+# per car arrays are decoded into structured NumPy arrays instead, see ColumnLayout
+
+import ctypes
+import struct
+
+from f1_22_telemetry.packets import PacketHeader, HEADER_FIELD_TO_PACKET_TYPE
+
+# --decoder numpy hands the module over with use_numpy, so it is only imported when it is used
+numpy = None
+
+
+def use_numpy(module):
+    global numpy
+    numpy = module
+
+
+struct_codes = {
+    ctypes.c_uint8: "B",
+    ctypes.c_int8: "b",
+    ctypes.c_uint16: "H",
+    ctypes.c_int16: "h",
+    ctypes.c_uint32: "I",
+    ctypes.c_int32: "i",
+    ctypes.c_uint64: "Q",
+    ctypes.c_float: "f",
+    ctypes.c_double: "d",
+}
+
+
+# Precomputed table for one ctypes structure, unpacked into a flat dict in one call.
+# Arrays of scalars expand to name1..nameN, the same keys MergePlan.flatten produces
+class FieldTable:
+    def __init__(self, ctype):
+        fmt = "<"
+        self.keys = []
+        self.floats = []
+        self.strings = []
+
+        for name, field_type in ctype._fields_:
+            if field_type in struct_codes:
+                code = struct_codes[field_type]
+                if code in "fd":
+                    self.floats.append(len(self.keys))
+                self.keys.append(name)
+                fmt += code
+            elif issubclass(field_type, ctypes.Array) and field_type._type_ is ctypes.c_char:
+                self.strings.append(len(self.keys))
+                self.keys.append(name)
+                fmt += str(field_type._length_) + "s"
+            elif issubclass(field_type, ctypes.Array) and field_type._type_ in struct_codes:
+                # to_json() leaves array elements unrounded
+                for i in range(field_type._length_):
+                    self.keys.append(name + str(i + 1))
+                fmt += str(field_type._length_) + struct_codes[field_type._type_]
+            else:
+                raise TypeError("Cannot build a field table for " + ctype.__name__ + "." + name)
+
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+    # Values are rounded and decoded the same way as PacketMixin.to_json()
+    def row(self, values):
+        values = list(values)
+        for i in self.floats:
+            values[i] = round(values[i], 3)
+        for i in self.strings:
+            values[i] = values[i].split(b"\x00", 1)[0].decode("utf-8", "replace")
+        return dict(zip(self.keys, values))
+
+    def unpack(self, buffer, offset=0):
+        return self.row(self.struct.unpack_from(buffer, offset))
+
+    # Unpack an array of count structures into rows tagged with car_index
+    def unpack_rows(self, buffer, offset, count):
+        rows = []
+        for car_index, values in enumerate(self.struct.iter_unpack(buffer[offset:offset + self.size * count])):
+            row = self.row(values)
+            row["car_index"] = car_index
+            rows.append(row)
+        return rows
+
+    # Unpack only the structure of one car, the other slots are None
+    def unpack_car(self, buffer, offset, count, car_index):
+        rows = [None] * count
+        if car_index < count:
+            row = self.unpack(buffer, offset + self.size * car_index)
+            row["car_index"] = car_index
+            rows[car_index] = row
+        return rows
+
+
+numpy_codes = {
+    ctypes.c_uint8: "<u1",
+    ctypes.c_int8: "<i1",
+    ctypes.c_uint16: "<u2",
+    ctypes.c_int16: "<i2",
+    ctypes.c_uint32: "<u4",
+    ctypes.c_int32: "<i4",
+    ctypes.c_uint64: "<u8",
+    ctypes.c_float: "<f4",
+    ctypes.c_double: "<f8",
+}
+
+
+numpy_dtypes = {}
+
+
+# Structured NumPy dtype with the same packed layout as the ctypes structure, built once per structure
+def numpy_dtype(ctype):
+    if ctype in numpy_dtypes:
+        return numpy_dtypes[ctype]
+
+    names = []
+    formats = []
+    offsets = []
+
+    for name, field_type in ctype._fields_:
+        if field_type in numpy_codes:
+            formats.append(numpy_codes[field_type])
+        elif issubclass(field_type, ctypes.Array) and field_type._type_ is ctypes.c_char:
+            formats.append("S" + str(field_type._length_))
+        elif issubclass(field_type, ctypes.Array) and field_type._type_ in numpy_codes:
+            formats.append((numpy_codes[field_type._type_], (field_type._length_,)))
+        else:
+            raise TypeError("Cannot build a NumPy dtype for " + ctype.__name__ + "." + name)
+        names.append(name)
+        offsets.append(getattr(ctype, name).offset)
+
+    dtype = numpy_dtypes[ctype] = numpy.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": ctypes.sizeof(ctype)})
+    return dtype
+
+
+# Precomputed decode plan for one packet type: where each root field lives and how to read it
+class PacketTable:
+    def __init__(self, packet_type):
+        self.packet_type = packet_type
+        self.fields = []
+        # the per car array merged by the packet's MergePlan, see solo_fields
+        self.car_field = None
+
+        for name, field_type in packet_type._fields_:
+            offset = getattr(packet_type, name).offset
+            if field_type is PacketHeader:
+                self.fields.append((name, "struct", offset, FieldTable(PacketHeader)))
+            elif field_type in struct_codes:
+                code = struct_codes[field_type]
+                self.fields.append((name, "float" if code in "fd" else "scalar", offset, struct.Struct("<" + code)))
+            elif issubclass(field_type, ctypes.Array) and field_type._type_ in struct_codes:
+                fmt = struct.Struct("<" + str(field_type._length_) + struct_codes[field_type._type_])
+                self.fields.append((name, "list", offset, fmt))
+            elif issubclass(field_type, ctypes.Array) and issubclass(field_type._type_, ctypes.Structure):
+                self.fields.append((name, "rows", offset, (FieldTable(field_type._type_), field_type._length_, field_type._type_)))
+            else:
+                # unions such as the event details are rare, let ctypes format them
+                self.fields.append((name, "ctypes", offset, None))
+
+    # columnar decodes arrays of structures into NumPy structured arrays instead of rows. solo only
+    # unpacks the player car's row of the per car array, from player_car_index in the header
+    def decode(self, buffer, columnar=False, solo=False):
+        data = {}
+        packet = None
+
+        for name, kind, offset, table in self.fields:
+            if kind == "struct":
+                data[name] = table.unpack(buffer, offset)
+            elif kind == "scalar":
+                data[name] = table.unpack_from(buffer, offset)[0]
+            elif kind == "float":
+                data[name] = round(table.unpack_from(buffer, offset)[0], 3)
+            elif kind == "list":
+                data[name] = list(table.unpack_from(buffer, offset))
+            elif kind == "rows":
+                if columnar:
+                    data[name] = numpy.frombuffer(buffer, dtype=numpy_dtype(table[2]), count=table[1], offset=offset)
+                elif solo and name == self.car_field:
+                    data[name] = table[0].unpack_car(buffer, offset, table[1], buffer[22])
+                else:
+                    data[name] = table[0].unpack_rows(buffer, offset, table[1])
+            else:
+                if packet is None:
+                    packet = self.packet_type.from_buffer_copy(buffer)
+                data[name] = packet.get_value(name)
+
+        return data
+
+
+packet_tables = {key: PacketTable(packet_type) for key, packet_type in HEADER_FIELD_TO_PACKET_TYPE.items()}
+header_struct = struct.Struct("<HBBBB")
+
+
+# Parse raw UDP bytes into the f1_22_telemetry ctypes packet, as TelemetryListener.get() does
+def unpack_packet(buffer):
+    header = PacketHeader.from_buffer_copy(buffer)
+    packet_type = HEADER_FIELD_TO_PACKET_TYPE.get((header.packet_format, header.packet_version, header.packet_id))
+    if packet_type is None:
+        return None
+
+    return packet_type.unpack(buffer)
+
+
+# Decode raw UDP bytes into the same shape as json.loads(packet.to_json()), with per car arrays already flattened
+def decode_packet(buffer, columnar=False, solo=False):
+    packet_format, _, _, packet_version, packet_id = header_struct.unpack_from(buffer)
+    table = packet_tables.get((packet_format, packet_version, packet_id))
+    if table is None:
+        return None
+
+    return table.decode(memoryview(buffer), columnar, solo)
+
+
+# Name of each packet id, used as the HEC sourcetype. 99 and 100 are the events the script makes itself
+def lookup_packet_id(packet_id):
+    dict = {
+        0: "MotionData",
+        1: "SessionData",
+        2: "LapData",
+        3: "EventData",
+        4: "ParticipantsData",
+        5: "CarSetupData",
+        6: "CarTelemetryData",
+        7: "CarStatusData",
+        8: "FinalClassificationData",
+        9: "LobbyInfoData",
+        10: "CarDamageData",
+        11: "SessionHistoryData",
+        99: "ScriptStartup",
+        100: "LapAnalytics",
+    }
+    return dict[packet_id]
+
+
+#########################################
+# Columns of the structured arrays decoded for --decoder numpy
+
+# numpy.arange(n) by n, built once: arange lets go of the GIL while it fills the array, and getting it back
+# can take tens of milliseconds behind a sender thread serialising a batch
+car_ranges = {}
+
+
+def car_range(count):
+    indices = car_ranges.get(count)
+    if indices is None:
+        indices = numpy.arange(count)
+        indices.flags.writeable = False
+        car_ranges[count] = indices
+    return indices
+
+
+# Flat layout of a structured dtype: per tyre arrays become name1..nameN columns at their own
+# offsets, so a selection of cars turns into value tuples with a single tolist() call
+class ColumnLayout:
+    def __init__(self, dtype):
+        names = []
+        formats = []
+        offsets = []
+        out_formats = []
+        self.rounded = []
+        self.strings = []
+
+        for name in dtype.names:
+            field_dtype, offset = dtype.fields[name][:2]
+            if field_dtype.subdtype is not None:
+                base, shape = field_dtype.subdtype
+                for i in range(shape[0]):
+                    names.append(name + str(i + 1))
+                    formats.append(base)
+                    offsets.append(offset + i * base.itemsize)
+                    # to_json() leaves array elements unrounded
+                    out_formats.append(base)
+            else:
+                if field_dtype.kind == "f":
+                    self.rounded.append(name)
+                    out_formats.append(numpy.float64)
+                else:
+                    if field_dtype.kind == "S":
+                        self.strings.append(len(names))
+                    out_formats.append(field_dtype)
+                names.append(name)
+                formats.append(field_dtype)
+                offsets.append(offset)
+
+        self.keys = names
+        self.flat = numpy.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": dtype.itemsize})
+        self.out = numpy.dtype({"names": names, "formats": out_formats})
+
+    # Value tuples for the selected cars, floats rounded the same way as to_json()
+    def values(self, cars, indices):
+        selected = cars[indices].view(self.flat).astype(self.out)
+        for name in self.rounded:
+            selected[name] = numpy.round(selected[name], 3)
+
+        values = selected.tolist()
+        if self.strings:
+            values = [self.decode_strings(row) for row in values]
+        return values
+
+    def decode_strings(self, row):
+        row = list(row)
+        for i in self.strings:
+            row[i] = row[i].split(b"\x00", 1)[0].decode("utf-8", "replace")
+        return tuple(row)
+
+
+column_layouts = {}
+
+
+def column_layout(dtype):
+    if dtype not in column_layouts:
+        column_layouts[dtype] = ColumnLayout(dtype)
+    return column_layouts[dtype]
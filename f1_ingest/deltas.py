@@ -0,0 +1,120 @@
+# Change detection
+# Fields listed in [hec_deltas] or [o11y_deltas] are only sent to that sink when they have moved
+# more than their threshold since the value last sent for the same car, or when heartbeat_ms has
+# passed without sending them. A key is a field name, optionally prefixed with a packet type such
+# as CarTelemetryData.gear, and may use * wildcards
+
+import fnmatch
+import threading
+import time
+
+from f1_ingest.decoders import lookup_packet_id
+
+# detect_lap_events reads these, a threshold can never hide a new lap or sector
+delta_lap_fields = ("current_lap_num", "sector")
+
+
+class DeltaFilter:
+    def __init__(self, thresholds, heartbeat_ms, context_fields):
+        # (packet name or None, field pattern, threshold), packet specific keys first. configparser
+        # hands the keys over lowercased, packet names are matched that way whatever the caller passes
+        self.patterns = []
+        for key, threshold in thresholds.items():
+            packet_name, _, pattern = key.rpartition(".")
+            self.patterns.append((packet_name.lower() or None, pattern, threshold))
+        self.patterns.sort(key=lambda entry: entry[0] is None)
+
+        self.heartbeat = heartbeat_ms / 1000.0
+        # fields that identify a row rather than measure anything, never filtered
+        self.context_fields = context_fields
+        # (packet id, field) -> threshold, None when the field is always sent
+        self.thresholds = {}
+        # (packet id, car, field) -> (value, time sent)
+        self.last = {}
+        self.lock = threading.Lock()
+
+        # counters
+        self.kept = 0
+        self.suppressed = 0
+        self.dropped_rows = 0
+
+    def threshold(self, packet_id, field):
+        key = (packet_id, field)
+        if key not in self.thresholds:
+            threshold = None
+            if field not in self.context_fields and not field.startswith("checkpoint_"):
+                packet_name = lookup_packet_id(packet_id).lower()
+                for pattern_packet, pattern, value in self.patterns:
+                    if pattern_packet in (None, packet_name) and fnmatch.fnmatchcase(field, pattern):
+                        threshold = 0 if field in delta_lap_fields else value
+                        break
+            self.thresholds[key] = threshold
+        return self.thresholds[key]
+
+    # Fields of values that have not moved, and how many measured fields are left to send
+    def unchanged(self, packet_id, car, values, now, force):
+        suppressed = []
+        left = 0
+        for field, value in values.items():
+            threshold = self.threshold(packet_id, field)
+            if threshold is None:
+                if field not in self.context_fields and not field.startswith("checkpoint_"):
+                    left += 1
+                continue
+
+            key = (packet_id, car, field)
+            last = self.last.get(key)
+            if force or last is None or now - last[1] >= self.heartbeat or moved(value, last[0], threshold):
+                self.last[key] = (value, now)
+                self.kept += 1
+                left += 1
+            else:
+                suppressed.append(field)
+                self.suppressed += 1
+        return suppressed, left
+
+    # Rows and pairs are shared with the other sink stages, so filtered ones are copies
+    @staticmethod
+    def without(values, suppressed):
+        if not suppressed:
+            return values
+        suppressed = set(suppressed)
+        return {key: value for key, value in values.items() if key not in suppressed}
+
+    # HEC rows of one packet
+    def filter_rows(self, packet_id, rows):
+        now = time.monotonic()
+        kept = []
+        with self.lock:
+            for row in rows:
+                force = row.get("lap_event", "none") != "none"
+                suppressed, left = self.unchanged(packet_id, row.get("car_index"), row, now, force)
+                if left or force:
+                    kept.append(self.without(row, suppressed))
+                else:
+                    self.dropped_rows += 1
+        return kept
+
+    # O11y (metrics, dimensions) pairs of one packet, cars told apart by their dimensions
+    def filter_pairs(self, packet_id, pairs):
+        now = time.monotonic()
+        kept = []
+        with self.lock:
+            for f1_metrics, f1_dimensions in pairs:
+                suppressed, left = self.unchanged(packet_id, tuple(f1_dimensions.items()), f1_metrics, now, False)
+                if left:
+                    kept.append((self.without(f1_metrics, suppressed), f1_dimensions))
+                else:
+                    self.dropped_rows += 1
+        return kept
+
+    def stats(self):
+        with self.lock:
+            return {"kept": self.kept, "suppressed": self.suppressed, "dropped_rows": self.dropped_rows}
+
+
+def moved(value, last, threshold):
+    try:
+        return abs(value - last) > threshold
+    except TypeError:
+        return value != last
@@ -0,0 +1,146 @@
+#########################################
+# Self metrics
+# Counters, latency histograms and sampled gauges about the forwarder itself, shared by the
+# script and the sinks. The script exports them to O11y Cloud and serves them on /stats
+
+import bisect
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in ms, the last bucket is unbounded
+histogram_bounds_ms = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(histogram_bounds_ms) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.buckets[bisect.bisect_left(histogram_bounds_ms, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    # Upper bound of the bucket holding the quantile, the largest value seen for the last bucket
+    def quantile(self, fraction):
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(histogram_bounds_ms, self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.5), 3),
+            "p99_ms": round(self.quantile(0.99), 3),
+            "max_ms": round(self.max, 3),
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, dimensions) -> value, Histogram or function
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        # the main process, or the rig worker process exporting them
+        self.process = "main"
+        # the --hostname of the script, on every exported datapoint
+        self.hostname = None
+
+    @staticmethod
+    def key(name, dimensions):
+        return name, tuple(sorted((key, str(value)) for key, value in dimensions.items()))
+
+    def incr(self, name, value=1, **dimensions):
+        key = self.key(name, dimensions)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **dimensions):
+        key = self.key(name, dimensions)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds * 1000)
+
+    # function() is called for the current value every time the metrics are read
+    def gauge(self, name, function, **dimensions):
+        with self.lock:
+            self.gauges[self.key(name, dimensions)] = function
+
+    def read_gauges(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+        values = []
+        for key, function in gauges:
+            try:
+                values.append((key, function()))
+            except Exception:
+                pass
+        return values
+
+    def snapshot(self):
+        with self.lock:
+            counters = [(key, value) for key, value in self.counters.items()]
+            histograms = [(key, histogram.summary()) for key, histogram in self.histograms.items()]
+        return {
+            "process": self.process,
+            "counters": [{"metric": name, "dimensions": dict(dimensions), "value": value} for (name, dimensions), value in counters],
+            "histograms": [dict(summary, metric=name, dimensions=dict(dimensions)) for (name, dimensions), summary in histograms],
+            "gauges": [{"metric": name, "dimensions": dict(dimensions), "value": value} for (name, dimensions), value in self.read_gauges()],
+        }
+
+    # Everything as SignalFx gauges. Counters are running totals, histograms cover the time since the
+    # last export and start again empty
+    def datapoints(self):
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = list(self.histograms.items())
+            self.histograms = {}
+
+        common = {"f1-2022-hostname": self.hostname, "ingest-process": self.process}
+        datapoints = []
+
+        def add(name, dimensions, value):
+            datapoint_dimensions = dict(dimensions)
+            datapoint_dimensions.update(common)
+            datapoints.append({"metric": "f1_2022.ingest." + name, "value": value, "dimensions": datapoint_dimensions})
+
+        for (name, dimensions), value in counters:
+            add(name, dimensions, value)
+        for (name, dimensions), histogram in histograms:
+            for field, value in histogram.summary().items():
+                add(name + "." + field, dimensions, value)
+        for (name, dimensions), value in self.read_gauges():
+            add(name, dimensions, value)
+
+        return datapoints
+
+
+metrics = MetricsRegistry()
+
+
+# The value at fraction of the way through the sorted values, 0.0 when there are none
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+# Median in ms of the (finished, seconds) POSTs that finished in the last window_s, so a sink that has
+# gone quiet after a slow spell does not keep the shedding level up
+def recent_post_ms(recent_posts, window_s):
+    now = time.monotonic()
+    return percentile([seconds for finished, seconds in list(recent_posts) if now - finished <= window_s], 0.5) * 1000
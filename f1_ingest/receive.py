@@ -0,0 +1,66 @@
+# Packet loss
+# Packets the game sent that never arrived are counted per packet id from the session time and
+# frame in the header of the raw datagrams, before anything is decoded
+
+import collections
+import struct
+
+from f1_22_telemetry.packets import PacketHeader
+
+# Packet ids the game sends at a steady rate: motion, session, lap, car setups, telemetry, status and damage
+loss_tracked_packets = tuple(packet_id in (0, 1, 2, 5, 6, 7, 10) for packet_id in range(16))
+# anything shorter is not a game packet
+packet_header_size = PacketHeader.size()
+# session_uid, session_time and frame_identifier
+header_timing = struct.Struct("<QfI")
+# a longer gap is the game pausing or loading, not loss
+loss_max_gap_s = 5.0
+
+
+# The interval of each packet id is learned as the median gap in session time between packets, a
+# gap of n intervals means n - 1 packets were lost. A packet older than the last one is late. A new
+# session, a flashback or a pause starts the tracking again
+class PacketLoss:
+    def __init__(self):
+        self.lost = [0] * 16
+        self.late = [0] * 16
+        self.session_uid = None
+        self.reset()
+
+    def reset(self):
+        self.last_time = [None] * 16
+        self.last_frame = [0] * 16
+        self.gaps = [collections.deque(maxlen=32) for _ in range(16)]
+        self.interval = [0.0] * 16
+
+    def check(self, packet):
+        packet_id = packet[5] & 15
+        if not loss_tracked_packets[packet_id] or len(packet) < packet_header_size:
+            return
+
+        session_uid, session_time, frame = header_timing.unpack_from(packet, 6)
+        if session_uid != self.session_uid:
+            self.session_uid = session_uid
+            self.reset()
+
+        last_time = self.last_time[packet_id]
+        gap = session_time - last_time if last_time is not None else 0.0
+        if last_time is not None and frame < self.last_frame[packet_id] and -1.0 < gap <= 0:
+            self.late[packet_id] += 1
+            return
+
+        self.last_time[packet_id] = session_time
+        self.last_frame[packet_id] = frame
+        if gap <= 0 or gap > loss_max_gap_s:
+            return
+
+        gaps = self.gaps[packet_id]
+        gaps.append(gap)
+        if len(gaps) < 8:
+            return
+        if not self.interval[packet_id] or frame % 32 == 0:
+            self.interval[packet_id] = sorted(gaps)[len(gaps) // 2]
+
+        missing = int(gap / self.interval[packet_id] + 0.5) - 1
+        if missing > 0:
+            self.lost[packet_id] += missing
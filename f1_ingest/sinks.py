@@ -0,0 +1,559 @@
+# Splunk HEC and O11y sinks, the batching, retries and spool between the pipeline and the
+# ingest endpoints. requests and aiohttp are imported by the script only for the sinks and
+# engine that use them and handed over with use_http
+
+import asyncio
+import collections
+import gzip
+import itertools
+import os
+import random
+import threading
+import time
+
+from f1_ingest.metrics import metrics, percentile, recent_post_ms
+
+requests = None
+aiohttp = None
+
+
+def use_http(requests_module, aiohttp_module):
+    global requests, aiohttp
+    requests = requests_module
+    aiohttp = aiohttp_module
+
+
+#########################################
+# Splunk HEC transport
+# Batch bodies are gzip compressed and posted over the pooled connections of the session. Failed posts are
+# retried with exponential backoff; when HEC stays unreachable the compressed batch is written to
+# a bounded on-disk spool, and the spool is drained in order once HEC answers again
+
+# Connection errors, timeouts, 429 and 5xx are worth retrying, other HTTP errors are not
+def retryable(err):
+    status = None
+    if requests is not None and isinstance(err, requests.exceptions.HTTPError) and err.response is not None:
+        status = err.response.status_code
+    elif aiohttp is not None and isinstance(err, aiohttp.ClientResponseError):
+        status = err.status
+    return status is None or status == 429 or status >= 500
+
+
+class HecTransport:
+    def __init__(self, session, url, token, gzip_level, max_retries, backoff_ms, backoff_max_ms, timeout, spool_dir, spool_max_bytes):
+        self.session = session
+        self.url = url
+        self.header = {"Authorization": "Splunk " + token}
+        self.gzip_header = {"Authorization": "Splunk " + token, "Content-Encoding": "gzip"}
+        self.gzip_level = gzip_level
+        self.max_retries = max_retries
+        self.backoff = backoff_ms / 1000.0
+        self.backoff_max = backoff_max_ms / 1000.0
+        self.timeout = timeout
+        self.spool = HecSpool(spool_dir, spool_max_bytes, self) if spool_dir else None
+
+    def encode(self, batch):
+        payload = b"".join(batch)
+        if self.gzip_level:
+            return gzip.compress(payload, compresslevel=self.gzip_level), True
+        return payload, False
+
+    def post(self, payload, compressed):
+        try:
+            response = self.session.post(
+                url=self.url, data=payload, headers=self.gzip_header if compressed else self.header, verify=False, timeout=self.timeout
+            )
+        except requests.exceptions.RequestException:
+            metrics.incr("hec.responses", status="error")
+            raise
+        metrics.incr("hec.responses", status=response.status_code)
+        response.raise_for_status()
+
+    # Exponential backoff with jitter
+    def delay(self, attempt):
+        return min(self.backoff_max, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    # Post a batch of serialised events, returns "sent", "spooled" or "failed"
+    def send(self, batch):
+        payload, compressed = self.encode(batch)
+        if self.spool is not None and self.spool.offline:
+            # keep the spool in order and the flushers moving while HEC is down
+            return self.spool_or_fail(payload, compressed, len(batch))
+
+        for attempt in itertools.count():
+            try:
+                self.post(payload, compressed)
+                return "sent"
+            except requests.exceptions.RequestException as err:
+                error = err
+                if attempt >= self.max_retries or not retryable(err):
+                    break
+                metrics.incr("hec.retries")
+                time.sleep(self.delay(attempt))
+
+        print(error)
+        if not retryable(error):
+            print("HEC batch lost: " + str(len(batch)) + " events")
+            return "failed"
+        return self.spool_or_fail(payload, compressed, len(batch))
+
+    async def send_async(self, session, batch):
+        payload, compressed = self.encode(batch)
+        if self.spool is not None and self.spool.offline:
+            return self.spool_or_fail(payload, compressed, len(batch))
+
+        for attempt in itertools.count():
+            try:
+                async with session.post(
+                    self.url,
+                    data=payload,
+                    headers=self.gzip_header if compressed else self.header,
+                    ssl=False,
+                    timeout=aiohttp.ClientTimeout(total=self.timeout),
+                ) as response:
+                    metrics.incr("hec.responses", status=response.status)
+                    response.raise_for_status()
+                return "sent"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                error = err
+                if not isinstance(err, aiohttp.ClientResponseError):
+                    metrics.incr("hec.responses", status="error")
+                if attempt >= self.max_retries or not retryable(err):
+                    break
+                metrics.incr("hec.retries")
+                await asyncio.sleep(self.delay(attempt))
+
+        print(repr(error))
+        if not retryable(error):
+            print("HEC batch lost: " + str(len(batch)) + " events")
+            return "failed"
+        return self.spool_or_fail(payload, compressed, len(batch))
+
+    def spool_or_fail(self, payload, compressed, events):
+        if self.spool is not None and self.spool.write(payload, compressed, events):
+            return "spooled"
+        print("HEC batch lost: " + str(events) + " events")
+        return "failed"
+
+
+# Compressed batches waiting for HEC, one file per batch named <sequence>-<events>.hec[.gz].
+# Files left over from a previous run are sent first. When the spool is over max_bytes the
+# oldest batches are dropped
+class HecSpool:
+    def __init__(self, directory, max_bytes, transport):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.transport = transport
+
+        self.files = collections.deque()
+        self.bytes = 0
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+
+        # counters
+        self.spooled = 0
+        self.drained = 0
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if ".hec" not in name or name.endswith(".tmp"):
+                continue
+            sequence, events = name.split(".")[0].split("-")
+            size = os.path.getsize(os.path.join(directory, name))
+            self.files.append((name, size, int(events)))
+            self.bytes += size
+            self.sequence = max(self.sequence, int(sequence))
+
+        metrics.gauge("hec.spool_batches", lambda: len(self.files))
+        metrics.gauge("hec.spool_dropped", lambda: self.dropped)
+
+        # while anything is spooled new batches are spooled behind it
+        self.offline = bool(self.files)
+        if self.files:
+            print("HEC spool: " + str(len(self.files)) + " batches left from the last run")
+
+        threading.Thread(target=self.drain_loop, name="hec-spool", daemon=True).start()
+
+    def write(self, payload, compressed, events):
+        if len(payload) > self.max_bytes:
+            return False
+
+        with self.lock:
+            self.sequence += 1
+            name = "%016d-%d.hec" % (self.sequence, events) + (".gz" if compressed else "")
+            path = os.path.join(self.directory, name)
+            with open(path + ".tmp", "wb") as spool_file:
+                spool_file.write(payload)
+            os.replace(path + ".tmp", path)
+
+            if not self.offline:
+                print("HEC unreachable, spooling to " + self.directory)
+            self.offline = True
+            self.files.append((name, len(payload), events))
+            self.bytes += len(payload)
+            self.spooled += events
+
+            while self.bytes > self.max_bytes and len(self.files) > 1:
+                self.remove(self.files.popleft())
+
+            self.not_empty.notify()
+        return True
+
+    def remove(self, spooled_file):
+        name, size, events = spooled_file
+        self.bytes -= size
+        self.dropped += events
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def drain_loop(self):
+        attempt = 0
+        while True:
+            with self.lock:
+                while not self.files:
+                    self.not_empty.wait()
+                name, size, events = self.files[0]
+
+            try:
+                with open(os.path.join(self.directory, name), "rb") as spool_file:
+                    payload = spool_file.read()
+                self.transport.post(payload, name.endswith(".gz"))
+                sent = True
+            except FileNotFoundError:
+                sent = False
+            except requests.exceptions.RequestException as err:
+                if retryable(err):
+                    time.sleep(self.transport.delay(attempt))
+                    attempt = min(attempt + 1, 16)
+                    continue
+                print("HEC rejected spooled batch " + name + ": " + str(err))
+                sent = False
+
+            attempt = 0
+            with self.lock:
+                if self.files and self.files[0][0] == name:
+                    self.remove(self.files.popleft())
+                    if sent:
+                        self.dropped -= events
+                        self.drained += events
+                if not self.files:
+                    self.offline = False
+                    print("HEC reachable again, spool drained")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "batches": len(self.files),
+                "bytes": self.bytes,
+                "spooled": self.spooled,
+                "drained": self.drained,
+                "dropped": self.dropped,
+            }
+
+
+#########################################
+# Splunk HEC batching sender
+# Events from every packet type are queued here and coalesced into a single POST
+# to /services/collector, flushed when either the byte limit or the max latency
+# is reached, whichever comes first
+class HecSender:
+    def __init__(self, transport, max_bytes, max_latency_ms, queue_size, backpressure, workers):
+        if backpressure not in ("drop-oldest", "block"):
+            raise ValueError("hec_settings backpressure must be drop-oldest or block, not " + backpressure)
+
+        self.transport = transport
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency_ms / 1000.0
+        self.queue_size = queue_size
+        self.backpressure = backpressure
+
+        self.queue = collections.deque()
+        # when each queued event was put, for the latency deadline of the oldest one
+        self.queued_at = collections.deque()
+        self.queued_bytes = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.running = True
+
+        # counters and the most recent POST latencies in seconds
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.spooled = 0
+        self.posts = 0
+        self.post_times = collections.deque(maxlen=1024)
+        # (finished, seconds) of the last few POSTs, see recent_post_ms
+        self.recent_posts = collections.deque(maxlen=16)
+        metrics.gauge("hec.queue_depth", lambda: len(self.queue))
+
+        self.workers = [
+            threading.Thread(target=self.flush_loop, name="hec-flusher-" + str(i), daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    # Queue one serialised HEC event
+    def put(self, event):
+        self.put_many([event])
+
+    def put_many(self, events):
+        with self.lock:
+            was_empty = not self.queue
+            now = time.monotonic()
+            for event in events:
+                if len(self.queue) >= self.queue_size:
+                    if self.backpressure == "block":
+                        while len(self.queue) >= self.queue_size and self.running:
+                            self.not_full.wait()
+                    else:
+                        self.queued_bytes -= len(self.queue.popleft())
+                        self.queued_at.popleft()
+                        self.dropped += 1
+                        metrics.incr("hec.events", result="dropped")
+
+                self.queue.append(event)
+                self.queued_at.append(now)
+                self.queued_bytes += len(event)
+
+            # a flusher waiting on an empty queue starts the latency deadline, a full batch goes at once
+            if (was_empty and self.queue) or self.queued_bytes >= self.max_bytes:
+                self.not_empty.notify()
+
+    # Take up to max_bytes of events off the queue once a flush is due
+    def next_batch(self):
+        with self.lock:
+            while not self.queue and self.running:
+                self.not_empty.wait()
+
+            while self.running and self.queue and self.queued_bytes < self.max_bytes:
+                deadline = self.queued_at[0] + self.max_latency
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.not_empty.wait(remaining)
+
+            batch = []
+            batch_bytes = 0
+            while self.queue and (batch_bytes < self.max_bytes or not batch):
+                event = self.queue.popleft()
+                self.queued_at.popleft()
+                batch_bytes += len(event)
+                batch.append(event)
+
+            # what is left keeps the put times of its events, so its deadline does not start again
+            self.queued_bytes -= batch_bytes
+            self.not_full.notify_all()
+            # hand what is left to another flusher
+            if self.queue:
+                self.not_empty.notify()
+
+            return batch
+
+    def flush_loop(self):
+        while True:
+            batch = self.next_batch()
+            if batch:
+                self.post(batch)
+                continue
+            # another flusher took the batch, stop only once close() has drained the queue
+            with self.lock:
+                if not self.running and not self.queue:
+                    return
+
+    def post(self, batch):
+        started = time.perf_counter()
+        result = self.transport.send(batch)
+        metrics.incr("hec.events", len(batch), result=result)
+        metrics.observe("hec.post", time.perf_counter() - started)
+        with self.lock:
+            self.recent_posts.append((time.monotonic(), time.perf_counter() - started))
+            if result == "sent":
+                self.flushed += len(batch)
+                self.posts += 1
+                self.post_times.append(time.perf_counter() - started)
+            elif result == "spooled":
+                self.spooled += len(batch)
+            else:
+                self.failed += len(batch)
+
+    def stats(self):
+        with self.lock:
+            post_times = list(self.post_times)
+            stats = {
+                "queued": len(self.queue),
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "spooled": self.spooled,
+                "posts": self.posts,
+            }
+
+        stats["post_p50_ms"] = round(percentile(post_times, 0.5) * 1000, 2)
+        stats["post_p99_ms"] = round(percentile(post_times, 0.99) * 1000, 2)
+        return stats
+
+    # For load shedding: fraction of the queue in use and the median of the latest POSTs
+    def backlog(self):
+        return len(self.queue) / self.queue_size
+
+    def recent_post_ms(self, window_s):
+        with self.lock:
+            return recent_post_ms(self.recent_posts, window_s)
+
+    # Flush whatever is still queued and stop the flusher workers
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+
+#########################################
+# O11y sink
+# Gauges from every car and packet type are collected into one batch that is handed to the
+# ingest client every window_ms, or sooner once max_datapoints are waiting. Dimension dicts are
+# interned per rig and car, so every datapoint of a car shares one dict. Metrics listed in
+# aggregate_metrics can be reduced to one value per car and window: the last, min, max or avg
+# value, or all of them with .min, .max and .avg suffixes. With block set, add() waits while ten
+# windows of datapoints are waiting, for the unthrottled replay
+o11y_aggregates = ("none", "last", "min", "max", "avg", "all")
+
+
+class O11ySink:
+    def __init__(self, window_ms, max_datapoints, aggregate, aggregate_metrics, emit, block=False):
+        if aggregate not in o11y_aggregates:
+            raise ValueError("o11y_settings aggregate must be one of " + ", ".join(o11y_aggregates) + ", not " + aggregate)
+
+        self.window = window_ms / 1000.0
+        self.max_datapoints = max_datapoints
+        self.aggregate = aggregate
+        self.aggregate_metrics = frozenset(aggregate_metrics) if aggregate != "none" else frozenset()
+        self.emit = emit
+        self.block = block
+
+        self.dimensions = {}
+        self.metric_names = {}
+        self.gauges = []
+        # (metric name, dimensions key) -> [last, min, max, total, count, dimensions]
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.flush_due = threading.Condition(self.lock)
+        self.taken = threading.Condition(self.lock)
+        self.running = True
+
+        # counters
+        self.received = 0
+        self.sent = 0
+        self.batches = 0
+
+        self.worker = threading.Thread(target=self.flush_loop, name="o11y-sink", daemon=True)
+        self.worker.start()
+
+    # Queue the (metrics, dimensions) pair of every car
+    def add(self, rig, pairs):
+        with self.lock:
+            for f1_metrics, f1_dimensions in pairs:
+                key = (rig.hostname,) + tuple(f1_dimensions.items())
+                dimensions = self.dimensions.get(key)
+                if dimensions is None:
+                    dimensions = dict(f1_dimensions)
+                    dimensions["f1-2022-hostname"] = rig.hostname
+                    self.dimensions[key] = dimensions
+
+                for metric, value in f1_metrics.items():
+                    if value is None:
+                        continue
+                    name = self.metric_names.get(metric)
+                    if name is None:
+                        name = self.metric_names[metric] = "f1_2022." + metric
+
+                    self.received += 1
+                    if metric not in self.aggregate_metrics:
+                        self.gauges.append({"metric": name, "value": value, "dimensions": dimensions})
+                        continue
+
+                    window = self.windows.get((name, key))
+                    if window is None:
+                        self.windows[(name, key)] = [value, value, value, value, 1, dimensions]
+                    else:
+                        window[0] = value
+                        if value < window[1]:
+                            window[1] = value
+                        if value > window[2]:
+                            window[2] = value
+                        window[3] += value
+                        window[4] += 1
+
+            if len(self.gauges) >= self.max_datapoints:
+                self.flush_due.notify()
+            while self.block and self.running and len(self.gauges) >= self.max_datapoints * 10:
+                self.taken.wait()
+
+    # Everything collected so far as one list of gauges, the aggregated windows closed
+    def take(self):
+        gauges = self.gauges
+        self.gauges = []
+
+        for (name, key), (last, low, high, total, count, dimensions) in self.windows.items():
+            if self.aggregate in ("last", "all"):
+                gauges.append({"metric": name, "value": last, "dimensions": dimensions})
+            if self.aggregate == "min":
+                gauges.append({"metric": name, "value": low, "dimensions": dimensions})
+            if self.aggregate == "max":
+                gauges.append({"metric": name, "value": high, "dimensions": dimensions})
+            if self.aggregate == "avg":
+                gauges.append({"metric": name, "value": total / count, "dimensions": dimensions})
+            if self.aggregate == "all":
+                gauges.append({"metric": name + ".min", "value": low, "dimensions": dimensions})
+                gauges.append({"metric": name + ".max", "value": high, "dimensions": dimensions})
+                gauges.append({"metric": name + ".avg", "value": total / count, "dimensions": dimensions})
+        self.windows.clear()
+
+        return gauges
+
+    def flush_loop(self):
+        while True:
+            with self.lock:
+                deadline = time.monotonic() + self.window
+                while self.running and len(self.gauges) < self.max_datapoints:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.flush_due.wait(remaining)
+
+                gauges = self.take()
+                running = self.running
+                self.taken.notify_all()
+
+            if gauges:
+                try:
+                    self.emit(gauges)
+                    metrics.incr("o11y.datapoints", len(gauges))
+                except Exception as e:
+                    print("o11y sink error: " + str(e))
+                with self.lock:
+                    self.sent += len(gauges)
+                    self.batches += 1
+
+            if not running:
+                return
+
+    def stats(self):
+        with self.lock:
+            return {"received": self.received, "sent": self.sent, "batches": self.batches, "series": len(self.dimensions)}
+
+    # Send what is left and stop the flusher
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.flush_due.notify()
+            self.taken.notify_all()
+        self.worker.join()
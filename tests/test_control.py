@@ -0,0 +1,112 @@
+import pytest
+
+from f1_ingest import control
+
+rig_hostnames = ["rig1", "rig2"]
+
+
+def validate(changes, started_sinks=("hec",)):
+    control.validate_config(changes, rig_hostnames, frozenset(started_sinks))
+
+
+@pytest.mark.parametrize("changes", [
+    {"motion": False, "debug": True},
+    {"hec": False},
+    {"hec": True},
+    {"o11y": False},
+    {"o11y_window_ms": 500, "metrics_interval": 1, "stats_interval": 60},
+    {"hec_deltas": {"gear": 0, "cartelemetrydata.speed": 2.5, "heartbeat_ms": 5000}},
+    {"o11y_deltas": {}},
+    {"mode": "solo"},
+    {"mode": {"rig2": "spectator"}},
+])
+def test_accepts(changes):
+    validate(changes)
+
+
+@pytest.mark.parametrize("changes, message", [
+    ({"motion": "no"}, "motion must be true or false"),
+    ({"o11y": True}, "o11y was not started, restart with --o11y yes"),
+    ({"archive": True}, "archive was not started, restart with --archive yes"),
+    ({"o11y_window_ms": 0}, "o11y_window_ms must be a whole number of 1 or more"),
+    ({"stats_interval": True}, "stats_interval must be a whole number of 1 or more"),
+    ({"metrics_interval": 1.5}, "metrics_interval must be a whole number of 1 or more"),
+    ({"hec_deltas": [1]}, "hec_deltas must be an object of field thresholds"),
+    ({"hec_deltas": {"heartbeat_ms": 0}}, "hec_deltas heartbeat_ms must be a whole number of 1 or more"),
+    ({"o11y_deltas": {"gear": -1}}, "o11y_deltas gear must be a number of 0 or more"),
+    ({"o11y_deltas": {"gear": "1"}}, "o11y_deltas gear must be a number of 0 or more"),
+    ({"o11y_max_datapoints": 500}, "o11y_max_datapoints cannot be changed while running, restart the script"),
+    ({"mode": {"rig3": "solo"}}, "no rig rig3"),
+    ({"mode": "race"}, "mode must be spectator or solo, not race"),
+    ({"gzip_level": 1}, "unknown setting gzip_level"),
+])
+def test_rejects(changes, message):
+    with pytest.raises(ValueError, match="^" + message + "$"):
+        validate(changes)
+
+
+def test_one_bad_setting_rejects_the_whole_change():
+    with pytest.raises(ValueError):
+        validate({"motion": False, "mode": "race"})
+
+
+settings_ini = """[ingest_settings]
+debug = False
+
+[telemetry_settings]
+motion = False
+lap = True
+
+[o11y_settings]
+window_ms = 250
+
+[hec_deltas]
+heartbeat_ms = 2000
+gear = 0
+CarTelemetryData.engine_temperature = 2
+
+[rigs]
+rig1 = 20777, Driver One
+rig2 = 20778, Driver Two, solo
+"""
+
+
+@pytest.fixture
+def settings_path(tmp_path):
+    path = tmp_path / "settings.ini"
+    path.write_text(settings_ini)
+    return str(path)
+
+
+def test_file_config_reads_the_runtime_settings(settings_path):
+    settings = control.file_config(settings_path)
+
+    assert settings["motion"] is False
+    assert settings["lap"] is True
+    assert settings["telemetry"] is True
+    assert settings["debug"] is False
+    assert settings["o11y_window_ms"] == 250
+    assert settings["metrics_interval"] == 10
+    assert settings["stats_interval"] == 30
+    assert settings["hec_deltas"] == {"gear": 0.0, "cartelemetrydata.engine_temperature": 2.0, "heartbeat_ms": 2000}
+    assert settings["o11y_deltas"] == {}
+    assert "mode" not in settings
+    validate(settings)
+
+
+def test_file_config_reads_the_mode_of_every_rig(settings_path):
+    settings = control.file_config(settings_path, rigs=True, default_mode="spectator")
+    assert settings["mode"] == {"rig1": "spectator", "rig2": "solo"}
+
+
+def test_file_config_without_the_file(tmp_path):
+    with pytest.raises(ValueError, match="not found"):
+        control.file_config(str(tmp_path / "settings.ini"))
+
+
+def test_changed_settings_only_has_what_changed():
+    before = {"motion": True, "o11y_window_ms": 200, "mode": {"rig1": "spectator", "rig2": "solo"}}
+    after = {"motion": True, "o11y_window_ms": 300, "mode": {"rig1": "solo", "rig2": "solo"}}
+
+    assert control.changed_settings(before, after) == {"o11y_window_ms": 300, "mode": {"rig1": "solo"}}
+    assert control.changed_settings(after, after) == {}
@@ -0,0 +1,101 @@
+import json
+
+import pytest
+from f1_22_telemetry.packets import HEADER_FIELD_TO_PACKET_TYPE
+
+from f1_ingest import decoders
+
+packet_keys = sorted(HEADER_FIELD_TO_PACKET_TYPE, key=lambda key: key[2])
+
+
+# Raw UDP bytes of one packet type with every field set. Bytes below 0x40 keep the floats finite and
+# the strings ASCII, so the decoders can be compared value for value
+def packet_bytes(key, player_car_index=3):
+    packet_type = HEADER_FIELD_TO_PACKET_TYPE[key]
+    buffer = bytearray((i * 7 + key[2]) % 61 for i in range(packet_type.size()))
+    packet = packet_type.from_buffer(buffer)
+    packet.header.packet_format, packet.header.packet_version, packet.header.packet_id = key
+    packet.header.player_car_index = player_car_index
+    return bytes(buffer)
+
+
+# json.loads(packet.to_json()) with the per car arrays flattened the way MergePlan.flatten does
+def json_decode(buffer):
+    data = json.loads(decoders.unpack_packet(buffer).to_json())
+    for name, value in data.items():
+        if isinstance(value, list) and value and isinstance(value[0], dict):
+            data[name] = [flatten(entry, car_index) for car_index, entry in enumerate(value)]
+    return data
+
+
+def flatten(entry, car_index):
+    row = {}
+    for name, value in entry.items():
+        if isinstance(value, list):
+            for i, item in enumerate(value):
+                row[name + str(i + 1)] = item
+        else:
+            row[name] = value
+    row["car_index"] = car_index
+    return row
+
+
+@pytest.fixture
+def numpy():
+    module = pytest.importorskip("numpy")
+    decoders.use_numpy(module)
+    yield module
+    decoders.use_numpy(None)
+
+
+@pytest.mark.parametrize("key", packet_keys)
+def test_struct_matches_json(key):
+    buffer = packet_bytes(key)
+    assert decoders.decode_packet(buffer) == json_decode(buffer)
+
+
+# the ingest sets car_field from its merge plans, see solo_fields
+@pytest.fixture
+def lap_data_table():
+    table = decoders.packet_tables[lap_data_key]
+    table.car_field = "lap_data"
+    yield table
+    table.car_field = None
+
+
+lap_data_key = next(key for key in packet_keys if key[2] == 2)
+
+
+def test_solo_only_unpacks_the_player_car(lap_data_table):
+    buffer = packet_bytes(lap_data_key, player_car_index=3)
+    full = decoders.decode_packet(buffer)
+    solo = decoders.decode_packet(buffer, solo=True)
+
+    assert solo["lap_data"][3] == full["lap_data"][3]
+    assert solo["lap_data"].count(None) == len(full["lap_data"]) - 1
+    assert {name: value for name, value in solo.items() if name != "lap_data"} == \
+        {name: value for name, value in full.items() if name != "lap_data"}
+
+
+@pytest.mark.parametrize("key", packet_keys)
+def test_numpy_matches_struct(key, numpy):
+    buffer = packet_bytes(key)
+    rows = decoders.decode_packet(buffer)
+    columns = decoders.decode_packet(buffer, columnar=True)
+
+    for name, value in columns.items():
+        if not isinstance(value, numpy.ndarray):
+            assert value == rows[name]
+            continue
+
+        layout = decoders.column_layout(value.dtype)
+        decoded = [dict(zip(layout.keys, values), car_index=car_index)
+                   for car_index, values in enumerate(layout.values(value, decoders.car_range(len(value))))]
+        assert decoded == rows[name]
+
+
+def test_unknown_packet_is_skipped():
+    buffer = bytearray(packet_bytes(packet_keys[0]))
+    buffer[5] = 99
+    assert decoders.unpack_packet(bytes(buffer)) is None
+    assert decoders.decode_packet(bytes(buffer)) is None
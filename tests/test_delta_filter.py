@@ -0,0 +1,114 @@
+import pytest
+
+from f1_ingest import deltas
+
+telemetry = 6
+lap = 2
+context_fields = frozenset(["car_index", "name", "lap_event"])
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(deltas.time, "monotonic", lambda: now[0])
+    return now
+
+
+def delta_filter(thresholds, heartbeat_ms=60000):
+    return deltas.DeltaFilter(thresholds, heartbeat_ms, context_fields)
+
+
+def test_sends_a_field_only_once_it_moves_past_its_threshold(clock):
+    delta = delta_filter({"engine_temperature": 2})
+    row = {"car_index": 0, "engine_temperature": 90, "speed": 200}
+
+    assert delta.filter_rows(telemetry, [row]) == [row]
+    assert delta.filter_rows(telemetry, [dict(row, engine_temperature=91)]) == [{"car_index": 0, "speed": 200}]
+    assert delta.filter_rows(telemetry, [dict(row, engine_temperature=93)]) == [dict(row, engine_temperature=93)]
+    assert delta.stats() == {"kept": 2, "suppressed": 1, "dropped_rows": 0}
+
+
+def test_compares_against_the_value_last_sent_for_the_same_car(clock):
+    delta = delta_filter({"gear": 0})
+    delta.filter_rows(telemetry, [{"car_index": 0, "gear": 3, "speed": 1}, {"car_index": 1, "gear": 3, "speed": 1}])
+
+    kept = delta.filter_rows(telemetry, [{"car_index": 0, "gear": 3, "speed": 1}, {"car_index": 1, "gear": 4, "speed": 1}])
+
+    assert kept == [{"car_index": 0, "speed": 1}, {"car_index": 1, "gear": 4, "speed": 1}]
+
+
+def test_heartbeat_resends_unchanged_fields(clock):
+    delta = delta_filter({"gear": 0}, heartbeat_ms=1000)
+    row = {"car_index": 0, "gear": 3, "speed": 1}
+    delta.filter_rows(telemetry, [row])
+
+    clock[0] += 0.5
+    assert delta.filter_rows(telemetry, [row]) == [{"car_index": 0, "speed": 1}]
+    clock[0] += 0.5
+    assert delta.filter_rows(telemetry, [row]) == [row]
+
+
+def test_packet_specific_keys_win_over_wildcards():
+    delta = delta_filter({"tyres_*_temperature*": 1, "CarTelemetryData.tyres_inner_temperature1": 10})
+
+    assert delta.threshold(telemetry, "tyres_inner_temperature1") == 10
+    assert delta.threshold(telemetry, "tyres_surface_temperature2") == 1
+    assert delta.threshold(7, "tyres_inner_temperature1") == 1
+    assert delta.threshold(telemetry, "speed") is None
+
+
+def test_context_and_checkpoint_fields_are_never_filtered():
+    delta = delta_filter({"*": 100})
+
+    assert delta.threshold(telemetry, "car_index") is None
+    assert delta.threshold(telemetry, "checkpoint_1_data_received") is None
+    assert delta.threshold(telemetry, "speed") == 100
+
+
+def test_lap_and_sector_are_sent_on_every_change():
+    delta = delta_filter({"current_lap_num": 5, "sector": 5})
+
+    assert delta.threshold(lap, "current_lap_num") == 0
+    assert delta.threshold(lap, "sector") == 0
+
+
+def test_a_row_with_a_lap_event_is_sent_whole(clock):
+    delta = delta_filter({"current_lap_time_in_ms": 1000})
+    delta.filter_rows(lap, [{"car_index": 0, "current_lap_time_in_ms": 100, "lap_event": "none"}])
+
+    row = {"car_index": 0, "current_lap_time_in_ms": 200, "lap_event": "LAP_COMPLETE"}
+    assert delta.filter_rows(lap, [row]) == [row]
+
+
+def test_a_row_left_with_only_context_fields_is_dropped(clock):
+    delta = delta_filter({"gear": 0})
+    row = {"car_index": 0, "name": "Driver", "gear": 3}
+    delta.filter_rows(telemetry, [row])
+
+    assert delta.filter_rows(telemetry, [row]) == []
+    assert delta.stats()["dropped_rows"] == 1
+
+
+def test_filtered_rows_are_copies(clock):
+    delta = delta_filter({"gear": 0})
+    row = {"car_index": 0, "gear": 3, "speed": 1}
+    delta.filter_rows(telemetry, [dict(row)])
+
+    delta.filter_rows(telemetry, [row])
+    assert row == {"car_index": 0, "gear": 3, "speed": 1}
+
+
+def test_values_that_cannot_be_subtracted_are_compared_for_equality():
+    assert not deltas.moved("Soft", "Soft", 5)
+    assert deltas.moved("Soft", "Hard", 5)
+    assert deltas.moved(10, 4, 5)
+    assert not deltas.moved(9, 4, 5)
+
+
+def test_o11y_pairs_tell_cars_apart_by_their_dimensions(clock):
+    delta = delta_filter({"gear": 0})
+    first = ({"gear": 3, "speed": 1}, {"name": "A"})
+    second = ({"gear": 3, "speed": 1}, {"name": "B"})
+    delta.filter_pairs(telemetry, [first])
+
+    assert delta.filter_pairs(telemetry, [first, second]) == [({"speed": 1}, {"name": "A"}), second]
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from f1_ingest import sinks
+
+
+# Stands in for HecTransport, send() records when each batch went and waits for release
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def send(self, batch):
+        self.sent.append((time.monotonic(), list(batch)))
+        self.release.wait()
+        return "sent"
+
+
+def test_a_full_batch_goes_without_waiting_for_the_deadline():
+    transport = FakeTransport()
+    sender = sinks.HecSender(transport, max_bytes=100, max_latency_ms=10000, queue_size=100, backpressure="block", workers=1)
+    started = time.monotonic()
+    sender.put_many([b"x" * 60, b"y" * 60])
+    sender.close()
+
+    assert [batch for _, batch in transport.sent] == [[b"x" * 60, b"y" * 60]]
+    assert transport.sent[0][0] - started < 1.0
+    assert sender.stats()["flushed"] == 2
+
+
+def test_events_left_by_a_capped_batch_keep_their_deadline():
+    transport = FakeTransport()
+    transport.release.clear()
+    sender = sinks.HecSender(transport, max_bytes=100, max_latency_ms=200, queue_size=100, backpressure="block", workers=1)
+    started = time.monotonic()
+    sender.put(b"a" * 60)
+    time.sleep(0.3)
+    # the flusher is stuck posting the first event, these are put at 0.3 and due at 0.5
+    sender.put_many([b"b" * 60] * 3)
+    time.sleep(0.5)
+    transport.release.set()
+    time.sleep(0.2)
+    sender.close()
+
+    times = [round(sent - started, 1) for sent, _ in transport.sent]
+    assert [len(batch) for _, batch in transport.sent] == [1, 2, 1]
+    # the leftover event was overdue when the capped batch went, so it goes straight after it
+    assert times[2] - times[1] < 0.1
+
+
+def test_drop_oldest_makes_room_for_new_events():
+    transport = FakeTransport()
+    transport.release.clear()
+    sender = sinks.HecSender(transport, max_bytes=1000, max_latency_ms=10, queue_size=2, backpressure="drop-oldest", workers=1)
+    sender.put(b"held")
+    time.sleep(0.1)
+    sender.put_many([b"1", b"2", b"3"])
+    transport.release.set()
+    sender.close()
+
+    assert [batch for _, batch in transport.sent] == [[b"held"], [b"2", b"3"]]
+    assert sender.stats()["dropped"] == 1
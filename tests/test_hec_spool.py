@@ -0,0 +1,111 @@
+import os
+import time
+
+import pytest
+
+from f1_ingest import sinks
+
+requests = pytest.importorskip("requests")
+sinks.use_http(requests, None)
+
+
+# Stands in for HecTransport, post() fails with the error in fail until it is cleared
+class FakeTransport:
+    def __init__(self, fail=None, delay=0.01):
+        self.fail = fail
+        self.retry_delay = delay
+        self.posts = []
+
+    def post(self, payload, compressed):
+        if self.fail is not None:
+            raise self.fail
+        self.posts.append((payload, compressed))
+
+    def delay(self, attempt):
+        return self.retry_delay
+
+
+# HEC down: the first post fails and the drain thread sleeps long enough for the test to finish
+def offline_transport():
+    return FakeTransport(fail=requests.exceptions.ConnectionError("down"), delay=3600)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def spool_files(directory):
+    return sorted(name for name in os.listdir(directory) if not name.endswith(".tmp"))
+
+
+def test_write_names_the_file_after_sequence_and_events(tmp_path):
+    spool = sinks.HecSpool(str(tmp_path), 1000, offline_transport())
+    assert not spool.offline
+
+    assert spool.write(b"one", True, 3)
+    assert spool.write(b"two", False, 5)
+
+    assert spool.offline
+    assert spool_files(tmp_path) == ["0000000000000001-3.hec.gz", "0000000000000002-5.hec"]
+    assert spool.stats() == {"batches": 2, "bytes": 6, "spooled": 8, "drained": 0, "dropped": 0}
+
+
+def test_drains_in_order_once_hec_answers(tmp_path):
+    transport = FakeTransport(fail=requests.exceptions.ConnectionError("down"))
+    spool = sinks.HecSpool(str(tmp_path), 1000, transport)
+    for i in range(3):
+        spool.write(b"batch" + str(i).encode(), i % 2 == 0, 1)
+
+    transport.fail = None
+    wait_for(lambda: not spool.offline)
+
+    assert transport.posts == [(b"batch0", True), (b"batch1", False), (b"batch2", True)]
+    assert spool_files(tmp_path) == []
+    assert spool.stats()["drained"] == 3
+
+
+def test_resumes_the_batches_left_by_the_last_run(tmp_path):
+    spool = sinks.HecSpool(str(tmp_path), 1000, offline_transport())
+    spool.write(b"first", True, 2)
+    spool.write(b"second", True, 4)
+
+    transport = FakeTransport()
+    restarted = sinks.HecSpool(str(tmp_path), 1000, transport)
+    assert restarted.sequence == 2
+    wait_for(lambda: not restarted.offline)
+
+    assert transport.posts == [(b"first", True), (b"second", True)]
+    assert restarted.stats()["drained"] == 6
+
+
+def test_drops_the_oldest_batches_over_max_bytes(tmp_path):
+    spool = sinks.HecSpool(str(tmp_path), 100, offline_transport())
+    for i in range(4):
+        assert spool.write(bytes([i]) * 40, False, 10)
+
+    assert spool_files(tmp_path) == ["0000000000000003-10.hec", "0000000000000004-10.hec"]
+    assert spool.stats()["bytes"] == 80
+    assert spool.stats()["dropped"] == 20
+
+
+def test_refuses_a_batch_bigger_than_the_spool(tmp_path):
+    spool = sinks.HecSpool(str(tmp_path), 100, offline_transport())
+    assert not spool.write(b"x" * 101, False, 1)
+    assert spool_files(tmp_path) == []
+    assert not spool.offline
+
+
+def test_drops_a_batch_hec_rejects(tmp_path):
+    response = requests.Response()
+    response.status_code = 400
+    transport = FakeTransport(fail=requests.exceptions.HTTPError("bad request", response=response))
+    spool = sinks.HecSpool(str(tmp_path), 1000, transport)
+    spool.write(b"rejected", False, 7)
+
+    wait_for(lambda: not spool.offline)
+    assert transport.posts == []
+    assert spool_files(tmp_path) == []
+    assert spool.stats()["dropped"] == 7
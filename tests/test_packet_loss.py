@@ -0,0 +1,81 @@
+from f1_22_telemetry.packets import PacketHeader
+
+from f1_ingest.receive import PacketLoss
+
+telemetry = 6
+event = 3
+
+
+def packet(packet_id, frame, session_uid=1, interval=1 / 60):
+    header = PacketHeader()
+    header.packet_format = 2022
+    header.packet_id = packet_id
+    header.session_uid = session_uid
+    header.session_time = frame * interval
+    header.frame_identifier = frame
+    return bytes(header)
+
+
+def feed(loss, frames, packet_id=telemetry, **kwargs):
+    for frame in frames:
+        loss.check(packet(packet_id, frame, **kwargs))
+
+
+def test_a_steady_stream_loses_nothing():
+    loss = PacketLoss()
+    feed(loss, range(100))
+    assert loss.lost[telemetry] == 0
+    assert loss.late[telemetry] == 0
+
+
+def test_a_gap_of_n_intervals_is_n_minus_one_lost():
+    loss = PacketLoss()
+    feed(loss, range(20))
+    # 19 to 23 is four intervals, frames 20 to 22 never arrived
+    feed(loss, range(23, 40))
+    assert loss.lost[telemetry] == 3
+
+
+def test_the_interval_is_learned_per_packet_id():
+    loss = PacketLoss()
+    # sent every other frame
+    feed(loss, range(0, 40, 2))
+    feed(loss, range(0, 20), packet_id=2)
+    assert loss.lost == [0] * 16
+
+
+def test_nothing_is_counted_before_the_interval_is_known():
+    loss = PacketLoss()
+    feed(loss, [0, 1, 5, 6])
+    assert loss.lost[telemetry] == 0
+
+
+def test_an_older_packet_is_late_not_lost():
+    loss = PacketLoss()
+    feed(loss, range(20))
+    feed(loss, [18, 20, 21])
+    assert loss.late[telemetry] == 1
+    assert loss.lost[telemetry] == 0
+
+
+def test_a_pause_longer_than_the_max_gap_is_not_loss():
+    loss = PacketLoss()
+    feed(loss, range(20))
+    feed(loss, range(20 + 60 * 6, 30 + 60 * 6))
+    assert loss.lost[telemetry] == 0
+
+
+def test_a_new_session_starts_the_tracking_again():
+    loss = PacketLoss()
+    feed(loss, range(20))
+    feed(loss, range(100, 120), session_uid=2)
+    assert loss.lost[telemetry] == 0
+    assert loss.session_uid == 2
+
+
+def test_event_packets_and_short_datagrams_are_ignored():
+    loss = PacketLoss()
+    feed(loss, range(0, 100, 10), packet_id=event)
+    loss.check(packet(telemetry, 0)[:10])
+    assert loss.lost == [0] * 16
+    assert loss.last_time[telemetry] is None